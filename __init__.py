@@ -29,14 +29,12 @@ Skill idea: have some small talk with Picroft
 # Version 3.1.20230320 added more vehicle queries
 
 import os
-from os.path import exists
+import time
+import threading
 from adapt.intent import IntentBuilder
 from mycroft import MycroftSkill, intent_handler, intent_file_handler
 from mycroft.skills.context import adds_context, removes_context
-from mycroft.util.parse import normalize
-
-# note the relative '.'
-from .wita_pi_energy import pi_energy
+# wita_pi_energy is imported by get_pi_energy(), not to slow down loading the skill
 
 class TalkToMe(MycroftSkill):
     def __init__(self):
@@ -122,11 +120,45 @@ class TalkToMe(MycroftSkill):
         self.register_intent_file("query.grid.report.intent", self.grid_report_query)
         # PVReport
         self.register_intent_file("query.pv.report.intent", self.pv_report_query)
-
-        self.skill_path = "/opt/mycroft/skills/talk-to-me-skill"
+        # PVPowerProductionYesterday
+        self.register_intent_file("query.pv-power.production.yesterday.intent", self.pv_power_production_yesterday_query)
+        # PVPowerProductionWeek
+        self.register_intent_file("query.pv-power.production.week.intent", self.pv_power_production_week_query)
+        # OverallPowerAutonomyWeek
+        self.register_intent_file("query.overall.power.autonomy.week.intent", self.overall_power_autonomy_week_query)
+        # HistoryReport
+        self.register_intent_file("query.history.report.intent", self.history_report_query)
+
+        self.skill_path = self.root_dir
         #self.lang = "de-de"
         #note:  see also pihelper.sh, implementation of the energy-files location must be in sync
-        self.pi_e = pi_energy("/tmp/talk-to-me_energy-files/energy-files")
+        #      the folder is watched, so json files are only checked after the collector wrote them
+        #      json files are loaded by the background refresher, intent handlers only read memory
+        #      the values are recorded in the history store, kept in the skill's file system
+        #      a collector may write energy-snapshot.wsnap instead of the json files, see wita_pi_snapshot.py
+        #      pi_energy is constructed by the prewarm or the first query, see get_pi_energy()
+        self.pi_e = None
+        self.pi_e_lock = threading.Lock()
+        # refresh interval in secs of the background refresher, see handle_energy_refresh()
+        self.refresh_interval = 5
+        # prewarm right after startup, then keep the energy data warm
+        self.schedule_event(self.handle_energy_refresh, 1, name="EnergyPrewarm")
+        self.schedule_repeating_event(self.handle_energy_refresh, None, self.refresh_interval, name="EnergyRefresh")
+        # every stats_log_interval queries the pi_energy timings and counters are logged
+        self.stats_log_interval = 20
+        self.query_count = 0
+        # optional metrics of the queries and of pi_energy, see wita_pi_metrics.py
+        #      metrics_port: serve them on http://127.0.0.1:<metrics_port>/metrics
+        #      metrics_textfile: write them on every refresh for the textfile collector of node_exporter
+        #      both are off if not set, the metrics are set up by get_pi_energy()
+        self.metrics = None
+        # optional socket collectors push their records to, rather than writing the json files
+        #      ingest_socket: path of the unix socket, see wita_pi_server.py, off if not set
+        self.ingest_server = None
+        # days of history kept, see wita_pi_history.py, None keeps all of it
+        #      history_days: validated by load_settings(), default 1200 days
+        self.history_days = 1200
+        self.load_settings()
 
         self.query_hash = {
         #   search_key                   WITA_query_item                  not_found_dialog file
@@ -200,7 +232,22 @@ class TalkToMe(MycroftSkill):
             "GridReport":                   ("grid",                           "grid_report_not_known"),
             # PVReport
             "PVReport":                     ("photovoltaik",                   "pv_report_not_known"),
+            # PV Power production yesterday
+            "PVPowerProductionYesterday":   ("pv_production_yesterday",        "pv_production_yesterday_not_known"),
+            # PV Power production this week
+            "PVPowerProductionWeek":        ("pv_production_week",             "pv_production_week_not_known"),
+            # Overall Power Autonomy this week
+            "OverallPowerAutonomyWeek":     ("energy_autonomy_week",           "energy_autonomy_week_not_known"),
+            # HistoryReport
+            "HistoryReport":                ("history",                        "history_report_not_known"),
         }
+        # hash of language to hash of search_key to the not_found dialog to speak,
+        # query_default_not_known if the dialog of query_hash is not available, see dialog_index()
+        self.not_found_dialogs = {}
+        self.dialog_index(self.lang)
+        # the index is built again after the language was changed, the settings are checked again
+        self.add_event("configuration.updated", self.handle_configuration_updated)
+        self.settings_change_callback = self.handle_configuration_updated
 
 
     def query(self, search_item):
@@ -216,23 +263,123 @@ class TalkToMe(MycroftSkill):
             self.speak_dialog('query_not_supported', expect_response=True)
             return
         query_ctrl = self.query_hash[search_item]
-        rc, rc_msg, rc_TTS = self.pi_e.query(query_ctrl[0])
+        pi_e = self.get_pi_energy()
+        t0 = time.perf_counter()
+        rc = 0
+        rc_msg = " no answer"
+        # reports are spoken sentence by sentence: the first sentence is spoken
+        # while the following ones are still calculated
+        for rc, rc_msg, rc_TTS in pi_e.query_stream(query_ctrl[0]):
+            if rc != 0:
+                break
+            self.speak_dialog(rc_TTS, expect_response=True)
+        if self.metrics is not None:
+            self.metrics.observe(search_item, rc, time.perf_counter() - t0)
         self.log.info(" executed query " + query_ctrl[0])
         self.log.info(" rc= " + str(rc)  + " rc_msg= " + rc_msg)
+        self.query_count += 1
+        if self.query_count % self.stats_log_interval == 0:
+            self.log.info(" pi_energy stats: " + pi_e.stats_summary())
         if rc != 0:
-            if not exists(self.skill_path + "/locale/" + self.lang + "/" + query_ctrl[1] + ".dialog"):
-                dialog = "query_default_not_known"
-            else:
-                dialog = query_ctrl[1]
-            self.speak_dialog(dialog, expect_response=True)
-        else:
-            if isinstance(rc_TTS, list):
-                for t in rc_TTS:
-                    self.speak_dialog(t, expect_response=True)
-            else:
-                self.speak_dialog(rc_TTS, expect_response=True)
+            self.speak_dialog(self.dialog_index(self.lang)[search_item], expect_response=True)
         return
 
+    def dialog_index(self, lang):
+        """ return the hash of search_key to the not_found dialog of language lang.
+            the dialogs available in the locale folder of lang are listed once per language,
+            dialogs that are not available fall back to query_default_not_known.
+        """
+        if lang not in self.not_found_dialogs:
+            try:
+                available = set(os.listdir(os.path.join(self.skill_path, "locale", lang)))
+            except OSError:
+                available = set()
+            dialogs = {}
+            for search_key, query_ctrl in self.query_hash.items():
+                if query_ctrl[1] + ".dialog" in available:
+                    dialogs[search_key] = query_ctrl[1]
+                else:
+                    dialogs[search_key] = "query_default_not_known"
+            self.not_found_dialogs[lang] = dialogs
+        return self.not_found_dialogs[lang]
+
+    def handle_configuration_updated(self, message=None):
+        """ the language or the settings may have changed, build the dialog index
+            of the current language and check the settings
+        """
+        self.not_found_dialogs = {}
+        self.dialog_index(self.lang)
+        self.load_settings()
+
+    def load_settings(self):
+        """ check the skill settings used by pi_energy, a malformed one is logged and
+            the previous value is kept
+        """
+        history_days = self.settings.get("history_days", 1200)
+        try:
+            history_days = int(history_days) if history_days not in (None, "") else None
+            if history_days is not None and history_days <= 0:
+                raise ValueError("not a positive number of days")
+        except (TypeError, ValueError) as e:
+            self.log.error(" setting history_days " + repr(history_days) + " is invalid, "
+                           + str(self.history_days) + " is kept: " + str(e))
+            return
+        self.history_days = history_days
+        if self.pi_e is not None and self.pi_e.history is not None:
+            self.pi_e.history.retention_days = history_days
+
+    def get_pi_energy(self):
+        """ return the pi_energy object, constructed on first use.
+            wita_pi_energy is imported here, so loading the skill does not pay for it.
+        """
+        if self.pi_e is None:
+            with self.pi_e_lock:
+                if self.pi_e is None:
+                    # note the relative '.'
+                    from .wita_pi_energy import pi_energy
+                    self.pi_e = pi_energy("/tmp/talk-to-me_energy-files/energy-files", watch=True,
+                                          load_on_query=False,
+                                          history=os.path.join(self.file_system.path, "wita-history.sqlite"),
+                                          snapshot="energy-snapshot.wsnap",
+                                          history_days=self.history_days)
+                    if self.settings.get("metrics_port") or self.settings.get("metrics_textfile"):
+                        from .wita_pi_metrics import pi_energy_metrics
+                        self.metrics = pi_energy_metrics(self.pi_e)
+                        if self.settings.get("metrics_port"):
+                            rc, rc_msg = self.metrics.serve(int(self.settings.get("metrics_port")))
+                            self.log.info(rc_msg)
+                    if self.settings.get("ingest_socket"):
+                        from .wita_pi_server import pi_energy_server
+                        # only the user running Mycroft may push, with 660 its group as well
+                        socket_mode = 0o660 if str(self.settings.get("ingest_socket_mode")) == "660" else 0o600
+                        # the refresher of the skill keeps pi_energy up to date, the server does not
+                        self.ingest_server = pi_energy_server(self.pi_e, self.settings.get("ingest_socket"),
+                                                              refresh_interval=None, socket_mode=socket_mode)
+                        rc, rc_msg = self.ingest_server.start()
+                        self.log.info(rc_msg)
+                        if rc != 0:
+                            self.ingest_server = None
+        return self.pi_e
+
+    def handle_energy_refresh(self, message=None):
+        """ background refresher: load and index energy files that changed and
+            prerender the answers, so intent handlers find them in memory.
+            the watch rules fired by the reload are announced, see pi_energy.pi_watch_rules.
+            the first run (EnergyPrewarm) constructs pi_energy.
+        """
+        try:
+            pi_e = self.get_pi_energy()
+            pi_e.refresh()
+            for rule, rc_TTS in pi_e.take_notifications():
+                self.log.info(" watch rule " + rule + " fired")
+                self.speak_dialog(rc_TTS, expect_response=False)
+            if self.metrics is not None and self.settings.get("metrics_textfile"):
+                rc, rc_msg = self.metrics.write_textfile(self.settings.get("metrics_textfile"))
+                if rc != 0:
+                    self.log.error(rc_msg)
+        except Exception as e:
+            self.log.error(" energy refresh failed: " + str(e))
+
     # trigger on user intent "me.to.talk.intent"
     # note, decorators must be on top of the function call
     @intent_handler( 'me.to.talk.intent' )
@@ -452,6 +599,22 @@ class TalkToMe(MycroftSkill):
     def pv_report_query(self, message):
         self.query('PVReport')
 
+    @intent_handler( IntentBuilder('PVPowerProductionYesterday').build() )
+    def pv_power_production_yesterday_query(self, message):
+        self.query('PVPowerProductionYesterday')
+
+    @intent_handler( IntentBuilder('PVPowerProductionWeek').build() )
+    def pv_power_production_week_query(self, message):
+        self.query('PVPowerProductionWeek')
+
+    @intent_handler( IntentBuilder('OverallPowerAutonomyWeek').build() )
+    def overall_power_autonomy_week_query(self, message):
+        self.query('OverallPowerAutonomyWeek')
+
+    @intent_handler( IntentBuilder('HistoryReport').build() )
+    def history_report_query(self, message):
+        self.query('HistoryReport')
+
     # trigger to play an mp3 file
     # the mp3 file will be selected ramdomly from a list of available files
     # the selected mp3 file is addressed via its URI file://<host>/<path>/<file>
@@ -484,6 +647,20 @@ class TalkToMe(MycroftSkill):
         self.log.info("running stop()")
         pass
 
+    def shutdown(self):
+        """ the skill is unloaded or reloaded: stop the refresher and the servers and
+            close pi_energy, that is its watcher, json workers and history store
+        """
+        self.cancel_scheduled_event("EnergyPrewarm")
+        self.cancel_scheduled_event("EnergyRefresh")
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.ingest_server is not None:
+            self.ingest_server.stop()
+        with self.pi_e_lock:
+            if self.pi_e is not None:
+                self.pi_e.close()
+
 
 def create_skill():
     return TalkToMe()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""import time budget of the talk-to-me skill
+   Mycroft loads all skills at boot, so loading this skill must stay cheap:
+     - the skill (__init__.py) must not import heavy modules at load time,
+       checked statically as mycroft is not installed everywhere
+     - every wita_pi_* module must import within its budget, measured by
+       python -X importtime in a fresh interpreter (median of -n runs, bytecode warm)
+     - constructing pi_energy must stay within its budget
+   budgets are relative to a reference measured in the same run, the import of the
+   json module resp. decoding the sample json files, so a slow or loaded machine
+   raises the budgets as well. exit code is 1 if a budget is exceeded, the top
+   imports of the module are listed.
+
+   usage: pi-import-budget.py [-n <runs>] [-f <factor>]
+          -f scales all budgets, e.g. -f 0.5 to tighten them
+"""
+
+import sys
+import os
+import ast
+import time
+import statistics
+import subprocess
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# module whose import time is the unit of the import budgets
+import_reference = "json"
+# budgets of the cumulative import time of the modules in units of import_reference,
+# about three times what they take, an eager import of asyncio or http.server takes
+# about 5 units and fails the check
+import_budgets = {
+    "wita_pi_energy":   2.0,
+    "wita_pi_datetime": 1.0,
+    "wita_pi_history":  2.0,    # sqlite3
+    "wita_pi_snapshot": 2.5,    # json, mmap
+    "wita_pi_server":   4.0,    # the thin client, json and socket
+    "wita_pi_metrics":  1.5,    # http.server is imported by serve()
+}
+# budget of pi_energy() in units of decoding the json files of the sample energy-files
+construct_budget = 3.0
+# modules the skill must not import at load time
+skill_forbidden = ["wita_pi_energy", "mycroft.util.parse"]
+
+################################################################################
+
+def skill_imports():
+    """ return the modules imported at module level of the skill's __init__.py """
+    with open(os.path.join(skill_path, "__init__.py")) as s_handle:
+        tree = ast.parse(s_handle.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            modules.extend([alias.name for alias in node.names])
+        elif isinstance(node, ast.ImportFrom):
+            modules.append(node.module or "")
+    return modules
+
+################################################################################
+
+def import_time(module):
+    """ import module in a fresh interpreter with -X importtime
+        return: cumulative import time of module in ms, list of (cumulative ms, name) of all imports
+    """
+    # bytecode is written and used like in an installed skill
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    r = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                       cwd=skill_path, capture_output=True, text=True, env=env)
+    total = None
+    imports = []
+    started = False
+    for line in r.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue    # header line
+        cumulative = int(fields[1]) / 1000
+        name = fields[2].strip()
+        if not started:
+            # imports up to site are the ones of the interpreter startup
+            started = name == "site"
+            continue
+        imports.append((cumulative, name))
+        if fields[2].rstrip() == " " + module:
+            total = cumulative
+    return total, imports
+
+################################################################################
+
+def median_import_time(module, runs):
+    """ return the median cumulative import time of module in ms, None if it cannot be imported,
+        and the list of imports of the first run, see import_time()
+    """
+    import_time(module)     # compile the bytecode once
+    results = [import_time(module) for i in range(runs)]
+    totals = [total for total, imports in results if total is not None]
+    if not totals:
+        return None, []
+    return statistics.median(totals), results[0][1]
+
+################################################################################
+
+def construct_time(runs):
+    """ return the median time in ms of pi_energy() and of decoding the sample json files,
+        measured alternately, so both see the same load of the machine
+    """
+    import json
+    import glob
+    sys.path.insert(0, skill_path)
+    from wita_pi_energy import pi_energy
+    path_to_energy_files = os.path.join(skill_path, "energy-files")
+    j_datas = []
+    for path_to_file in sorted(glob.glob(os.path.join(path_to_energy_files, "*.json"))):
+        with open(path_to_file, "rb") as j_handle:
+            j_datas.append(j_handle.read())
+    pi_energy(path_to_energy_files)
+    samples = []
+    references = []
+    for i in range(runs):
+        t0 = time.perf_counter()
+        pi_energy(path_to_energy_files)
+        t1 = time.perf_counter()
+        for j_data in j_datas:
+            json.loads(j_data)
+        t2 = time.perf_counter()
+        samples.append((t1 - t0) * 1000)
+        references.append((t2 - t1) * 1000)
+    return statistics.median(samples), statistics.median(references)
+
+################################################################################
+
+if __name__ == "__main__":
+
+    runs = 5
+    factor = 1.0
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print(__doc__)
+            sys.exit(1)
+        if sys.argv[i] == "-n" or sys.argv[i] == "--runs":
+            runs = int(sys.argv[i+1])
+        if sys.argv[i] == "-f" or sys.argv[i] == "--factor":
+            factor = float(sys.argv[i+1])
+
+    failed = 0
+    for module in skill_imports():
+        for forbidden in skill_forbidden:
+            if module == forbidden or module.endswith("." + forbidden) or module == "." + forbidden:
+                print("FAIL  __init__.py imports " + module + " at load time")
+                failed += 1
+
+    unit, imports = median_import_time(import_reference, runs)
+    if unit is None:
+        print("FAIL  " + import_reference + " could not be imported")
+        sys.exit(1)
+    print("      " + import_reference + ": " + str(round(unit, 1)) + " ms, the unit of the import budgets")
+    for module, budget in import_budgets.items():
+        median, imports = median_import_time(module, runs)
+        if median is None:
+            print("FAIL  " + module + " could not be imported")
+            failed += 1
+            continue
+        ok = median <= budget * factor * unit
+        print(("ok    " if ok else "FAIL  ") + module + ": " + str(round(median, 1)) + " ms = "
+              + str(round(median / unit, 2)) + ", budget " + str(round(budget * factor, 2)))
+        if not ok:
+            failed += 1
+            for cumulative, name in sorted(imports, reverse=True)[1:6]:
+                print("          " + str(round(cumulative, 1)) + " ms  " + name)
+
+    median, unit = construct_time(max(runs, 20))
+    ok = median <= construct_budget * factor * unit
+    print(("ok    " if ok else "FAIL  ") + "pi_energy(): " + str(round(median, 3)) + " ms = "
+          + str(round(median / unit, 2)) + ", budget " + str(round(construct_budget * factor, 2))
+          + " (decoding the sample json files: " + str(round(unit, 3)) + " ms)")
+    if not ok:
+        failed += 1
+
+    sys.exit(1 if failed else 0)
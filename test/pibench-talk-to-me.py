@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""benchmark suite for pi_energy of the talk-to-me skill
+   generates synthetic energy-files folders with 1x, 100x, 10000x the entries of
+   the sample json files in ../energy-files and measures
+     - cold load: pi_energy construction and loading all json files
+     - cold load of the same content from a binary snapshot, see wita_pi_snapshot.py
+     - warm single item, derived function and each report, answered from the answer cache
+     - the same queries rendered without the answer and function caches
+     - memory: peak and retained memory of the cold load (tracemalloc)
+   results are written as json, so releases can be compared.
+
+   usage: pibench-talk-to-me.py [-s 1,100,10000] [-n <repeat>] [-o <result.json>] [-k]
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import tempfile
+import statistics
+import tracemalloc
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, skill_path)
+from wita_pi_energy import pi_energy
+from wita_pi_snapshot import pi_snapshot_writer
+
+bench_version = "1.0/2023/0401"
+
+# queries measured per scale
+bench_single_items = ["outdoor", "pv-total Energy", "charger Charge status", "vehicle Odometer"]
+bench_functions = ["energy_consumption_today", "energy_autonomy_today", "vehicle_km_tolerance_now"]
+
+################################################################################
+
+def scale_json(jdict, scale, file_no):
+    """ return a copy of the sample json dict jdict with scale times the entries.
+        the sample entries are kept (as the last ones), so all queries still succeed.
+    """
+    if scale <= 1:
+        return jdict
+    scaled = {}
+    records = list(jdict.items())
+    is_record_list = all(isinstance(v, list) and len(v) >= 4 and isinstance(v[0], str) for k, v in records) \
+                     and all(k.isdigit() for k, v in records)
+    n = 1
+    for copy in range(1, scale):
+        for key, entry in records:
+            if is_record_list:
+                # PV, CH and V files: list of records [key1, key2, unit, value, ...] keyed by a number
+                record = list(entry)
+                record[0] = record[0] + "-bench" + str(file_no) + "-" + str(copy)
+                scaled[str(n)] = record
+                n += 1
+            else:
+                # HP files: dict of item -> [unit, value, description]
+                scaled[key + "_bench" + str(copy)] = entry
+    for key, entry in records:
+        if is_record_list:
+            scaled[str(n)] = entry
+            n += 1
+        else:
+            scaled[key] = entry
+    return scaled
+
+################################################################################
+
+def generate_energy_files(path, scale):
+    """ write a synthetic energy-files folder to path with scale times the sample entries
+        return: number of bytes written
+    """
+    sample_path = os.path.join(skill_path, "energy-files")
+    os.makedirs(path, exist_ok=True)
+    size = 0
+    for file_no, filename in enumerate(sorted(os.listdir(sample_path))):
+        if not filename.endswith(".json"):
+            continue
+        with open(os.path.join(sample_path, filename)) as j_handle:
+            jdict = json.load(j_handle)
+        text = json.dumps(scale_json(jdict, scale, file_no))
+        with open(os.path.join(path, filename), "w") as j_handle:
+            j_handle.write(text)
+        size += len(text)
+    return size
+
+################################################################################
+
+def timings(samples):
+    """ summary of a list of timings in seconds, reported in micro seconds """
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "min_us": round(samples[0] * 1e6, 1),
+        "median_us": round(statistics.median(samples) * 1e6, 1),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1e6, 1),
+        "max_us": round(samples[-1] * 1e6, 1),
+    }
+
+def measure(fct, repeat, before=None):
+    samples = []
+    for i in range(repeat):
+        if before is not None:
+            before()
+        t0 = time.perf_counter()
+        fct()
+        samples.append(time.perf_counter() - t0)
+    return timings(samples)
+
+################################################################################
+
+def bench_scale(path, scale, repeat):
+    """ run all measurements on the energy-files folder path """
+    result = {"scale": scale}
+    result["bytes"] = generate_energy_files(path, scale)
+
+    # cold load, every sample with a new pi_energy
+    cold = []
+    for i in range(max(1, repeat // 10)):
+        t0 = time.perf_counter()
+        pi_e = pi_energy(path)
+        pi_e.load_json_files()
+        cold.append(time.perf_counter() - t0)
+    result["cold_load"] = timings(cold)
+
+    # cold load of the snapshot
+    writer = pi_snapshot_writer(os.path.join(path, "energy-snapshot.wsnap"))
+    for jfile_ctl in pi_e.json_files.values():
+        writer.set_section(jfile_ctl[0], jfile_ctl[2])
+    writer.write()
+    cold = []
+    for i in range(max(1, repeat // 10)):
+        t0 = time.perf_counter()
+        pi_s = pi_energy(path, snapshot="energy-snapshot.wsnap")
+        pi_s.load_json_files()
+        cold.append(time.perf_counter() - t0)
+    result["cold_load_snapshot"] = timings(cold)
+
+    tracemalloc.start()
+    pi_e = pi_energy(path)
+    pi_e.load_json_files()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    result["memory"] = {"retained_bytes": retained, "peak_bytes": peak}
+
+    def clear_cache():
+        # both caches, otherwise derived functions and reports reuse their function results
+        pi_e.answer_cache.clear()
+        pi_e.function_cache.clear()
+
+    queries = {}
+    for item in bench_single_items + bench_functions + list(pi_e.pi_query_items_reports):
+        rc, rc_msg, rc_TTS = pi_e.query(item)
+        queries[item] = {
+            "kind": "report" if item in pi_e.pi_query_items_reports else
+                    "function" if item in pi_e.pi_query_items_functions else "item",
+            "rc": rc,
+            "warm": measure(lambda: pi_e.query(item), repeat),
+            "uncached": measure(lambda: pi_e.query(item), repeat, clear_cache),
+        }
+    result["queries"] = queries
+    return result
+
+################################################################################
+
+def print_help():
+    print(__doc__)
+
+if __name__ == "__main__":
+
+    scales = [1, 100, 10000]
+    repeat = 200
+    output = None
+    keep = False
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print_help()
+            sys.exit(1)
+        if sys.argv[i] == "-s" or sys.argv[i] == "--scales":
+            scales = [int(s) for s in sys.argv[i+1].split(",")]
+        if sys.argv[i] == "-n" or sys.argv[i] == "--repeat":
+            repeat = int(sys.argv[i+1])
+        if sys.argv[i] == "-o" or sys.argv[i] == "--output":
+            output = sys.argv[i+1]
+        if sys.argv[i] == "-k" or sys.argv[i] == "--keep":
+            keep = True
+
+    tmp_path = tempfile.mkdtemp(prefix="pibench-talk-to-me-")
+    results = {
+        "bench_version": bench_version,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "machine": os.uname().machine,
+        "repeat": repeat,
+        "scales": [],
+    }
+    try:
+        for scale in scales:
+            print("pibench: scale " + str(scale) + "x ...", file=sys.stderr)
+            results["scales"].append(bench_scale(os.path.join(tmp_path, "x" + str(scale)), scale, repeat))
+    finally:
+        if keep:
+            print("pibench: energy-files kept in " + tmp_path, file=sys.stderr)
+        else:
+            shutil.rmtree(tmp_path)
+
+    text = json.dumps(results, indent=2)
+    if output is None:
+        print(text)
+    else:
+        with open(output, "w") as r_handle:
+            r_handle.write(text + "\n")
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""collector stand-in for the push ingestion of pi_energy, see wita_pi_server.py
+   starts pi_energy_server in this process on a copy of the sample energy-files
+   and pushes records like a collector would, then checks that
+     - only the owner may connect to the socket
+     - a valid push changes the answer, the json file is not written
+     - a malformed push is refused with an error rc over the socket, pi_energy keeps
+       answering from the records loaded before and the json file is not written
+     - pushes larger than the 64 KiB line limit of asyncio are accepted, pushes
+       longer than the request limit of the server are refused, the connection stays open
+     - json files whose answers cannot be rendered are not installed
+     - the records are written to the json file only if no server accepts the connection
+     - concurrent pushes without server are all merged into the json file, which keeps its
+       permissions and stays valid json, no temporary files are left
+
+   usage: pipush-talk-to-me.py [-p <path to energy files>] [-k]
+          -k keeps the copy of the energy-files
+   exit code is 1 if a check failed
+"""
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import threading
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, skill_path)
+
+from wita_pi_energy import pi_energy
+from wita_pi_server import pi_energy_server, pi_energy_client, pi_energy_push
+
+failed = 0
+
+def check(ok, text):
+    global failed
+    print(("ok    " if ok else "FAIL  ") + text)
+    if not ok:
+        failed += 1
+
+def read_file(path_to_file):
+    with open(path_to_file, "rb") as f_handle:
+        return f_handle.read()
+
+################################################################################
+
+if __name__ == "__main__":
+
+    path_to_sample = os.path.join(skill_path, "energy-files")
+    keep = False
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print(__doc__)
+            sys.exit(1)
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_sample = sys.argv[i+1]
+        if sys.argv[i] == "-k" or sys.argv[i] == "--keep":
+            keep = True
+
+    tmp = tempfile.mkdtemp(prefix="pipush-")
+    path_to_energy_files = os.path.join(tmp, "energy-files")
+    shutil.copytree(path_to_sample, path_to_energy_files)
+    path_to_socket = os.path.join(tmp, "wita-pi-energy.sock")
+    path_to_longterm = os.path.join(path_to_energy_files, "hpm-out-longterm.json")
+
+    pi_e = pi_energy(path_to_energy_files, watch=True, load_on_query=False)
+    pi_e.refresh()
+    server = pi_energy_server(pi_e, path_to_socket, refresh_interval=None)
+    server.request_limit = 1024 * 1024
+    rc, rc_msg = server.start()
+    check(rc == 0, rc_msg)
+    mode = os.stat(path_to_socket).st_mode & 0o777
+    check(mode == 0o600, "permissions of the socket: " + oct(mode))
+    client = pi_energy_client(path_to_socket)
+    check(client.connect(), "client connected to " + path_to_socket)
+
+    on_disk = read_file(path_to_longterm)
+    rc, rc_msg, answer = pi_e.query("outdoor")
+
+    # valid push
+    rc, rc_msg, mode = pi_energy_push("HPP", {"outdoor": ["degree", 21.5, "Aussentemperatur"]},
+                                      path_to_energy_files, client=client)
+    check(rc == 0 and mode == "socket", "push of a valid record: " + mode + " rc=" + str(rc) + rc_msg)
+    rc, rc_msg, pushed = pi_e.query("outdoor")
+    check(pushed != answer and "21,5" in pushed, "answer after the push: " + pushed)
+    check(read_file(path_to_longterm) == on_disk, "json file is not written by a push")
+
+    # malformed push: the description of the HP record is missing
+    rc, rc_msg, mode = pi_energy_push("HPP", {"outdoor": ["degree", 30]}, path_to_energy_files, client=client)
+    check(rc != 0 and mode == "socket", "push of a malformed record is refused: " + mode + " rc=" + str(rc) + rc_msg)
+    rc, rc_msg, after = pi_e.query("outdoor")
+    check(rc == 0 and after == pushed, "answer after the malformed push: " + after)
+    check(read_file(path_to_longterm) == on_disk, "json file is not written by a malformed push")
+    response = client.request({"stats": True})
+    check(response is not None and response["rc"] == 0, "server still answers after the malformed push")
+
+    # large pushes: 2000 records of about 80 bytes each, then more than the request limit
+    records = [["vehicle", "Soc", "%", "66"]] + [["pipush", "record-%05d" % n, "kWh", "%.3f" % (n * 1.5),
+                                                  "2023-01-26 15:34:10.082062"] for n in range(2000)]
+    rc, rc_msg, mode = pi_energy_push("V", records, path_to_energy_files, client=client)
+    check(rc == 0 and mode == "socket", "push of " + str(len(records)) + " records: " + mode + " rc=" + str(rc) + rc_msg)
+    rc, rc_msg, soc = pi_e.query("vehicle Soc")
+    check(rc == 0 and "66" in soc, "answer after the large push: " + soc)
+    records = [["pipush", "record-%06d" % n, "kWh", "1.0"] for n in range(30000)]
+    rc, rc_msg, mode = pi_energy_push("V", records, path_to_energy_files, client=client)
+    check(rc == 8 and mode == "socket", "push longer than the request limit is refused: " + mode + " rc=" + str(rc) + rc_msg)
+    rc, rc_msg, mode = pi_energy_push("V", [["vehicle", "Soc", "%", "67"]], path_to_energy_files, client=client)
+    check(rc == 0 and mode == "socket", "push on the same connection: " + mode + " rc=" + str(rc) + rc_msg)
+
+    # json files whose answers cannot be rendered are not installed
+    jfile_ctl = pi_e.json_files["3"]
+    bad = dict(jfile_ctl[2])
+    bad["outdoor"] = ["degree"]
+    with pi_e.lock:
+        rc, rc_msg = pi_e.install_json_files([["3", 1.0, 10, bad, bad, 0.0]], 0.0)
+    check(rc != 0, "json file with records of the wrong shape is not installed:" + rc_msg)
+    rc, rc_msg, after = pi_e.query("outdoor")
+    check(rc == 0 and after == pushed and jfile_ctl[2] is not bad, "answer after the failed install: " + after)
+
+    # file mode once the server is gone
+    server.stop()
+    rc, rc_msg, mode = pi_energy_push("HPP", {"outdoor": ["degree", 22.5, "Aussentemperatur"]},
+                                      path_to_energy_files, client=client)
+    check(rc == 0 and mode == "file", "push without server: " + mode + " rc=" + str(rc) + rc_msg)
+    check(b"22.5" in read_file(path_to_longterm), "json file is written by a push without server")
+
+    # concurrent pushes without server: every writer merges into the json file written before
+    path_to_vehicle = os.path.join(path_to_energy_files, "vehicle.json")
+    mode = os.stat(path_to_vehicle).st_mode & 0o777
+    results = []
+    def push_many(writer):
+        for n in range(25):
+            results.append(pi_energy_push("V", [["pipush-%d" % writer, "record-%02d" % n, "kWh", str(n)]],
+                                          path_to_energy_files, path_to_socket=path_to_socket))
+    writers = [threading.Thread(target=push_many, args=(writer,)) for writer in range(8)]
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    check(all(rc == 0 and mode_push == "file" for rc, rc_msg, mode_push in results),
+          str(len(results)) + " concurrent pushes without server")
+    with open(path_to_vehicle) as j_handle:
+        records = json.load(j_handle).values()
+    pushed = set((r[0], r[1]) for r in records if r[0].startswith("pipush-"))
+    check(len(pushed) == 8 * 25, str(len(pushed)) + " of " + str(8 * 25) + " records in the json file")
+    check(os.stat(path_to_vehicle).st_mode & 0o777 == mode, "permissions of the json file: "
+          + oct(os.stat(path_to_vehicle).st_mode & 0o777))
+    left = [f for f in os.listdir(path_to_energy_files) if f.endswith(".tmp")]
+    check(not left, "temporary files left: " + str(left))
+    client.close()
+    pi_e.close()
+    if keep:
+        print("energy-files kept in " + path_to_energy_files)
+    else:
+        shutil.rmtree(tmp, ignore_errors=True)
+    sys.exit(1 if failed else 0)
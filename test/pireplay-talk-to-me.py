@@ -0,0 +1,441 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""in-process utterance replay of the talk-to-me skill
+   replays the *.uterances files like pitester-talk-to-me.sh, but without a Picroft:
+   the skill (__init__.py) is loaded against a local stand-in of the Mycroft skill
+   base class, the adapt IntentBuilder and the message bus. Every utterance is
+   matched to an intent of the locale folder and its handler is called, the spoken
+   answers are collected from the bus when the handler completed, no delays needed.
+   every utterance file is a suite, suites run in parallel worker processes, each
+   with its own skill and pi_energy on the sample energy-files.
+
+   intent matching of the stand-in, in this order:
+     - padatious: the utterance matches a sample line of a .intent file,
+                  (a|b|" ") alternatives and {entities} included
+     - adapt:     the utterance contains a phrase of each required .voc file and
+                  the required contexts are set
+     - fuzzy:     the .intent file whose words cover most of the utterance words,
+                  at least fuzzy_threshold of them
+   utterance files: lines starting with # are comments, @ starts a section,
+   § <delay> lines are ignored, any other non-empty line is an utterance.
+
+   usage: pireplay-talk-to-me.py [-f <file>[,<file>...]] [-p <path to energy files>]
+                                 [-w <workers>] [-l <lang>] [-s]
+          default: all *.uterances files of this test folder, the sample energy-files,
+                   one worker per cpu, de-de
+          -s prints the summary of the suites only
+   exit code is 1 if a handler raised an exception
+"""
+
+import sys
+import os
+import re
+import glob
+import shutil
+import time
+import types
+import logging
+import tempfile
+import importlib
+import importlib.util
+import multiprocessing
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the skill is loaded as this package, so its relative imports work
+skill_package = "talk_to_me_skill"
+# minimum share of utterance words an intent must know for a fuzzy match
+fuzzy_threshold = 0.75
+
+################################################################################
+# stand-in of the message bus, mycroft and adapt
+
+class message:
+    """ stand-in of mycroft.messagebus.message.Message """
+    def __init__(self, msg_type, data=None, context=None):
+        self.msg_type = msg_type
+        self.data = data or {}
+        self.context = context or {}
+
+class message_bus:
+    """ stand-in of the message bus: emit() calls the handlers registered by on() """
+    def __init__(self):
+        self.handlers = {}
+
+    def on(self, msg_type, handler):
+        self.handlers.setdefault(msg_type, []).append(handler)
+
+    def emit(self, msg):
+        for handler in self.handlers.get(msg.msg_type, []):
+            handler(msg)
+
+class intent_builder:
+    """ stand-in of adapt.intent.IntentBuilder """
+    def __init__(self, name):
+        self.name = name
+        self.requires = []
+
+    def require(self, vocab):
+        self.requires.append(vocab)
+        return self
+
+    def optionally(self, vocab):
+        return self
+
+    def build(self):
+        return self
+
+def intent_handler(intent):
+    """ stand-in of mycroft.intent_handler: mark the method, see mycroft_skill.register_decorated() """
+    def decorator(func):
+        if not hasattr(func, "intents"):
+            func.intents = []
+        func.intents.append(intent)
+        return func
+    return decorator
+
+def context_decorator(context, add):
+    """ stand-in of mycroft.skills.context.adds_context and removes_context """
+    def decorator(func):
+        def wrapper(self, *args, **kwargs):
+            result = func(self, *args, **kwargs)
+            if add:
+                self.contexts.add(context)
+            else:
+                self.contexts.discard(context)
+            return result
+        wrapper.intents = getattr(func, "intents", [])
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+class mycroft_skill:
+    """ stand-in of mycroft.MycroftSkill
+        speak_dialog() renders the first line of the dialog file, or speaks the
+        text itself like Mycroft if there is no such dialog, and emits it as "speak"
+    """
+    def __init__(self, name=None, bus=None):
+        self.name = name or self.__class__.__name__
+        self.bus = bus
+        self.log = logging.getLogger(self.name)
+        self.lang = "de-de"
+        self.root_dir = skill_path
+        self.file_system = types.SimpleNamespace(path=tempfile.mkdtemp(prefix="pireplay-"))
+        self.settings = {}
+        self.contexts = set()
+        self.intent_files = []      # (intent file, handler)
+        self.adapt_intents = []     # (intent_builder, handler)
+        self.events = []            # scheduled events, not run by the stand-in
+
+    def register_decorated(self):
+        for name in dir(self):
+            method = getattr(self, name, None)
+            for intent in getattr(method, "intents", []):
+                if isinstance(intent, str):
+                    self.register_intent_file(intent, method)
+                else:
+                    self.adapt_intents.append((intent, method))
+
+    def register_intent_file(self, intent_file, handler):
+        self.intent_files.append((intent_file, handler))
+
+    def schedule_event(self, handler, when, data=None, name=None):
+        self.events.append((name, handler))
+
+    def schedule_repeating_event(self, handler, when, frequency, data=None, name=None):
+        self.events.append((name, handler))
+
+    def cancel_scheduled_event(self, name):
+        self.events = [e for e in self.events if e[0] != name]
+
+    def add_event(self, name, handler):
+        self.bus.on(name, handler)
+
+    def dialog(self, key, data=None):
+        path = os.path.join(self.root_dir, "locale", self.lang, key + ".dialog")
+        if not os.path.exists(path):
+            # like mycroft, a key that is no dialog is spoken itself
+            return key.replace(".", " ")
+        with open(path) as d_handle:
+            lines = [l.strip() for l in d_handle if l.strip() and not l.startswith("#")]
+        text = lines[0] if lines else key
+        for name, value in (data or {}).items():
+            text = text.replace("{{" + name + "}}", str(value))
+        return text
+
+    def speak_dialog(self, key, data=None, expect_response=False, wait=False):
+        self.bus.emit(message("speak", {"utterance": self.dialog(key, data), "expect_response": expect_response}))
+
+    def speak(self, utterance, expect_response=False, wait=False):
+        self.bus.emit(message("speak", {"utterance": utterance, "expect_response": expect_response}))
+
+def install_stand_ins():
+    """ install the stand-in modules of mycroft and adapt, the skill imports them """
+    modules = {}
+    for name in ["mycroft", "mycroft.skills", "mycroft.skills.context", "adapt", "adapt.intent"]:
+        modules[name] = types.ModuleType(name)
+    modules["mycroft"].MycroftSkill = mycroft_skill
+    modules["mycroft"].intent_handler = intent_handler
+    modules["mycroft"].intent_file_handler = intent_handler
+    modules["mycroft"].skills = modules["mycroft.skills"]
+    modules["mycroft.skills"].context = modules["mycroft.skills.context"]
+    modules["mycroft.skills.context"].adds_context = lambda context: context_decorator(context, True)
+    modules["mycroft.skills.context"].removes_context = lambda context: context_decorator(context, False)
+    modules["adapt"].intent = modules["adapt.intent"]
+    modules["adapt.intent"].IntentBuilder = intent_builder
+    sys.modules.update(modules)
+
+################################################################################
+# intent matching
+
+def normalize(utterance):
+    """ return utterance in lower case, without punctuation and with single blanks """
+    return " ".join(re.sub(r"[^\w\s-]", " ", utterance.lower()).split())
+
+def intent_regex(sample):
+    """ return the compiled regex of a sample line of a .intent file """
+    def literal(text):
+        return " ".join(re.escape(word) for word in normalize(text).split())
+    pattern = ""
+    for token in re.split(r"(\([^)]*\)|\{[^}]*\})", sample):
+        if token.startswith("("):
+            alternatives = [literal(a) for a in token[1:-1].split("|")]
+            pattern += " (?:" + "|".join(a for a in alternatives if a) + ")" \
+                       + ("?" if "" in alternatives else "") + " "
+        elif token.startswith("{"):
+            pattern += " .+? "
+        else:
+            pattern += " " + literal(token) + " "
+    # blanks around an optional alternative may be missing
+    return re.compile(r"\s*".join(pattern.split()))
+
+class intent_matcher:
+    """ match utterances to the intents registered by the skill, see the module description """
+    def __init__(self, skill):
+        self.skill = skill
+        locale = os.path.join(skill.root_dir, "locale", skill.lang)
+        # (intent file, handler, regexes, words) of the padatious intents
+        self.intents = []
+        for intent_file, handler in skill.intent_files:
+            samples = self.read(os.path.join(locale, intent_file))
+            words = set(normalize(re.sub(r"[(|)]|\{[^}]*\}", " ", " ".join(samples))).split())
+            self.intents.append((intent_file, handler, [intent_regex(s) for s in samples], words))
+        # hash of vocabulary to its normalized phrases of the adapt intents
+        self.vocabs = {}
+        for intent, handler in skill.adapt_intents:
+            for vocab in intent.requires:
+                if vocab not in self.vocabs and not vocab.startswith("Context_"):
+                    self.vocabs[vocab] = [normalize(p) for p in self.read(os.path.join(locale, vocab + ".voc"))]
+
+    def read(self, path):
+        try:
+            with open(path) as i_handle:
+                return [l.strip() for l in i_handle if l.strip() and not l.startswith("#")]
+        except OSError:
+            return []
+
+    def match(self, utterance):
+        """ return (kind, intent name, handler) of utterance, None if no intent matches """
+        utt = normalize(utterance)
+        for intent_file, handler, regexes, words in self.intents:
+            for regex in regexes:
+                if regex.fullmatch(utt):
+                    return "padatious", intent_file, handler
+        padded = " " + utt + " "
+        for intent, handler in self.skill.adapt_intents:
+            vocabs = [v for v in intent.requires if not v.startswith("Context_")]
+            contexts = [v for v in intent.requires if v.startswith("Context_")]
+            if not vocabs or not all(c in self.skill.contexts for c in contexts):
+                continue
+            if all(any(" " + p + " " in padded for p in self.vocabs[v]) for v in vocabs):
+                return "adapt", intent.name, handler
+        best = None
+        utt_words = utt.split()
+        for intent_file, handler, regexes, words in self.intents:
+            score = sum(1 for w in utt_words if w in words) / max(len(utt_words), 1)
+            if score >= fuzzy_threshold and (best is None or score > best[0]):
+                best = (score, intent_file, handler)
+        if best is not None:
+            return "fuzzy", best[1], best[2]
+        return None
+
+################################################################################
+# replay
+
+def read_suite(path_to_suite):
+    """ return the sections of the utterance file as list of (section, [utterance, ...]) """
+    sections = []
+    section = ""
+    with open(path_to_suite) as u_handle:
+        for line in u_handle:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("§"):
+                continue
+            if line.startswith("@"):
+                section = line
+                continue
+            if not sections or sections[-1][0] != section:
+                sections.append((section, []))
+            sections[-1][1].append(line)
+    return sections
+
+def load_skill(path_to_energy_files, lang):
+    """ load the skill against the stand-ins and prewarm its pi_energy on path_to_energy_files
+        return: skill, intent_matcher, bus
+    """
+    logging.basicConfig(level=logging.WARNING)
+    install_stand_ins()
+    spec = importlib.util.spec_from_file_location(skill_package, os.path.join(skill_path, "__init__.py"),
+                                                  submodule_search_locations=[skill_path])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[skill_package] = module
+    spec.loader.exec_module(module)
+    bus = message_bus()
+    skill = module.create_skill()
+    skill.bus = bus
+    skill.lang = lang
+    skill.register_decorated()
+    skill.initialize()
+    # the prewarm event of the skill, on the given energy files instead of the collector's folder
+    pi_energy = importlib.import_module(skill_package + ".wita_pi_energy").pi_energy
+    skill.pi_e = pi_energy(path_to_energy_files, watch=True, load_on_query=False,
+                           history=os.path.join(skill.file_system.path, "wita-history.sqlite"),
+                           snapshot="energy-snapshot.wsnap")
+    skill.handle_energy_refresh()
+    return skill, intent_matcher(skill), bus
+
+def replay_suite(args):
+    """ replay the utterance file path_to_suite in a fresh skill
+        return: hash of the suite name, its records and counters
+    """
+    path_to_suite, path_to_energy_files, lang = args
+    t0 = time.perf_counter()
+    skill, matcher, bus = load_skill(path_to_energy_files, lang)
+    load_ms = (time.perf_counter() - t0) * 1000
+    spoken = []
+    completed = []
+    bus.on("speak", lambda msg: spoken.append(msg.data["utterance"]))
+    bus.on("mycroft.skill.handler.complete", lambda msg: completed.append(msg.data))
+
+    def handle_utterance(msg):
+        utterance = msg.data["utterances"][0]
+        match = matcher.match(utterance)
+        if match is None:
+            bus.emit(message("complete_intent_failure", {"utterance": utterance}))
+            bus.emit(message("mycroft.skill.handler.complete", {"intent": None, "kind": "unmatched"}))
+            return
+        kind, intent, handler = match
+        error = None
+        try:
+            handler(message(intent, {"utterance": utterance}))
+        except Exception as e:
+            error = type(e).__name__ + ": " + str(e)
+        bus.emit(message("mycroft.skill.handler.complete", {"intent": intent, "kind": kind, "error": error}))
+    bus.on("recognizer_loop:utterance", handle_utterance)
+
+    records = []
+    counters = {"utterances": 0, "padatious": 0, "adapt": 0, "fuzzy": 0, "unmatched": 0, "errors": 0}
+    for section, utterances in read_suite(path_to_suite):
+        for utterance in utterances:
+            del spoken[:]
+            del completed[:]
+            t0 = time.perf_counter()
+            bus.emit(message("recognizer_loop:utterance", {"utterances": [utterance], "lang": lang}))
+            # the answer is complete when the handler completed, no need to sleep
+            result = completed[-1]
+            counters["utterances"] += 1
+            counters[result["kind"]] += 1
+            if result.get("error"):
+                counters["errors"] += 1
+            records.append({"section": section, "utterance": utterance, "kind": result["kind"],
+                            "intent": result["intent"], "error": result.get("error"),
+                            "spoken": list(spoken), "ms": (time.perf_counter() - t0) * 1000})
+    skill.shutdown()
+    shutil.rmtree(skill.file_system.path, ignore_errors=True)
+    return {"suite": os.path.basename(path_to_suite), "load_ms": load_ms, "records": records,
+            "counters": counters}
+
+def print_suite(result):
+    print("going to test uterances of file " + result["suite"])
+    section = None
+    cnt = 1
+    for r in result["records"]:
+        if r["section"] != section:
+            section = r["section"]
+            print(section)
+        print(section + " " + str(cnt) + " uterance: " + r["utterance"])
+        print(section + " " + str(cnt) + " reply: (" + r["kind"] + " " + str(r["intent"]) + ", "
+              + str(round(r["ms"], 2)) + " ms)")
+        for s in r["spoken"]:
+            print(s)
+        if r["error"]:
+            print("handler failed: " + r["error"])
+        print("================")
+        cnt += 1
+
+################################################################################
+
+if __name__ == "__main__":
+
+    suites = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.uterances")))
+    path_to_energy_files = os.path.join(skill_path, "energy-files")
+    workers = os.cpu_count() or 1
+    lang = "de-de"
+    summary_only = False
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print(__doc__)
+            sys.exit(1)
+        if sys.argv[i] == "-f" or sys.argv[i] == "--file":
+            suites = [os.path.abspath(f) for f in sys.argv[i+1].split(",")]
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_energy_files = os.path.abspath(sys.argv[i+1])
+        if sys.argv[i] == "-w" or sys.argv[i] == "--workers":
+            workers = int(sys.argv[i+1])
+        if sys.argv[i] == "-l" or sys.argv[i] == "--lang":
+            lang = sys.argv[i+1]
+        if sys.argv[i] == "-s" or sys.argv[i] == "--summary":
+            summary_only = True
+
+    t0 = time.perf_counter()
+    jobs = [(suite, path_to_energy_files, lang) for suite in suites]
+    if workers > 1 and len(jobs) > 1:
+        with multiprocessing.Pool(min(workers, len(jobs))) as pool:
+            results = pool.map(replay_suite, jobs)
+    else:
+        results = [replay_suite(job) for job in jobs]
+    elapsed = time.perf_counter() - t0
+
+    if not summary_only:
+        for result in results:
+            print_suite(result)
+            print()
+    totals = {}
+    print("%-40s %6s %9s %6s %6s %9s %6s %9s" % ("suite", "utts", "padatious", "adapt", "fuzzy", "unmatched",
+                                                 "errors", "load ms"))
+    for result in results:
+        c = result["counters"]
+        for key, value in c.items():
+            totals[key] = totals.get(key, 0) + value
+        print("%-40s %6d %9d %6d %6d %9d %6d %9.1f" % (result["suite"], c["utterances"], c["padatious"],
+              c["adapt"], c["fuzzy"], c["unmatched"], c["errors"], result["load_ms"]))
+    print("%-40s %6d %9d %6d %6d %9d %6d" % ("total", totals.get("utterances", 0), totals.get("padatious", 0),
+          totals.get("adapt", 0), totals.get("fuzzy", 0), totals.get("unmatched", 0), totals.get("errors", 0)))
+    print("\n" + str(len(results)) + " suites replayed in " + str(round(elapsed, 2)) + " s by "
+          + str(min(workers, max(len(jobs), 1))) + " workers")
+    sys.exit(1 if totals.get("errors", 0) else 0)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""scraper stand-in for the metrics of the talk-to-me skill, see wita_pi_metrics.py
+   scrapes the metrics like Prometheus would, checks the text format and prints them:
+     - every sample follows the # HELP and # TYPE lines of its family
+     - counters and ages are not negative
+     - histogram buckets are cumulative and the +Inf bucket equals the _count
+   without -u or -t the metrics endpoint is started in this process on the sample
+   energy-files, the queries of AUTOTEST are asked and observed, then it is scraped.
+
+   usage: piscrape-talk-to-me.py [-u <url> | -t <textfile>] [-p <path to energy files>]
+   exit code is 1 if the metrics are not valid
+"""
+
+import sys
+import os
+import re
+import time
+import urllib.request
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, skill_path)
+
+sample_re = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(.*)\})? (\S+)$')
+label_re = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+################################################################################
+
+def parse(text):
+    """ parse the Prometheus text format
+        return: families: hash of name -> [type, help, [(sample name, labels, value), ...]]
+                errors: list of error messages
+    """
+    families = {}
+    errors = []
+    family = None
+    for n, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        if line.startswith("# HELP "):
+            name, help_text = (line[7:].split(" ", 1) + [""])[:2]
+            families[name] = [None, help_text, []]
+            family = name
+            continue
+        if line.startswith("# TYPE "):
+            name, mtype = line[7:].split(" ", 1)
+            if name != family:
+                errors.append("line " + str(n) + ": # TYPE of " + name + " without # HELP")
+                families[name] = [None, "", []]
+                family = name
+            families[name][0] = mtype
+            continue
+        if line.startswith("#"):
+            continue
+        m = sample_re.match(line)
+        if m is None:
+            errors.append("line " + str(n) + ": invalid sample: " + line)
+            continue
+        name, labels_text, value = m.group(1), m.group(3) or "", m.group(4)
+        if family is None or not (name == family or name in [family + s for s in ("_bucket", "_sum", "_count")]):
+            errors.append("line " + str(n) + ": sample " + name + " outside its family")
+            continue
+        try:
+            value = float(value)
+        except ValueError:
+            errors.append("line " + str(n) + ": invalid value: " + line)
+            continue
+        labels = dict(label_re.findall(labels_text))
+        families[family][2].append((name, labels, value))
+    return families, errors
+
+################################################################################
+
+def check(families):
+    """ return list of errors of the metric families, see the module description """
+    errors = []
+    for name, (mtype, help_text, samples) in families.items():
+        if mtype not in ("counter", "gauge", "histogram", "summary", "untyped"):
+            errors.append(name + ": invalid type " + str(mtype))
+        if mtype == "counter" or name.endswith("_age_seconds"):
+            for sample, labels, value in samples:
+                if value < 0:
+                    errors.append(name + str(labels) + ": negative value " + str(value))
+        if mtype == "histogram":
+            series = {}
+            for sample, labels, value in samples:
+                key = tuple(sorted((l, v) for l, v in labels.items() if l != "le"))
+                series.setdefault(key, {"buckets": [], "count": None})
+                if sample == name + "_bucket":
+                    series[key]["buckets"].append((float(labels["le"]), value))
+                elif sample == name + "_count":
+                    series[key]["count"] = value
+            for key, s in series.items():
+                counts = [v for le, v in s["buckets"]]
+                if counts != sorted(counts):
+                    errors.append(name + str(dict(key)) + ": buckets are not cumulative")
+                if not s["buckets"] or s["buckets"][-1][0] != float("inf") or s["buckets"][-1][1] != s["count"]:
+                    errors.append(name + str(dict(key)) + ": +Inf bucket does not equal _count")
+    return errors
+
+################################################################################
+
+if __name__ == "__main__":
+
+    url = None
+    textfile = None
+    path_to_energy_files = os.path.join(skill_path, "energy-files")
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print(__doc__)
+            sys.exit(1)
+        if sys.argv[i] == "-u" or sys.argv[i] == "--url":
+            url = sys.argv[i+1]
+        if sys.argv[i] == "-t" or sys.argv[i] == "--textfile":
+            textfile = sys.argv[i+1]
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_energy_files = sys.argv[i+1]
+
+    metrics = None
+    if url is None and textfile is None:
+        from wita_pi_energy import pi_energy
+        from wita_pi_metrics import pi_energy_metrics
+        pi_e = pi_energy(path_to_energy_files, watch=True, load_on_query=False)
+        pi_e.refresh()
+        metrics = pi_energy_metrics(pi_e)
+        rc, rc_msg = metrics.serve(0)
+        if rc != 0:
+            print(rc_msg)
+            sys.exit(1)
+        url = "http://127.0.0.1:" + str(metrics.server.server_address[1]) + "/metrics"
+        for item in ["outdoor", "vehicle Soc", "summary", "energy_autonomy_today", "pv_production_week", "no_such_item"]:
+            t0 = time.perf_counter()
+            rc, rc_msg, rc_TTS = pi_e.query(item)
+            metrics.observe(item, rc, time.perf_counter() - t0)
+
+    if textfile is not None:
+        with open(textfile) as t_handle:
+            text = t_handle.read()
+    else:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            text = response.read().decode("utf-8")
+    if metrics is not None:
+        metrics.stop()
+        metrics.pi_e.close()
+
+    families, errors = parse(text)
+    errors += check(families)
+    for name, (mtype, help_text, samples) in sorted(families.items()):
+        for sample, labels, value in samples:
+            if sample.endswith("_bucket"):
+                continue
+            label_text = ",".join([l + "=" + v for l, v in sorted(labels.items())])
+            print("%-50s %-40s %s" % (sample, label_text, repr(value)))
+    print("\n" + str(len(families)) + " metric families scraped from " + (textfile or url))
+    for e in errors:
+        print("ERROR " + e)
+    sys.exit(1 if errors else 0)
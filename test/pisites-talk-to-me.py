@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""multi-site check of pi_energy_sites, see wita_pi_sites.py
+   registers -n copies of the sample energy-files by a registry json file and checks that
+     - load_registry() registers all sites, folders relative to the registry file
+     - a site that is not registered is answered with rc 5
+     - the LRU keeps at most max_sites sites, the least recently queried is evicted
+     - max_bytes bounds the memory estimate of the loaded sites
+     - a site evicted while it is checked out stays usable and is closed by release()
+     - all sites share one executor, the number of threads does not grow with the sites
+     - queries of many threads on few cached sites answer like a single pi_energy
+
+   usage: pisites-talk-to-me.py [-n <sites>] [-p <path to energy files>] [-k]
+          -k keeps the registry and the copies of the energy-files
+   exit code is 1 if a check failed
+"""
+
+import sys
+import os
+import json
+import random
+import shutil
+import tempfile
+import threading
+
+# the skill folder is the parent folder of this test folder
+skill_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, skill_path)
+
+from wita_pi_energy import pi_energy
+from wita_pi_sites import pi_energy_sites
+
+failed = 0
+
+def check(ok, text):
+    global failed
+    print(("ok    " if ok else "FAIL  ") + text)
+    if not ok:
+        failed += 1
+
+################################################################################
+
+if __name__ == "__main__":
+
+    path_to_sample = os.path.join(skill_path, "energy-files")
+    n_sites = 20
+    keep = False
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print(__doc__)
+            sys.exit(1)
+        if sys.argv[i] == "-n" or sys.argv[i] == "--sites":
+            n_sites = int(sys.argv[i+1])
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_sample = sys.argv[i+1]
+        if sys.argv[i] == "-k" or sys.argv[i] == "--keep":
+            keep = True
+
+    tmp = tempfile.mkdtemp(prefix="pisites-")
+    registry = {}
+    for n in range(n_sites):
+        site = "site-%03d" % n
+        shutil.copytree(path_to_sample, os.path.join(tmp, site))
+        registry[site] = site
+    path_to_registry = os.path.join(tmp, "registry.json")
+    with open(path_to_registry, "w") as r_handle:
+        json.dump(registry, r_handle)
+    sites = sorted(registry)
+    queries = ["outdoor", "vehicle Soc", "summary", "energy_autonomy_today"]
+    expected = {}
+    pi_e = pi_energy(path_to_sample)
+    for item in queries:
+        expected[item] = pi_e.query(item)[2]
+    pi_e.close()
+
+    # registry
+    pi_sites = pi_energy_sites(max_sites=3)
+    rc, rc_msg = pi_sites.load_registry(path_to_registry)
+    check(rc == 0 and pi_sites.get_stats()["registered"] == n_sites, "load_registry():" + rc_msg)
+    check(pi_sites.registry[sites[0]] == os.path.join(tmp, sites[0]), "folders are relative to the registry file")
+    rc, rc_msg, rc_TTS = pi_sites.query("no-such-site", "outdoor")
+    check(rc == 5, "site not registered: rc=" + str(rc) + rc_msg)
+
+    # LRU by max_sites
+    for site in sites[:5]:
+        rc, rc_msg, rc_TTS = pi_sites.query(site, "outdoor")
+        check(rc == 0 and rc_TTS == expected["outdoor"], site + ": " + str(rc_TTS))
+    stats = pi_sites.get_stats()
+    check(stats["loaded"] == 3 and stats["evictions"] == 2, "max_sites 3: " + str(stats))
+    check(list(pi_sites.sites) == sites[2:5], "the least recently queried sites are evicted: " + str(list(pi_sites.sites)))
+    pi_sites.query(sites[2], "outdoor")
+    pi_sites.query(sites[5], "outdoor")
+    check(list(pi_sites.sites) == [sites[4], sites[2], sites[5]], "a query moves its site to the end: " + str(list(pi_sites.sites)))
+
+    # memory bound: the estimate counts the parsed json files and the caches, not only the json bytes
+    pi_e = pi_sites.sites[sites[5]][0]
+    estimate = pi_e.memory_estimate()
+    check(estimate > pi_e.loaded_bytes() * 2, "memory estimate " + str(estimate) + " bytes of "
+          + str(pi_e.loaded_bytes()) + " bytes of json files")
+    pi_sites.query(sites[5], "summary")
+    check(pi_sites.sites[sites[5]][1] > pi_sites.site_bytes + estimate, "the estimate grows with the caches: "
+          + str(pi_sites.sites[sites[5]][1]))
+    pi_sites.close()
+    site_size = pi_sites.site_bytes + estimate
+    pi_sites = pi_energy_sites(max_sites=1000, max_bytes=int(site_size * 2.5))
+    pi_sites.load_registry(path_to_registry)
+    for site in sites[:8]:
+        pi_sites.query(site, "outdoor")
+    stats = pi_sites.get_stats()
+    check(stats["loaded"] == 2 and stats["loaded_bytes"] <= pi_sites.max_bytes,
+          "max_bytes " + str(pi_sites.max_bytes) + ": " + str(stats))
+
+    # eviction of a site that is checked out
+    pi_e = pi_sites.get_site(sites[0])
+    pi_sites.remove_site(sites[0])
+    check(pi_e in pi_sites.retired and pi_e.json_workers > 1, "a checked out site is not closed by its eviction")
+    rc, rc_msg, rc_TTS = pi_e.query("vehicle Soc")
+    check(rc == 0 and rc_TTS == expected["vehicle Soc"], "the evicted site still answers: " + str(rc_TTS))
+    pi_sites.release(pi_e)
+    check(pi_e not in pi_sites.retired and pi_e.json_workers == 1, "release() closes the evicted site")
+    rc, rc_msg, rc_TTS = pi_e.query("outdoor")
+    check(rc == 0 and rc_TTS == expected["outdoor"], "a closed site can still be queried: " + str(rc_TTS))
+    rc, rc_msg, rc_TTS = pi_sites.query(sites[0], "outdoor")
+    check(rc == 5, "a removed site is not registered any more: rc=" + str(rc))
+    pi_sites.close()
+
+    # threads: many threads query few cached sites
+    threads_before = threading.active_count()
+    pi_sites = pi_energy_sites(max_sites=max(2, n_sites // 4))
+    pi_sites.load_registry(path_to_registry)
+    answers = []
+    def ask():
+        for k in range(100):
+            item = random.choice(queries)
+            rc, rc_msg, rc_TTS = pi_sites.query(random.choice(sites), item)
+            answers.append(rc == 0 and rc_TTS == expected[item])
+    threads = [threading.Thread(target=ask) for k in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    stats = pi_sites.get_stats()
+    check(all(answers), str(len(answers)) + " queries of 8 threads, " + str(answers.count(False)) + " wrong answers")
+    check(stats["checked_out"] == 0 and not pi_sites.retired, "all sites released: " + str(stats))
+    check(threading.active_count() - threads_before <= pi_sites.json_workers,
+          str(threading.active_count() - threads_before) + " threads left for " + str(stats["loaded"]) + " sites")
+    pi_sites.close()
+
+    if keep:
+        print("registry kept in " + path_to_registry)
+    else:
+        shutil.rmtree(tmp, ignore_errors=True)
+    sys.exit(1 if failed else 0)
@@ -7,18 +7,45 @@ import datetime
 
 class pi_datetime:
     """ provides methods around date and time
-        e.g. diff between two dates
-        more methods to come...
+        e.g. diff between two dates, calendar and lease periods
+        parsed dates are cached, periods are cached until the next midnight
 
     """
     def __init__(self):
         self.iso_format = "%Y-%m-%d %H:%M:%S"
+        # hash of date string to its datetime, see parse()
+        self.parsed = {}
+        # hash of (period name, start) to (rc, rc_msg, rc_start, rc_end), see period()
+        # the periods change at midnight, so the hash is valid until self.periods_until
+        self.periods = {}
+        self.periods_until = None
+
+    ############################################################################
+
+    def now(self):
+        """ return the current datetime to the second, like dates formatted in self.iso_format """
+        return datetime.datetime.now().replace(microsecond=0)
+
+    ############################################################################
+
+    def parse(self, date):
+        """ return date as datetime
+            date is a datetime, "now" for the current date, or a string formatted in self.iso_format
+            parsed strings are cached
+        """
+        if isinstance(date, datetime.datetime):
+            return date
+        if date == 'now':
+            return self.now()
+        if date not in self.parsed:
+            self.parsed[date] = datetime.datetime.strptime(date, self.iso_format)
+        return self.parsed[date]
 
     ############################################################################
 
     def diff(self, date_from, date_to):
         """ calculates difference between the two dates
-            dates need to be formatted as string in self.iso_format
+            dates need to be formatted as string in self.iso_format, or datetime
             when a date is "now", the current date will be used.
             The difference is returned in terms of days.
             rc = 0 no errors, else some error occured
@@ -27,23 +54,103 @@ class pi_datetime:
         """
         rc = 0
         rc_msg = "success"
-        rc_diff = 0
-        if date_from == 'now':
-            dt_dt_from = datetime.datetime.now()
-            dt_str_from = dt_dt_from.strftime(self.iso_format)
-        else:
-            dt_str_from = date_from
-
-        if date_to == 'now':
-            dt_dt_to = datetime.datetime.now()
-            dt_str_to = dt_dt_to.strftime(self.iso_format)
-        else:
-            dt_str_to = date_to
-
-        dt_from = datetime.datetime.strptime(dt_str_from, self.iso_format)
-        dt_to   = datetime.datetime.strptime(dt_str_to,   self.iso_format)
-        rc_diff = ((dt_from - dt_to).days)
+        rc_diff = (self.parse(date_from) - self.parse(date_to)).days
         return rc, rc_msg, rc_diff
 
+    ############################################################################
+
+    def next_diff_change(self, date_to, now='now'):
+        """ calculates when diff(now, date_to) returns the next number of days
+            date_to and now need to be formatted as string in self.iso_format, or datetime
+            return: datetime of the next change
+        """
+        dt_to = self.parse(date_to)
+        days = (self.parse(now) - dt_to).days
+        return dt_to + datetime.timedelta(days=days + 1)
+
+    ############################################################################
+
+    def add_years(self, day, years):
+        """ return the datetime day years later, the 29th of february becomes the 28th """
+        try:
+            return day.replace(year=day.year + years)
+        except ValueError:
+            return day.replace(year=day.year + years, day=28)
+
+    ############################################################################
+
+    def period(self, name, start=None):
+        """ calculates the start and end of the period name as of now
+            name: calendar periods
+                    "today", "yesterday",
+                    "week", "last_week" (from monday),
+                    "month", "last_month", "year", "last_year"
+                  lease periods, start is the lease start date (see parse())
+                    "lease" since the day the lease started, until the end of today
+                    "lease_year" the current year of the lease, from the last anniversary
+                    "last_lease_year" the lease year before
+            periods start and end at midnight, they are cached until the next midnight
+            rc = 0 no errors, else unknown period or lease period without start
+            rc_msg = return message
+            rc_start, rc_end = start (included) and end (excluded) of the period as datetime
+        """
+        if self.periods_until is None or datetime.datetime.now() >= self.periods_until:
+            self.periods = {}
+            self.periods_until = self.next_midnight()
+        key = (name, start)
+        if key in self.periods:
+            return self.periods[key]
+        rc = 0
+        rc_msg = "success"
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        rc_start = today
+        rc_end = today + datetime.timedelta(days=1)
+        if name == "yesterday":
+            rc_start = today - datetime.timedelta(days=1)
+            rc_end = today
+        elif name == "week" or name == "last_week":
+            rc_start = today - datetime.timedelta(days=today.weekday())
+            if name == "last_week":
+                rc_start = rc_start - datetime.timedelta(days=7)
+            rc_end = rc_start + datetime.timedelta(days=7)
+        elif name == "month":
+            rc_start = today.replace(day=1)
+            rc_end = (rc_start + datetime.timedelta(days=32)).replace(day=1)
+        elif name == "last_month":
+            rc_end = today.replace(day=1)
+            rc_start = (rc_end - datetime.timedelta(days=1)).replace(day=1)
+        elif name == "year" or name == "last_year":
+            rc_start = today.replace(month=1, day=1)
+            if name == "last_year":
+                rc_start = rc_start.replace(year=rc_start.year - 1)
+            rc_end = rc_start.replace(year=rc_start.year + 1)
+        elif name == "lease" or name == "lease_year" or name == "last_lease_year":
+            if start is None:
+                rc = 2
+                rc_msg = "period " + name + " requires the lease start"
+            else:
+                lease_start = datetime.datetime.combine(self.parse(start).date(), datetime.time())
+                if name == "lease":
+                    rc_start = lease_start
+                else:
+                    years = today.year - lease_start.year
+                    if self.add_years(lease_start, years) > today:
+                        years -= 1
+                    if name == "last_lease_year":
+                        years -= 1
+                    rc_start = self.add_years(lease_start, years)
+                    rc_end = self.add_years(lease_start, years + 1)
+        elif name != "today":
+            rc = 1
+            rc_msg = "unknown period " + name
+        self.periods[key] = (rc, rc_msg, rc_start, rc_end)
+        return self.periods[key]
+
+    ############################################################################
+
+    def next_midnight(self):
+        """ return the datetime of the next midnight, when calendar periods change """
+        return datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+
 # class pi_datetime
 ############################################################################
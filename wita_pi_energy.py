@@ -37,9 +37,11 @@ from os.path import exists
 from os.path import abspath
 import datetime
 import time
-import json
-import pwd
-from pprint import pprint
+import gc
+import functools
+import threading
+# json and pwd are imported on first use, importing this module should be cheap,
+# see test/pi-import-budget.py
 #relative import does not work when we use this module as a __main__,
 #  what we in fact do for testing
 #  as a workaround we use importlib, see below rather than
@@ -52,18 +54,45 @@ from pprint import pprint
 
 class pi_datetime:
     """ provides methods around date and time
-        e.g. diff between two dates
-        more methods to come...
+        e.g. diff between two dates, calendar and lease periods
+        parsed dates are cached, periods are cached until the next midnight
 
     """
     def __init__(self):
         self.iso_format = "%Y-%m-%d %H:%M:%S"
+        # hash of date string to its datetime, see parse()
+        self.parsed = {}
+        # hash of (period name, start) to (rc, rc_msg, rc_start, rc_end), see period()
+        # the periods change at midnight, so the hash is valid until self.periods_until
+        self.periods = {}
+        self.periods_until = None
+
+    ############################################################################
+
+    def now(self):
+        """ return the current datetime to the second, like dates formatted in self.iso_format """
+        return datetime.datetime.now().replace(microsecond=0)
+
+    ############################################################################
+
+    def parse(self, date):
+        """ return date as datetime
+            date is a datetime, "now" for the current date, or a string formatted in self.iso_format
+            parsed strings are cached
+        """
+        if isinstance(date, datetime.datetime):
+            return date
+        if date == 'now':
+            return self.now()
+        if date not in self.parsed:
+            self.parsed[date] = datetime.datetime.strptime(date, self.iso_format)
+        return self.parsed[date]
 
     ############################################################################
 
     def diff(self, date_from, date_to):
         """ calculates difference between the two dates
-            dates need to be formatted as string in self.iso_format
+            dates need to be formatted as string in self.iso_format, or datetime
             when a date is "now", the current date will be used.
             The difference is returned in terms of days.
             rc = 0 no errors, else some error occured
@@ -72,57 +101,549 @@ class pi_datetime:
         """
         rc = 0
         rc_msg = "success"
-        rc_diff = 0
-        if date_from == 'now':
-            dt_dt_from = datetime.datetime.now()
-            dt_str_from = dt_dt_from.strftime(self.iso_format)
-        else:
-            dt_str_from = date_from
+        rc_diff = (self.parse(date_from) - self.parse(date_to)).days
+        return rc, rc_msg, rc_diff
 
-        if date_to == 'now':
-            dt_dt_to = datetime.datetime.now()
-            dt_str_to = dt_dt_to.strftime(self.iso_format)
-        else:
-            dt_str_to = date_to
+    ############################################################################
 
-        dt_from = datetime.datetime.strptime(dt_str_from, self.iso_format)
-        dt_to   = datetime.datetime.strptime(dt_str_to,   self.iso_format)
-        rc_diff = ((dt_from - dt_to).days)
-        return rc, rc_msg, rc_diff
+    def next_diff_change(self, date_to, now='now'):
+        """ calculates when diff(now, date_to) returns the next number of days
+            date_to and now need to be formatted as string in self.iso_format, or datetime
+            return: datetime of the next change
+        """
+        dt_to = self.parse(date_to)
+        days = (self.parse(now) - dt_to).days
+        return dt_to + datetime.timedelta(days=days + 1)
+
+    ############################################################################
+
+    def add_years(self, day, years):
+        """ return the datetime day years later, the 29th of february becomes the 28th """
+        try:
+            return day.replace(year=day.year + years)
+        except ValueError:
+            return day.replace(year=day.year + years, day=28)
+
+    ############################################################################
+
+    def period(self, name, start=None):
+        """ calculates the start and end of the period name as of now
+            name: calendar periods
+                    "today", "yesterday",
+                    "week", "last_week" (from monday),
+                    "month", "last_month", "year", "last_year"
+                  lease periods, start is the lease start date (see parse())
+                    "lease" since the day the lease started, until the end of today
+                    "lease_year" the current year of the lease, from the last anniversary
+                    "last_lease_year" the lease year before
+            periods start and end at midnight, they are cached until the next midnight
+            rc = 0 no errors, else unknown period or lease period without start
+            rc_msg = return message
+            rc_start, rc_end = start (included) and end (excluded) of the period as datetime
+        """
+        if self.periods_until is None or datetime.datetime.now() >= self.periods_until:
+            self.periods = {}
+            self.periods_until = self.next_midnight()
+        key = (name, start)
+        if key in self.periods:
+            return self.periods[key]
+        rc = 0
+        rc_msg = "success"
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        rc_start = today
+        rc_end = today + datetime.timedelta(days=1)
+        if name == "yesterday":
+            rc_start = today - datetime.timedelta(days=1)
+            rc_end = today
+        elif name == "week" or name == "last_week":
+            rc_start = today - datetime.timedelta(days=today.weekday())
+            if name == "last_week":
+                rc_start = rc_start - datetime.timedelta(days=7)
+            rc_end = rc_start + datetime.timedelta(days=7)
+        elif name == "month":
+            rc_start = today.replace(day=1)
+            rc_end = (rc_start + datetime.timedelta(days=32)).replace(day=1)
+        elif name == "last_month":
+            rc_end = today.replace(day=1)
+            rc_start = (rc_end - datetime.timedelta(days=1)).replace(day=1)
+        elif name == "year" or name == "last_year":
+            rc_start = today.replace(month=1, day=1)
+            if name == "last_year":
+                rc_start = rc_start.replace(year=rc_start.year - 1)
+            rc_end = rc_start.replace(year=rc_start.year + 1)
+        elif name == "lease" or name == "lease_year" or name == "last_lease_year":
+            if start is None:
+                rc = 2
+                rc_msg = "period " + name + " requires the lease start"
+            else:
+                lease_start = datetime.datetime.combine(self.parse(start).date(), datetime.time())
+                if name == "lease":
+                    rc_start = lease_start
+                else:
+                    years = today.year - lease_start.year
+                    if self.add_years(lease_start, years) > today:
+                        years -= 1
+                    if name == "last_lease_year":
+                        years -= 1
+                    rc_start = self.add_years(lease_start, years)
+                    rc_end = self.add_years(lease_start, years + 1)
+        elif name != "today":
+            rc = 1
+            rc_msg = "unknown period " + name
+        self.periods[key] = (rc, rc_msg, rc_start, rc_end)
+        return self.periods[key]
+
+    ############################################################################
+
+    def next_midnight(self):
+        """ return the datetime of the next midnight, when calendar periods change """
+        return datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
 
 # class pi_datetime
 ############################################################################
 
+class pi_energy_watcher:
+    """ watches the energy-files folder for changes of json files
+        on Linux inotify is used to mark individual json files dirty as soon as
+        the collector has written them. Any other platform, or if the folder
+        cannot be watched, leaves self.active False and the caller falls back
+        to polling the file modification times.
+    """
+    # inotify event masks, see inotify(7)
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CLOSE_WRITE = 0x00000008
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF   = 0x00000800
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+
+    def __init__(self, path_to_energy_files, json_filenames):
+        """ json_filenames: hash of json filename to json_files index
+        """
+        self.path_to_energy_files = path_to_energy_files
+        self.json_filenames = json_filenames
+        self.active = False
+        self.fd = -1
+        self.wake_fds = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.dirty = set()
+
+    ############################################################################
+    def start(self):
+        """ start watching the energy-files folder.
+            all json files are marked dirty, so they are loaded on the next query.
+            return: rc = 0 watching, else inotify is not available and polling must be used
+                    rc_msg return message
+        """
+        fct = " pi_energy_watcher.start() "
+        if not sys.platform.startswith("linux"):
+            return 1, fct + " inotify is not available on " + sys.platform + "!"
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd < 0:
+                return 2, fct + " inotify_init1 failed by errno=" + str(ctypes.get_errno()) + "!"
+            mask = (self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_MOVED_FROM | self.IN_DELETE |
+                    self.IN_DELETE_SELF | self.IN_MOVE_SELF)
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.path_to_energy_files), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                return 3, fct + " cannot watch " + self.path_to_energy_files + " errno=" + str(errno) + "!"
+        except (OSError, AttributeError) as e:
+            return 4, fct + " inotify is not available: " + str(e) + "!"
+        self.fd = fd
+        self.wake_fds = os.pipe()
+        with self.lock:
+            self.dirty = set(self.json_filenames.values())
+        self.active = True
+        self.thread = threading.Thread(target=self.run, name="pi_energy_watcher", daemon=True)
+        self.thread.start()
+        return 0, fct + " success!"
+
+    ############################################################################
+    def stop(self):
+        """ stop watching, the caller falls back to polling """
+        self.active = False
+        if self.thread is not None:
+            os.write(self.wake_fds[1], b"x")
+            self.thread.join()
+            self.thread = None
+        for fd in [self.fd] + list(self.wake_fds or []):
+            if fd >= 0:
+                os.close(fd)
+        self.fd = -1
+        self.wake_fds = None
+
+    ############################################################################
+    def take_dirty(self, indexes):
+        """ return those of the json_files indexes that changed since they were taken last
+            and reset them, other dirty indexes are kept. This does not touch the file system.
+        """
+        if not self.dirty:
+            return ()
+        with self.lock:
+            dirty = self.dirty.intersection(indexes)
+            self.dirty -= dirty
+        return dirty
+
+    ############################################################################
+    def mark_dirty(self, indexes):
+        """ mark json_files indexes dirty again, e.g. if they could not be loaded after they were taken,
+            so they are checked again on the next load
+        """
+        with self.lock:
+            self.dirty.update(indexes)
+
+    ############################################################################
+    def run(self):
+        """ watcher thread: read inotify events and mark json files dirty """
+        import select
+        import struct
+        event_size = struct.calcsize("iIII")
+        while self.active:
+            readable, w, x = select.select([self.fd, self.wake_fds[0]], [], [])
+            if self.wake_fds[0] in readable:
+                break
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            changed = set()
+            pos = 0
+            while pos + event_size <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from("iIII", buf, pos)
+                name = buf[pos + event_size:pos + event_size + length].rstrip(b"\0")
+                pos += event_size + length
+                if mask & (self.IN_Q_OVERFLOW):
+                    # events were lost, everything may have changed
+                    changed.update(self.json_filenames.values())
+                elif mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                    # energy-files folder is gone, fall back to polling
+                    self.active = False
+                else:
+                    filename = os.fsdecode(name)
+                    if filename in self.json_filenames:
+                        changed.add(self.json_filenames[filename])
+            if changed:
+                with self.lock:
+                    self.dirty |= changed
+
+# class pi_energy_watcher
+############################################################################
+
+# the garbage collector is paused while json files are decoded, see pi_gc_pause().
+# its state is global to the process, so the decoding threads count the pauses
+# and the last one resumes it, if it was enabled when the first one paused it.
+pi_gc_pauses = [0, False]   # number of pauses, gc was enabled by the first pause
+pi_gc_lock = threading.Lock()
+
+def pi_gc_pause():
+    with pi_gc_lock:
+        if pi_gc_pauses[0] == 0:
+            pi_gc_pauses[1] = gc.isenabled()
+            gc.disable()
+        pi_gc_pauses[0] += 1
+
+def pi_gc_resume():
+    with pi_gc_lock:
+        pi_gc_pauses[0] -= 1
+        if pi_gc_pauses[0] == 0 and pi_gc_pauses[1]:
+            gc.enable()
+
+############################################################################
+
+def pi_json_decoder(name=None):
+    """ select the decoder of json files
+        name: "json" for the python json module, "orjson" or "ujson" for these packages,
+              None for orjson if it is installed, else the json module
+        return: rc = 0 ok, else the decoder is not installed and the json module is used
+                rc_msg return message
+                decoder: [name, loads function, True if loads accepts a buffer (memoryview)]
+    """
+    fct = " pi_json_decoder() "
+    import json
+    if name is None or name == "orjson":
+        try:
+            import orjson
+            return 0, fct + " success!", ["orjson", orjson.loads, True]
+        except ImportError:
+            if name is not None:
+                return 1, fct + " orjson is not installed, using json!", ["json", json.loads, False]
+    if name == "ujson":
+        try:
+            import ujson
+            return 0, fct + " success!", ["ujson", ujson.loads, False]
+        except ImportError:
+            return 1, fct + " ujson is not installed, using json!", ["json", json.loads, False]
+    if name is not None and name != "json":
+        return 2, fct + " unknown decoder " + name + ", using json!", ["json", json.loads, False]
+    return 0, fct + " success!", ["json", json.loads, False]
+
+############################################################################
+
+# JSON-File-Type -> json filename, see pi_energy.json_files
+pi_json_file_names = {
+    "HPH": "hpm-out-header.json",
+    "HPS": "hpm-out-shortterm.json",
+    "HPP": "hpm-out-longterm.json",
+    "PVM": "pv_meter.json",
+    "PVT": "pvm-out-meter-total.json",
+    "CH":  "charger.json",
+    "V":   "vehicle.json",
+    }
+
+def pi_merge_records(jtype, jdict, records, replace=False):
+    """ merge the records pushed by a collector into the json dict jdict of the JSON-File-Type jtype
+        jtype HPH, HPS, HPP: records is a dict item -> [unit, value, description]
+        jtype PVM, PVT, CH, V: records is a list or a dict of records [key1, key2, unit, value, ...],
+              a record replaces the one of the same (key1, key2), else it is appended
+        replace: if True, the records are the complete json dict, jdict is dropped
+        jdict is not changed, it may still be read by queries
+        return: rc = 0 ok, else error
+                rc_msg return message
+                jdict merged, a new dict
+    """
+    fct = " pi_merge_records() "
+    if jtype == "HPH" or jtype == "HPS" or jtype == "HPP":
+        if not isinstance(records, dict) or \
+           not all(isinstance(r, list) and len(r) >= 3 for r in records.values()):
+            return 2, fct + " records of " + jtype + " must be a dict of item -> [unit, value, description]!", jdict
+        merged = {} if replace else dict(jdict.items())
+        merged.update(records)
+        return 0, fct + " success!", merged
+    if isinstance(records, dict):
+        records = list(records.values())
+    if not isinstance(records, list) or \
+       not all(isinstance(r, list) and len(r) >= 4 and isinstance(r[0], str) and isinstance(r[1], str)
+               for r in records):
+        return 2, fct + " records of " + jtype + " must be a list of [key1, key2, unit, value, ...]!", jdict
+    merged = {}
+    positions = {}
+    if not replace:
+        for key, record in jdict.items():
+            merged[key] = record
+            positions[(record[0], record[1])] = key
+    n = max([int(key) for key in merged if key.isdigit()] + [0])
+    for record in records:
+        key = positions.get((record[0], record[1]))
+        if key is None:
+            n += 1
+            key = str(n)
+            positions[(record[0], record[1])] = key
+        merged[key] = record
+    return 0, fct + " success!", merged
+
+def pi_write_records(path_to_energy_files, jtype, records, replace=False):
+    """ file mode of pi_energy.ingest(): merge the records into the json file of jtype and write it
+        atomically, e.g. when no server accepts pushes, see wita_pi_server.pi_energy_push()
+        writers of the same json file take turns by an flock on <json file>.lock, the json file
+        itself is replaced by a temporary file of its folder.
+        return: rc = 0 ok, else error
+                rc_msg return message
+    """
+    fct = " pi_write_records() "
+    import json
+    import fcntl
+    import tempfile
+    if jtype not in pi_json_file_names:
+        return 1, fct + " unknown JSON-File-Type " + str(jtype) + "!"
+    path_to_file = os.path.join(path_to_energy_files, pi_json_file_names[jtype])
+    try:
+        l_handle = open(path_to_file + ".lock", "a")
+    except OSError as e:
+        return 4, fct + " json file " + path_to_file + " could not be locked: " + str(e) + "!"
+    with l_handle:
+        fcntl.flock(l_handle, fcntl.LOCK_EX)
+        jdict = {}
+        mode = 0o644
+        if not replace:
+            try:
+                with open(path_to_file) as j_handle:
+                    mode = os.fstat(j_handle.fileno()).st_mode & 0o777
+                    jdict = json.load(j_handle)
+            except OSError:
+                jdict = {}
+            except ValueError as e:
+                return 3, fct + " json file " + path_to_file + " could not be read: " + str(e) + "!"
+        r, r_msg, jdict = pi_merge_records(jtype, jdict, records, replace)
+        if r != 0:
+            return r, fct + " failed by " + r_msg
+        path_to_tmp = None
+        try:
+            with tempfile.NamedTemporaryFile("w", dir=path_to_energy_files, prefix=pi_json_file_names[jtype] + ".",
+                                             suffix=".tmp", delete=False) as t_handle:
+                path_to_tmp = t_handle.name
+                os.fchmod(t_handle.fileno(), mode)
+                json.dump(jdict, t_handle)
+                t_handle.flush()
+                os.fsync(t_handle.fileno())
+            os.replace(path_to_tmp, path_to_file)
+        except OSError as e:
+            if path_to_tmp is not None:
+                try:
+                    os.unlink(path_to_tmp)
+                except OSError:
+                    pass
+            return 4, fct + " json file " + path_to_file + " could not be written: " + str(e) + "!"
+    return 0, fct + " success!"
+
+############################################################################
+
+class pi_energy_context:
+    """ request scoped evaluation context of pi_energy
+        while a query or report is answered, every query item and every function
+        is evaluated at most once, repeated requests are answered from this context.
+    """
+    def __init__(self):
+        self.items = {}      # query item -> result of pi_energy.query_item()
+        self.functions = {}  # function item -> result of its pi_energy.calc_*() function
+        self.expires = None  # time.time() when results depending on the current date expire
+
+# class pi_energy_context
+############################################################################
+
 class pi_energy:
     """ purpose of this class is to answer queries about items in json files
         json files are provided in the the  path_to_energy_files folder.
         They include items about WITA Energy.
         The concept is open for any other items in any other json files.
     """
+    # bytes a json file takes in memory when parsed and indexed, per byte of the json file,
+    # measured 5 to 9 for the json files of the collector, see memory_estimate()
+    json_memory_factor = 8
+    # bytes of a cached answer or function result besides its strings
+    cache_entry_bytes = 200
+    # compiled TTS templates, shared by all instances, see compile_template()
+    tts_templates_shared = {}
+    # json files and clock dependencies of the query items and the order of the functions,
+    # the same for all instances, computed by the first one:
+    # (pi_query_files, pi_query_clock, pi_query_history, pi_query_functions_order)
+    query_deps_shared = None
+
     ############################################################################
-    def __init__(self, path_to_energy_files):
-        user = pwd.getpwuid( os.getuid() ).pw_name
+    def __init__(self, path_to_energy_files, watch=False, load_on_query=True, decoder=None, history=None,
+                 snapshot=None, history_days=None, executor=None):
+        """ path_to_energy_files: folder of the json files
+            watch: if True, the folder is watched by inotify and json files are only
+                   checked after they have been written. Otherwise, or if inotify
+                   is not available, the modification time of every json file is
+                   checked on every query.
+            load_on_query: if True, every query loads the json files it needs if they changed.
+                   if False, json files are kept up to date by calling refresh(), e.g. by
+                   a background refresher, and queries only load json files never loaded.
+            decoder: decoder of json files, see pi_json_decoder()
+            history: path to the sqlite file of the history store, see wita_pi_history.py
+                   if None, no history is recorded and history items cannot be answered
+            snapshot: filename of a snapshot in the energy-files folder, see wita_pi_snapshot.py
+                   if the snapshot exists, its sections replace the json files of the same
+                   JSON-File-Type, the other json files are still loaded.
+                   if None, only json files are loaded
+            history_days: days of history kept by the history store, None keeps all of it
+            executor: ThreadPoolExecutor reading the changed json files, e.g. shared by the
+                   pi_energy instances of many sites, it is not shut down by close().
+                   if None, an executor of json_workers threads is created when needed
+        """
         self.path_to_energy_files = path_to_energy_files
-        self.user = user
+        self.user_name = None   # see user
 
         j_dict = {} # empty json dict to initialie json_files hash
         mod_time = 0
+        j_index = {} # empty lookup index, built by load_json_files()
+        j_gen = 0    # generation of the json dict, counts the loads of the jfile
         self.json_files = {
         # hash of index to jfile_ctl: (json filename, json load dict, and file modification time.
         #                              if file modification time is 0, jfile was not loaded yet
-        #   index  JSON-File-Type   json filename      json dict, jfile modification time
+        #   index  JSON-File-Type   json filename (see pi_json_file_names), json dict, jfile modification time, lookup index, generation
         #
-            "1" : ["HPH", "hpm-out-header.json",       j_dict, mod_time],
-            "2" : ["HPS", "hpm-out-shortterm.json",    j_dict, mod_time],
-            "3" : ["HPP", "hpm-out-longterm.json",     j_dict, mod_time],
-            "4" : ["PVM", "pv_meter.json",             j_dict, mod_time],
-            "5" : ["PVT", "pvm-out-meter-total.json",  j_dict, mod_time],
-            "6" : ["CH",  "charger.json",              j_dict, mod_time],
-            "7" : ["V",   "vehicle.json",              j_dict, mod_time],
+            "1" : ["HPH",  pi_json_file_names["HPH"], j_dict, mod_time, j_index, j_gen],
+            "2" : ["HPS",  pi_json_file_names["HPS"], j_dict, mod_time, j_index, j_gen],
+            "3" : ["HPP",  pi_json_file_names["HPP"], j_dict, mod_time, j_index, j_gen],
+            "4" : ["PVM",  pi_json_file_names["PVM"], j_dict, mod_time, j_index, j_gen],
+            "5" : ["PVT",  pi_json_file_names["PVT"], j_dict, mod_time, j_index, j_gen],
+            "6" : ["CH",   pi_json_file_names["CH"],  j_dict, mod_time, j_index, j_gen],
+            "7" : ["V",    pi_json_file_names["V"],   j_dict, mod_time, j_index, j_gen],
             }
         # JSON-File-Type: points to the structure of the respective json file
         #                 HPH, HPS, HPP, PVM, PVT, CH, V
         #
+        # this hash maps the JSON-File-Type to the method that looks up an item
+        # in the lookup index of the respective json file
+        self.json_lookup = {
+            "HPH" : self.lookup_HP_item,
+            "HPS" : self.lookup_HP_item,
+            "HPP" : self.lookup_HP_item,
+            "PVM" : self.lookup_PV_item,
+            "PVT" : self.lookup_PV_item,
+            "CH"  : self.lookup_CH_item,
+            "V"   : self.lookup_V_item,
+            }
+        # this hash caches item keys split into (key1, key2) as used by the lookup index
+        self.json_item_keys = {}
+        # json_files indexes that were reported as missing, not to report them on every query
+        self.json_files_missing = set()
+        # date and time methods, e.g. for the vehicle lease calculations
+        self.pi_dt = pi_datetime()
+        # evaluation context of the query currently answered, see open_context()
+        self.eval_ctx = None
+        self.load_on_query = load_on_query
+        # decoder of json files: [name, loads function, loads accepts a buffer]
+        rc, rc_msg, self.json_decoder = pi_json_decoder(decoder)
+        if rc != 0:
+            print(rc_msg)
+        # json files of at least json_mmap_size bytes are mapped rather than read,
+        # if the decoder accepts a buffer
+        self.json_mmap_size = 1024 * 1024
+        # changed json files are parsed by up to json_workers threads
+        self.json_workers = 4
+        self.json_executor = executor
+        self.json_executor_owned = False
+        # bytes of the json files currently loaded, by json_files index, see loaded_bytes()
+        self.json_sizes = {}
+        # optional history store, json files of history_files are recorded on every reload
+        self.history = None
+        self.history_files = {"3", "4", "5", "6", "7"}
+        # writes to the history store, part of the cache key of the history items, see cache_gens()
+        self.history_gen = 0
+        if history is not None:
+            try:
+                from .wita_pi_history import pi_history
+            except ImportError:
+                from wita_pi_history import pi_history
+            self.history = pi_history(history, history_days)
+        # optional snapshot replacing the json files, see read_snapshot()
+        self.snapshot_name = snapshot
+        self.snapshot = None          # pi_snapshot currently mapped
+        self.snapshot_stat = None     # (inode, modification time) of the mapped snapshot
+        self.snapshot_loaded = {}     # json_files index -> (generation, crc) of the section loaded
+        # serializes queries and the installation of reloaded json files, see refresh()
+        self.lock = threading.RLock()
+        # cache of rendered answers to queries and reports, see answer()
+        self.answer_cache = {}
+        # cache of the results of functions, see query_function()
+        self.function_cache = {}
+        # (generation, time) of the newest measurement of pvm-out-meter-total.json, see data_timestamp()
+        self.data_time = None
+        # timings and counters of the query stages, see get_stats()
+        self.stats = self.new_stats()
+        # optional watcher of the energy-files folder, see load_json_files()
+        self.watcher = None
+        if watch:
+            json_filenames = {}
+            for index, jfile_ctl in self.json_files.items():
+                json_filenames[jfile_ctl[1]] = index
+            if snapshot is not None:
+                json_filenames[snapshot] = "S"
+            self.watcher = pi_energy_watcher(path_to_energy_files, json_filenames)
+            rc, rc_msg = self.watcher.start()
+            if rc != 0:
+                print(rc_msg + " falling back to polling")
+                self.watcher = None
         # this hash maps ENU et al vocs to DE vocs
         self.TTS_dict = {
             "degree"    : "Grad",
@@ -226,18 +747,80 @@ class pi_energy:
         # This hash controls query items that cannot be answered 1:1 by WITA_energy
         # json files. They rather are the result of specific calculations by functions
         # However the values of the json files are the basis for these calculations
+        # Every function declares its inputs: query items, static items, other functions
+        # and "now" for the current date. The inputs are evaluated first (see query_function())
+        # and passed to the function as (rc, rc_msg, value) in the declared order.
         self.pi_query_items_functions = {
-            # search item                function                       unit   TTS template
+            # search item                function                       unit   TTS template      inputs of the function
+            #
             #   how much energy was consumed today (including pv and grid)?
-            "energy_consumption_today": (self.calc_energy_consumption, ("kWh", "In der Energiebilanz wurden heute $$V %%U Strom %%Scons")),
+            "energy_consumption_today": (self.calc_energy_consumption, ("kWh", "In der Energiebilanz wurden heute $$V %%U Strom %%Scons"),
+                                         ["pv-total Energy_Today", "netzbezug-total Energy_Today", "netzeinspeisung-total Energy_Today"]),
             #   what is the degree of autonomy today
-            "energy_autonomy_today":    (self.calc_autonomy_degree,    ("%",   "Der Autonomiegrad in der Energiebilanz heute betraegt $$V %%U")),
+            "energy_autonomy_today":    (self.calc_autonomy_degree,    ("%",   "Der Autonomiegrad in der Energiebilanz heute betraegt $$V %%U"),
+                                         ["pv-total Energy_Today", "energy_consumption_today", "netzeinspeisung-total Energy_Today"]),
+            #   how much of the pv production was consumed by ourselves today
+            "self_consumption_today":   (self.calc_self_consumption,   ("kWh", "Vom Strom der Photovoltaik wurden heute $$V %%U selbst verbraucht"),
+                                         ["pv-total Energy_Today", "netzeinspeisung-total Energy_Today"]),
+            #   which share of the energy consumption today was taken by the heatpump
+            "hp_share_today":           (self.calc_share,              ("%",   "Der Anteil der Waermepumpe am Stromverbrauch heute betraegt $$V %%U"),
+                                         ["power_input_total_today", "energy_consumption_today"]),
             # how many days the vehicle has been leased as of today"
-            "vehicle_days_leased_now":  (self.calc_vehicle_days_leased_now, ("Tagen", "Der Liesing Vertrag fuer das E-Auto besteht heute seit $$V %%U")),
+            "vehicle_days_leased_now":  (self.calc_vehicle_days_leased_now, ("Tagen", "Der Liesing Vertrag fuer das E-Auto besteht heute seit $$V %%U"),
+                                         ["vehicle lease_start_date_iso", "now"]),
             # how many km are committed to go by vehicle as of today
-            "vehicle_km_committed_now":  (self.calc_vehicle_km_committed_now, ("km", "Bis heute durften laut Liesing Vertrag mit dem E-Auto bis zu $$V %%U zurueckgelegt werden")),
+            "vehicle_km_committed_now":  (self.calc_vehicle_km_committed_now, ("km", "Bis heute durften laut Liesing Vertrag mit dem E-Auto bis zu $$V %%U zurueckgelegt werden"),
+                                         ["vehicle lease_km_committed_per_year", "vehicle_days_leased_now"]),
             # which is the range we are over or below the committed number of km
-            "vehicle_km_tolerance_now":  (self.calc_vehicle_km_tolerance_now, ("km", "Stand heute wurden mit dem E-Auto $$V %%U %%Smoreless als das vereinbarte Limit gefahren")),
+            "vehicle_km_tolerance_now":  (self.calc_vehicle_km_tolerance_now, ("km", "Stand heute wurden mit dem E-Auto $$V %%U %%Smoreless als das vereinbarte Limit gefahren"),
+                                         ["vehicle Odometer", "vehicle_km_committed_now"]),
+
+            # the following items are answered by the history store, see calc_history_delta()
+            # how much energy did the pv produce yesterday, this week, this month
+            "pv_production_yesterday":   (functools.partial(self.calc_history_delta, "PVM pv-total Energy", "yesterday"),
+                                          ("kWh", "Die Photovoltaik hat gestern $$V %%U Strom erzeugt"),
+                                          ["pv-total Energy", "now"]),
+            "pv_production_week":        (functools.partial(self.calc_history_delta, "PVM pv-total Energy", "week"),
+                                          ("kWh", "Die Photovoltaik hat diese Woche bisher $$V %%U Strom erzeugt"),
+                                          ["pv-total Energy", "now"]),
+            "pv_production_month":       (functools.partial(self.calc_history_delta, "PVM pv-total Energy", "month"),
+                                          ("kWh", "Die Photovoltaik hat diesen Monat bisher $$V %%U Strom erzeugt"),
+                                          ["pv-total Energy", "now"]),
+            "pv_production_year":        (functools.partial(self.calc_history_delta, "PVM pv-total Energy", "year"),
+                                          ("kWh", "Die Photovoltaik hat dieses Jahr bisher $$V %%U Strom erzeugt"),
+                                          ["pv-total Energy", "now"]),
+            # how much energy was taken from resp. fed into the grid yesterday
+            "grid_consumption_yesterday": (functools.partial(self.calc_history_delta, "PVM netzbezug-total Energy", "yesterday"),
+                                          ("kWh", "Gestern wurden $$V %%U Strom aus dem Netz bezogen"),
+                                          ["netzbezug-total Energy", "now"]),
+            "grid_feedin_yesterday":     (functools.partial(self.calc_history_delta, "PVM netzeinspeisung-total Energy", "yesterday"),
+                                          ("kWh", "Gestern wurden $$V %%U Strom in das Netz eingespeist"),
+                                          ["netzeinspeisung-total Energy", "now"]),
+            # what was the degree of autonomy yesterday, this week, this month
+            "energy_autonomy_yesterday": (functools.partial(self.calc_history_autonomy_degree, "yesterday"),
+                                          ("%", "Der Autonomiegrad in der Energiebilanz gestern betrug $$V %%U"),
+                                          ["pv-total Energy", "netzbezug-total Energy", "netzeinspeisung-total Energy", "now"]),
+            "energy_autonomy_week":      (functools.partial(self.calc_history_autonomy_degree, "week"),
+                                          ("%", "Der Autonomiegrad in der Energiebilanz diese Woche betraegt $$V %%U"),
+                                          ["pv-total Energy", "netzbezug-total Energy", "netzeinspeisung-total Energy", "now"]),
+            "energy_autonomy_month":     (functools.partial(self.calc_history_autonomy_degree, "month"),
+                                          ("%", "Der Autonomiegrad in der Energiebilanz diesen Monat betraegt $$V %%U"),
+                                          ["pv-total Energy", "netzbezug-total Energy", "netzeinspeisung-total Energy", "now"]),
+            # how much energy did the heatpump consume yesterday (the daily counter at its maximum)
+            "hp_power_consumption_yesterday": (functools.partial(self.calc_history_aggregate, "HPP power_input_total_today", "yesterday", "max"),
+                                          ("kWh", "Die Waermepumpe hat gestern $$V %%U verbraucht"),
+                                          ["power_input_total_today", "now"]),
+            # how many km did we go by vehicle this week, this month
+            "vehicle_km_week":           (functools.partial(self.calc_history_delta, "V vehicle Odometer", "week"),
+                                          ("km", "Mit dem E-Auto wurden diese Woche bisher $$V %%U gefahren"),
+                                          ["vehicle Odometer", "now"]),
+            "vehicle_km_month":          (functools.partial(self.calc_history_delta, "V vehicle Odometer", "month"),
+                                          ("km", "Mit dem E-Auto wurden diesen Monat bisher $$V %%U gefahren"),
+                                          ["vehicle Odometer", "now"]),
+            # how many km did we go by vehicle in the current year of the lease
+            "vehicle_km_lease_year":     (functools.partial(self.calc_history_delta, "V vehicle Odometer", "lease_year"),
+                                          ("km", "Mit dem E-Auto wurden im laufenden Liesing Jahr bisher $$V %%U gefahren"),
+                                          ["vehicle Odometer", "now"]),
 
         }
 
@@ -309,6 +892,17 @@ class pi_energy:
             "netzeinspeisung-total Energy_Today",
             "energy_autonomy_today",
         ]
+        #    history report
+        self.pi_query_report_history = [
+            "pv_production_yesterday",
+            "grid_consumption_yesterday",
+            "energy_autonomy_yesterday",
+            "pv_production_week",
+            "energy_autonomy_week",
+            "pv_production_month",
+            "energy_autonomy_month",
+            "vehicle_km_month",
+        ]
         # This hash controls the Energy Reports
         self.pi_query_items_reports = {
             # report name    pointer to the list of report items
@@ -319,11 +913,160 @@ class pi_energy:
             "heatpump":     (self.pi_query_report_heatpump),
             "grid":         (self.pi_query_report_grid),
             "photovoltaik": (self.pi_query_report_pv),
+            "history":      (self.pi_query_report_history),
         }
 
+        # This hash provides the watch rules: rules on query items that are checked whenever
+        # a json file the item depends on was reloaded, see check_watch_rules().
+        # A rule that fires queues its announcement, see take_notifications().
+        #   kind         condition
+        #   threshold    (operator, limit), fires when the value crosses the limit: ("<", "<=", ">", ">=")
+        #   transition   (from, to), fires when the value changes from "from" (None: any value) to "to"
+        #   flip         True resp. False fires when the bool value turns true resp. false, None on any change
+        # rules do not fire on the first value seen, e.g. after startup.
+        self.pi_watch_rules = {
+            # rule name          query item               kind          condition     TTS announcement
+            "vehicle_full":      ("vehicle Soc",           "threshold",  (">=", 100),  "Das Auto ist voll geladen"),
+            "pv_storage_full":   ("stromspeicher Soc",     "threshold",  (">=", 100),  "Der Stromspeicher ist voll"),
+            "charger_started":   ("charger Charge status", "transition", (None, "C"),  "Die Wallbox laedt jetzt das Fahrzeug"),
+            "charger_finished":  ("charger Charge status", "transition", ("C", "B"),   "Die Wallbox hat das Laden beendet, das Fahrzeug ist noch verbunden"),
+            "compressor_on":     ("compressor_active",     "flip",       True,         "Der Kompressor der Waermepumpe ist angelaufen"),
+            "compressor_off":    ("compressor_active",     "flip",       False,        "Der Kompressor der Waermepumpe hat abgeschaltet"),
+        }
+        # hash of rule name to the last value seen, None before the first check
+        self.watch_state = {}
+        # announcements of the rules fired, not taken yet, at most notifications_max
+        self.notifications = []
+        self.notifications_max = 100
+
+        # This hash provides the compiled TTS templates of all query items, see compile_template()
+        self.tts_templates = pi_energy.tts_templates_shared
+        for pi_query_ctrl in self.pi_query_items.values():
+            self.compile_template(pi_query_ctrl[1])
+        for pi_query_ctrl in self.pi_query_items_patch.values():
+            self.compile_template(pi_query_ctrl[1][1])
+        for pi_query_ctrl in self.pi_query_items_static.values():
+            self.compile_template(pi_query_ctrl[2])
+        for pi_query_ctrl in self.pi_query_items_functions.values():
+            self.compile_template(pi_query_ctrl[1][1])
+        for pi_watch_ctrl in self.pi_watch_rules.values():
+            self.compile_template(pi_watch_ctrl[3])
+
+        # This hash maps every query item and report to the json_files indexes it depends on,
+        # so a query only loads the json files it actually needs
+        # These query items and reports depend on the current date ("now"), their answers expire
+        # These query items and reports are answered by the history store, see cache_gens()
+        if pi_energy.query_deps_shared is None:
+            self.pi_query_files = {}
+            for item in (list(self.pi_query_items) + list(self.pi_query_items_patch) + list(self.pi_query_items_static) +
+                         list(self.pi_query_items_functions) + list(self.pi_query_items_reports)):
+                self.pi_query_files[item] = self.query_files(item)
+            self.pi_query_clock = set()
+            self.pi_query_history = set()
+            for item in self.pi_query_files:
+                if self.query_depends_on_clock(item):
+                    self.pi_query_clock.add(item)
+                if self.query_depends_on_history(item):
+                    self.pi_query_history.add(item)
+            pi_energy.query_deps_shared = (self.pi_query_files, self.pi_query_clock, self.pi_query_history,
+                                           self.query_functions_order())
+        (self.pi_query_files, self.pi_query_clock, self.pi_query_history,
+         self.pi_query_functions_order) = pi_energy.query_deps_shared
+        # This hash maps the json_files indexes to the watch rules on items that depend on them
+        self.pi_watch_files = {}
+        self.index_watch_rules()
+
+
+    ############################################################################
+    def query_files(self, item, visited=None):
+        """ work out the json_files indexes the query item or report depends on.
+            items of pi_query_items and pi_query_items_patch depend on their json file,
+            static items on none, functions on the items they are calculated from
+            and reports on all of their items.
+
+            return: frozenset of json_files indexes
+        """
+        if visited is None:
+            visited = set()
+        if item in visited:
+            return frozenset()
+        visited.add(item)
+        if item in self.pi_query_items_static:
+            return frozenset()
+        if item in self.pi_query_items_patch:
+            return frozenset([self.pi_query_items_patch[item][1][0]])
+        if item in self.pi_query_items:
+            return frozenset([self.pi_query_items[item][0]])
+        if item in self.pi_query_items_functions:
+            items = self.pi_query_items_functions[item][2]
+        elif item in self.pi_query_items_reports:
+            items = self.pi_query_items_reports[item]
+        else:
+            return frozenset()
+        indexes = set()
+        for i in items:
+            indexes |= self.query_files(i, visited)
+        return frozenset(indexes)
+
+    ############################################################################
+    def query_depends_on_clock(self, item, visited=None):
+        """ True if the query item or report depends on the current date,
+            that is a function it is calculated from lists "now" as input
+        """
+        if visited is None:
+            visited = set()
+        if item in visited:
+            return False
+        visited.add(item)
+        if item in self.pi_query_items_functions:
+            items = self.pi_query_items_functions[item][2]
+        elif item in self.pi_query_items_reports:
+            items = self.pi_query_items_reports[item]
+        else:
+            return False
+        for i in items:
+            if i == "now" or self.query_depends_on_clock(i, visited):
+                return True
+        return False
+
+    ############################################################################
+    def query_depends_on_history(self, item, visited=None):
+        """ True if the query item or report depends on the history store,
+            that is a function it is calculated from is one of the calc_history_* methods
+        """
+        if visited is None:
+            visited = set()
+        if item in visited:
+            return False
+        visited.add(item)
+        if item in self.pi_query_items_functions:
+            function = self.pi_query_items_functions[item][0]
+            function = getattr(function, "func", function)
+            if getattr(function, "__name__", "").startswith("calc_history_"):
+                return True
+            items = self.pi_query_items_functions[item][2]
+        elif item in self.pi_query_items_reports:
+            items = self.pi_query_items_reports[item]
+        else:
+            return False
+        for i in items:
+            if self.query_depends_on_history(i, visited):
+                return True
+        return False
+
+    ############################################################################
+    def cache_gens(self, item):
+        """ return the key of the cached answer or function result of item: the generations of
+            the json files it depends on and, if it is answered by the history store, the number
+            of its writes, so a cached answer is valid until one of them changed
+        """
+        gens = tuple([self.json_files[index][5] for index in self.pi_query_files[item]])
+        if item in self.pi_query_history:
+            gens += (("H", self.history_gen),)
+        return gens
 
     #############################################
-    def calc_energy_consumption(self):
+    def calc_energy_consumption(self, pv, grid, feedin):
         """ calculate energy consumption of the current day
             energy_consumption today is:
                  + PV Production today      --> pv-total Energy_Today (self.pi_query_items)
@@ -334,10 +1077,9 @@ class pi_energy:
         rc = 0
         rc_msg = "success"
         r_value = 42
-        # retrive required basic measures
-        r_1, r_msg_1, r_unit_1, r_value_1, r_descr_1, r_tts_1 = self.query_item("pv-total Energy_Today")
-        r_2, r_msg_2, r_unit_2, r_value_2, r_descr_2, r_tts_2 = self.query_item("netzbezug-total Energy_Today")
-        r_3, r_msg_3, r_unit_3, r_value_3, r_descr_3, r_tts_3 = self.query_item("netzeinspeisung-total Energy_Today")
+        r_1, r_msg_1, r_value_1 = pv
+        r_2, r_msg_2, r_value_2 = grid
+        r_3, r_msg_3, r_value_3 = feedin
         if r_1 == 0 and r_2 == 0 and r_3 == 0:
             if self.is_float(r_1) and self.is_float(r_2) and self.is_float(r_3):
                 r_value = float(r_value_1) + float(r_value_2) - float(r_value_3)
@@ -351,7 +1093,7 @@ class pi_energy:
         return rc, rc_msg, str(r_value)
 
     #############################################
-    def calc_autonomy_degree(self):
+    def calc_autonomy_degree(self, pv, consumption, feedin):
         """ calculate degree of autonomy for the current day
             automomy_degree is:
                 energy_consumption = PV production + Grid import - Grid feed-in
@@ -362,10 +1104,9 @@ class pi_energy:
         rc = 0
         rc_msg = "success"
         r_value = 42
-        # retrive required basic measures
-        r_1, r_msg_1, r_unit_1, r_value_1, r_descr_1, r_tts_1 = self.query_item("pv-total Energy_Today")
-        r_2, r_msg_2,           r_value_2                     = self.calc_energy_consumption()
-        r_3, r_msg_3, r_unit_3, r_value_3, r_descr_3, r_tts_1 = self.query_item("netzeinspeisung-total Energy_Today")
+        r_1, r_msg_1, r_value_1 = pv
+        r_2, r_msg_2, r_value_2 = consumption
+        r_3, r_msg_3, r_value_3 = feedin
         if r_1 == 0 and r_2 == 0 and r_3 == 0:
             if self.is_float(r_1) and self.is_float(r_2) and self.is_float(r_3):
                 r_value = round((float(r_value_1) - float(r_value_3)) / float(r_value_2) *100, 2)
@@ -379,26 +1120,52 @@ class pi_energy:
         return rc, rc_msg, str(r_value)
 
     ############################################################################
-    def calc_vehicle_days_leased_now(self):
-        """ calculate the number of day the vehicle has been leased as of today
+    def calc_self_consumption(self, pv, feedin):
+        """ calculate the energy of the pv production consumed by ourselves (Eigenverbrauch) today
+                self_consumption = PV production - Grid feed-in
+        """
+        fct = " pi_energy.calc_self_consumption() "
+        if pv[0] != 0 or feedin[0] != 0:
+            return 2, fct + " failed by " + str(pv[0]) + " " + pv[1] + str(feedin[0]) + " " + feedin[1] + "!", "0"
+        if not self.is_float(pv[2]) or not self.is_float(feedin[2]):
+            return 1, fct + " failed, at least one of the basic measures retrieved is not a float!", "0"
+        return 0, "success", str(float(pv[2]) - float(feedin[2]))
+
+    ############################################################################
+    def calc_share(self, part, total):
+        """ calculate the share of part in total in percent, e.g. the share of the heatpump
+            in the energy consumption
+        """
+        fct = " pi_energy.calc_share() "
+        if part[0] != 0 or total[0] != 0:
+            return 2, fct + " failed by " + str(part[0]) + " " + part[1] + str(total[0]) + " " + total[1] + "!", "0"
+        if not self.is_float(part[2]) or not self.is_float(total[2]):
+            return 1, fct + " failed, at least one of the basic measures retrieved is not a float!", "0"
+        if float(total[2]) <= 0:
+            return 1, fct + " failed, no energy consumption!", "0"
+        return 0, "success", str(round(float(part[2]) / float(total[2]) * 100, 2))
+
+    ############################################################################
+    def calc_vehicle_days_leased_now(self, lease_start, now):
+        """ calculate the number of day the vehicle has been leased as of now
             the number of days is calculated by the datetime difference
-                 today - "vehicle lease_start_date_iso"
-            in days
+                 now - "vehicle lease_start_date_iso"
+            in days, now is the datetime of the input "now"
         """
         fct = " pi_energy.calc_vehicle_days_leased_now() "
         rc = 0
         rc_msg = "success"
         r_value = 42
-        # pi datetime methods
-        pi_dt = pi_datetime()
-        # retrive required basic measures
-        r1, r1_msg, r1_unit, r1_value, r1_descr, r1_tts = self.query_item("vehicle lease_start_date_iso")
-        rdt, rdt_msg, rdt_diff = pi_dt.diff('now', r1_value)
+        r1, r1_msg, r1_value = lease_start
+        r2, r2_msg, r2_value = now
+        rdt, rdt_msg, rdt_diff = self.pi_dt.diff(r2_value, r1_value)
+        # the number of days changes at the next full day since lease start
+        self.expire_at(self.pi_dt.next_diff_change(r1_value, r2_value))
         #print(fct + " rdt_diff= " + str(rdt_diff) + "\n")
         return rc, rc_msg, str(rdt_diff)
 
     ############################################################################
-    def calc_vehicle_km_committed_now(self):
+    def calc_vehicle_km_committed_now(self, km_per_year, days_leased):
         """ calculate how many km are committed to go with the vehicle as of today
             this number is calculated by
                 (calc_vehicle_km_committed_now) * vehicle_days_leased_now
@@ -407,16 +1174,15 @@ class pi_energy:
         rc = 0
         rc_msg = "success"
         r_value = 42
-        # retrive required basic measures
-        r1, r1_msg, r1_unit, r1_value, r1_descr, r1_tts = self.query_item("vehicle lease_km_committed_per_year")
-        r2, r2_msg,          r2_value                   = self.calc_vehicle_days_leased_now()
+        r1, r1_msg, r1_value = km_per_year
+        r2, r2_msg, r2_value = days_leased
         #print(fct + " r1_value=" + r1_value + "\n")
         #print(fct + " r2_value=" + r2_value + "\n")
         r_value = (float(r1_value))/365 * float(r2_value)
         return rc, rc_msg, str(r_value)
 
     ############################################################################
-    def calc_vehicle_km_tolerance_now(self):
+    def calc_vehicle_km_tolerance_now(self, odometer, km_committed):
         """ calculate how many km have been driven below or above the committed limit
             this number is calculated by
                 (vehicle Odometer) - calc_vehicle_km_committed_now
@@ -428,64 +1194,543 @@ class pi_energy:
         rc = 0
         rc_msg = "success"
         r_value = 42
-        # retrive required basic measures
-        r1, r1_msg, r1_unit, r1_value, r1_descr, r1_tts = self.query_item("vehicle Odometer")
-        r2, r2_msg,          r2_value                   = self.calc_vehicle_km_committed_now()
+        r1, r1_msg, r1_value = odometer
+        r2, r2_msg, r2_value = km_committed
         #print(fct + " r1_value=" + r1_value + "\n")
         #print(fct + " r2_value=" + r2_value + "\n")
         r_value = float(r1_value) - float(r2_value)
         return rc, rc_msg, str(r_value)
 
     ############################################################################
-    def load_json_files(self):
+    def period(self, name):
+        """ return rc, rc_msg, start and end of the calendar or lease period name, see pi_datetime.period()
+            lease periods start at "vehicle lease_start_date_iso"
+        """
+        return self.pi_dt.period(name, self.pi_query_items_static["vehicle lease_start_date_iso"][1])
+
+    ############################################################################
+    def calc_history_delta(self, item, period, *inputs):
+        """ calculate how much the counting item of the history store, e.g. "PVM pv-total Energy",
+            increased in the period ("yesterday", "week", "month", "lease_year", ...), see period()
+            results expire at midnight, when the periods change
+            inputs: the current value of the item and "now", they are not used for the calculation
+                    but make the result depend on reloads, when the history is recorded
+        """
+        fct = " pi_energy.calc_history_delta() "
+        if self.history is None:
+            return 1, fct + " no history store configured!", "0"
+        r, r_msg, r_start, r_end = self.period(period)
+        if r != 0:
+            return 2, fct + " failed by " + r_msg + "!", "0"
+        self.expire_at(self.pi_dt.next_midnight())
+        r, r_msg, r_value = self.history.delta(item, r_start.timestamp(), r_end.timestamp())
+        if r != 0:
+            return 3, fct + " failed by " + str(r) + " " + r_msg, "0"
+        return 0, "success", str(r_value)
+
+    ############################################################################
+    def calc_history_aggregate(self, item, period, function, *inputs):
+        """ calculate the minimum, maximum or average ("min", "max", "avg") of item
+            of the history store in the calendar period, see calc_history_delta()
+        """
+        fct = " pi_energy.calc_history_aggregate() "
+        if self.history is None:
+            return 1, fct + " no history store configured!", "0"
+        r, r_msg, r_start, r_end = self.period(period)
+        if r != 0:
+            return 2, fct + " failed by " + r_msg + "!", "0"
+        self.expire_at(self.pi_dt.next_midnight())
+        r, r_msg, r_value = self.history.aggregate(item, r_start.timestamp(), r_end.timestamp(), function)
+        if r != 0:
+            return 3, fct + " failed by " + str(r) + " " + r_msg, "0"
+        return 0, "success", str(r_value)
+
+    ############################################################################
+    def calc_history_autonomy_degree(self, period, *inputs):
+        """ calculate degree of autonomy of the calendar period from the history store
+            like calc_autonomy_degree(), but based on the total counters of pv_meter.json
+        """
+        fct = " pi_energy.calc_history_autonomy_degree() "
+        r_1, r_msg_1, r_value_1 = self.calc_history_delta("PVM pv-total Energy", period)
+        r_2, r_msg_2, r_value_2 = self.calc_history_delta("PVM netzbezug-total Energy", period)
+        r_3, r_msg_3, r_value_3 = self.calc_history_delta("PVM netzeinspeisung-total Energy", period)
+        if r_1 != 0 or r_2 != 0 or r_3 != 0:
+            return 2, fct + " failed by " + str(r_1) + " " + r_msg_1 + str(r_2) + " " + r_msg_2 + str(r_3) + " " + r_msg_3 + "!", "0"
+        consumption = float(r_value_1) + float(r_value_2) - float(r_value_3)
+        if consumption <= 0:
+            return 1, fct + " failed, no energy consumption in the period!", "0"
+        return 0, "success", str(round((float(r_value_1) - float(r_value_3)) / consumption * 100, 2))
+
+    ############################################################################
+    def record_history(self, jfiles):
+        """ record the json files just installed in the history store,
+            before their answers are rendered, see install_json_files()
+        """
+        history = self.history
+        if history is None:
+            return
+        for jfile in jfiles:
+            index = jfile[0]
+            if index in self.history_files:
+                r, r_msg, n = history.record(self.json_files[index][0], jfile[3], jfile[1])
+                if r != 0:
+                    print(r_msg)
+                if n > 0:
+                    self.history_gen += 1
+
+    ############################################################################
+    def load_json_files(self, indexes=None):
+        """ load json files that have not been loaded yet or have been updated since last load.
+            indexes: json_files indexes to load, None loads all json files
+            with an active watcher only the json files it marked dirty are checked,
+            so nothing touches the file system when no json file was written.
+            Otherwise the modification time of every json file is checked.
+        """
         fct = " pi_energy.load_json_files() "
-        for index, jfile_ctl in self.json_files.items():
-            path_to_file = self.path_to_energy_files + '/' + jfile_ctl[1]
-            if os.path.isfile(path_to_file):
-                # jfile exists
-                jfile_mtime = os.stat(path_to_file).st_mtime
-                if not jfile_ctl[3] == jfile_mtime:
-                    #jfile modification time is different to last load, or jfile was not yet loaded
-                    with open(path_to_file) as j_handle:
-                        jfile_ctl[2] = json.load(j_handle)
-                        jfile_ctl[3] = jfile_mtime
-                        j_handle.close()
-                        #print('\n')
-                        #print(fct + " json file loaded: " + jfile_ctl[0])
-            else:
+        jfiles, load_time = self.read_json_files(indexes)
+        with self.lock:
+            r, r_msg = self.install_json_files(jfiles, load_time)
+        if r != 0:
+            print(fct + " failed by " + r_msg)
+
+    ############################################################################
+    def read_json_files(self, indexes=None):
+        """ read and index the json files to load, see load_json_files().
+            more than one changed json file is read concurrently by up to self.json_workers threads,
+            decoding holds the GIL anyway and is done one json file after the other.
+            this does not change the loaded json files, so it may run in parallel to queries.
+            return: jfiles: list of json files read, see decode_json_file()
+                    load_time: time it took to read them
+        """
+        fct = " pi_energy.read_json_files() "
+        t0 = time.perf_counter()
+        if indexes is None:
+            indexes = self.json_files.keys()
+        jfiles = []
+        if self.snapshot_name is not None:
+            jfiles, indexes = self.read_snapshot(indexes)
+        watcher = self.watcher
+        if watcher is not None and watcher.active:
+            indexes = watcher.take_dirty(indexes)
+        changed = []
+        for index in indexes:
+            jfile_stat = self.check_json_file(index)
+            if jfile_stat is not None:
+                changed.append((index, jfile_stat))
+        executor = self.json_executor
+        if len(changed) > 1 and (executor is not None or self.json_workers > 1):
+            if executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                executor = ThreadPoolExecutor(max_workers=self.json_workers, thread_name_prefix="pi_energy_json")
+                self.json_executor = executor
+                self.json_executor_owned = True
+            j_datas = list(executor.map(self.read_json_data, changed))
+        else:
+            j_datas = [self.read_json_data(c) for c in changed]
+        failed = []
+        for (index, jfile_stat), j_data in zip(changed, j_datas):
+            try:
+                if isinstance(j_data, OSError):
+                    raise j_data
+                jfiles.append(self.decode_json_file(index, jfile_stat, j_data))
+            except (OSError, ValueError) as e:
+                # e.g. a json file read while the collector was still writing it,
+                # it keeps its modification time and is checked again on the next load
+                failed.append(index)
+                print(fct + " json file could not be loaded: " + self.json_files[index][1] + ": " + str(e))
+        if failed and watcher is not None and watcher.active:
+            watcher.mark_dirty(failed)
+        return jfiles, time.perf_counter() - t0
+
+    ############################################################################
+    def read_snapshot(self, indexes):
+        """ map the snapshot again if it was replaced and return the sections of the
+            json files indexes that changed since they were loaded, see wita_pi_snapshot.py
+            sections are not parsed, values are read from the mapped snapshot on lookup.
+            return: jfiles: list of sections read, like decode_json_file()
+                    indexes: json_files indexes not in the snapshot, to load from their json files
+        """
+        fct = " pi_energy.read_snapshot() "
+        if self.watcher is None or not self.watcher.active or self.watcher.take_dirty(["S"]):
+            path_to_snapshot = self.path_to_energy_files + '/' + self.snapshot_name
+            try:
+                s_stat = os.stat(path_to_snapshot)
+            except OSError:
+                s_stat = None
+            if s_stat is None:
+                # no snapshot (any more), the json files are loaded instead
+                self.snapshot = None
+                self.snapshot_stat = None
+                self.snapshot_loaded = {}
+            elif self.snapshot_stat != (s_stat.st_ino, s_stat.st_mtime):
+                try:
+                    from .wita_pi_snapshot import pi_snapshot
+                except ImportError:
+                    from wita_pi_snapshot import pi_snapshot
+                try:
+                    self.snapshot = pi_snapshot(path_to_snapshot)
+                    self.snapshot_stat = (s_stat.st_ino, s_stat.st_mtime)
+                except (OSError, ValueError) as e:
+                    print(fct + " snapshot could not be loaded: " + str(e))
+                    if self.watcher is not None and self.watcher.active:
+                        self.watcher.mark_dirty(["S"])
+        if self.snapshot is None:
+            return [], indexes
+        jfiles = []
+        remaining = []
+        for index in indexes:
+            section = self.snapshot.sections.get(self.json_files[index][0])
+            if section is None:
+                remaining.append(index)
+                continue
+            self.json_files_missing.discard(index)
+            if self.snapshot_loaded.get(index) != (section.generation, section.crc):
+                self.snapshot_loaded[index] = (section.generation, section.crc)
+                jfiles.append([index, self.snapshot_stat[1], 0, section, section, 0])
+        return jfiles, remaining
+
+    ############################################################################
+    def check_json_file(self, index):
+        """ check if the json file self.json_files[index] was modified since last load
+            return: None if the json file was not modified or is missing, else its os.stat()
+        """
+        fct = " pi_energy.check_json_file() "
+        jfile_ctl = self.json_files[index]
+        path_to_file = self.path_to_energy_files + '/' + jfile_ctl[1]
+        try:
+            jfile_stat = os.stat(path_to_file)
+        except OSError:
+            if index not in self.json_files_missing:
+                self.json_files_missing.add(index)
                 print(fct + " json file could not be loaded: " + path_to_file)
-        #print('\n')
-        #print(fct + " json_files hash: \n")
-        #pprint(self.json_files)
+            return None
+        self.json_files_missing.discard(index)
+        if jfile_ctl[3] == jfile_stat.st_mtime:
+            return None
+        #jfile modification time is different to last load, or jfile was not yet loaded
+        return jfile_stat
 
     ############################################################################
-    def lookup_PV_item(self, item_key, jdict):
-        fct = " pi_energy.lookup_PV_item() "
+    def read_json_data(self, changed):
+        """ read the changed json file (index, os.stat()) as bytes in one call.
+            return: bytes, or None if the json file is to be mapped by decode_json_file(),
+                    or the OSError if it could not be read, see read_json_files()
+        """
+        index, jfile_stat = changed
+        if self.json_decoder[2] and jfile_stat.st_size >= self.json_mmap_size:
+            return None
+        try:
+            with open(self.path_to_energy_files + '/' + self.json_files[index][1], "rb") as j_handle:
+                return j_handle.read()
+        except OSError as e:
+            return e
+
+    ############################################################################
+    def decode_json_file(self, index, jfile_stat, j_data):
+        """ decode the json file self.json_files[index] by self.json_decoder and build its lookup index.
+            j_data are its bytes as read by read_json_data(), None to map the json file instead
+            return: [index, jfile modification time, bytes, json dict, lookup index, parse time]
+        """
+        t0 = time.perf_counter()
+        jfile_ctl = self.json_files[index]
+        name, loads, loads_buffer = self.json_decoder
+        # decoding creates lots of objects that all survive, the garbage collector
+        # would scan them again and again, so it is paused meanwhile
+        pi_gc_pause()
+        try:
+            if j_data is None:
+                import mmap
+                with open(self.path_to_energy_files + '/' + jfile_ctl[1], "rb") as j_handle:
+                    with mmap.mmap(j_handle.fileno(), 0, access=mmap.ACCESS_READ) as j_map:
+                        with memoryview(j_map) as j_view:
+                            jdict = loads(j_view)
+            else:
+                jdict = loads(j_data)
+            jindex = self.index_json_dict(jfile_ctl[0], jdict)
+        finally:
+            pi_gc_resume()
+        return [index, jfile_stat.st_mtime, jfile_stat.st_size, jdict, jindex, time.perf_counter() - t0]
+
+    ############################################################################
+    def install_json_files(self, jfiles, load_time):
+        """ make the json files read by read_json_files() the loaded ones
+            and prerender the answers that depend on them.
+            if the answers cannot be rendered, e.g. a json file has records of the wrong
+            shape, the json files loaded before are kept and the answers rendered from
+            the new json files are dropped from the caches.
+            the caller must hold self.lock
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy.install_json_files() "
+        loaded = set()
+        previous = {}
+        for index, jfile_mtime, jfile_size, jdict, jindex, parse_time in jfiles:
+            jfile_ctl = self.json_files[index]
+            previous[index] = (list(jfile_ctl), self.json_sizes.get(index))
+            jfile_ctl[2] = jdict
+            jfile_ctl[3] = jfile_mtime
+            jfile_ctl[4] = jindex
+            jfile_ctl[5] += 1
+            loaded.add(index)
+            self.json_sizes[index] = jfile_size
+            self.stats["reloads"][jfile_ctl[1]] = self.stats["reloads"].get(jfile_ctl[1], 0) + 1
+            self.stats["bytes_parsed"] += jfile_size
+            self.stats["parse_time"] += parse_time
+        self.stats["load"] += 1
+        self.stats["load_time"] += load_time
+        if loaded:
+            # the history answers are rendered with the values just loaded
+            self.record_history(jfiles)
+            try:
+                self.prerender(loaded)
+                self.check_watch_rules(loaded)
+            except Exception as e:
+                for index, (jfile_ctl, jfile_size) in previous.items():
+                    self.json_files[index][:] = jfile_ctl
+                    if jfile_size is None:
+                        self.json_sizes.pop(index, None)
+                    else:
+                        self.json_sizes[index] = jfile_size
+                for item, item_indexes in self.pi_query_files.items():
+                    if not item_indexes.isdisjoint(loaded):
+                        self.answer_cache.pop(item, None)
+                        self.function_cache.pop(item, None)
+                self.data_time = None
+                names = ", ".join([self.json_files[index][1] for index in sorted(loaded)])
+                return 1, fct + " " + names + " not installed, answers failed by " + repr(e) + "!"
+        return 0, fct + " success!"
+
+    ############################################################################
+    def json_file_index(self, jtype):
+        """ return the json_files index of the JSON-File-Type jtype, None if there is none """
+        for index, jfile_ctl in self.json_files.items():
+            if jfile_ctl[0] == jtype:
+                return index
+        return None
+
+    ############################################################################
+    def merge_records(self, jtype, jdict, records, replace=False):
+        """ merge the records pushed by a collector into the json dict jdict, see pi_merge_records() """
+        return pi_merge_records(jtype, jdict, records, replace)
+
+    ############################################################################
+    def ingest(self, jtype, records, replace=False, size=0):
+        """ install the records pushed by a collector for the JSON-File-Type jtype, see merge_records(),
+            like a reload of its json file, but without writing and parsing it.
+            the pushed records stay loaded until the json file (or the snapshot section) is written again.
+            size: bytes of the records as pushed
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy.ingest() "
+        t0 = time.perf_counter()
+        index = self.json_file_index(jtype)
+        if index is None:
+            return 1, fct + " unknown JSON-File-Type " + str(jtype) + "!"
+        jfile_ctl = self.json_files[index]
+        if jfile_ctl[5] == 0 and not replace:
+            # the pushed records are merged into the json file
+            self.load_json_files([index])
+        with self.lock:
+            jdict = jfile_ctl[2]
+            r, r_msg, jdict = self.merge_records(jtype, jdict, records, replace)
+            if r != 0:
+                return r, fct + " failed by " + r_msg
+            jindex = self.index_json_dict(jtype, jdict)
+            now = time.time()
+            jfile = [index, now, size, jdict, jindex, time.perf_counter() - t0]
+            r, r_msg = self.install_json_files([jfile], time.perf_counter() - t0)
+            if r != 0:
+                return 3, fct + " failed by " + r_msg
+            # the json file as it is now is older than the pushed records, it is loaded
+            # again only after it was written again
+            try:
+                jfile_ctl[3] = os.stat(self.path_to_energy_files + '/' + jfile_ctl[1]).st_mtime
+            except OSError:
+                jfile_ctl[3] = now
+            if not replace:
+                self.json_sizes[index] = max(size, self.json_sizes.get(index, 0))
+            self.json_files_missing.discard(index)
+            self.stats["pushes"] += 1
+        return 0, fct + " success! " + jtype + " generation " + str(jfile_ctl[5])
+
+    ############################################################################
+    def write_records(self, jtype, records, replace=False):
+        """ file mode of ingest(): merge the records into the json file of jtype and write it
+            atomically, see pi_write_records()
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        return pi_write_records(self.path_to_energy_files, jtype, records, replace)
+
+    ############################################################################
+    @property
+    def user(self):
+        """ name of the user running pi_energy, looked up on first use """
+        if self.user_name is None:
+            import pwd
+            self.user_name = pwd.getpwuid( os.getuid() ).pw_name
+        return self.user_name
+
+    ############################################################################
+    def loaded_bytes(self):
+        """ return the bytes of the json files currently loaded, an estimate of the memory they take.
+            sections of a snapshot are mapped rather than loaded and count 0
+        """
+        return sum(self.json_sizes.values())
+
+    ############################################################################
+    def memory_estimate(self):
+        """ return an estimate of the bytes the loaded json files and the caches take:
+            the json files parsed and indexed, json_memory_factor times their size,
+            and the cached answers and function results with their strings
+        """
+        size = self.loaded_bytes() * self.json_memory_factor
+        with self.lock:
+            for cache in (self.answer_cache, self.function_cache):
+                for gens, expires, result in cache.values():
+                    size += self.cache_entry_bytes + sys.getsizeof(result[1])
+                    rc_TTS = result[2]
+                    for text in (rc_TTS if isinstance(rc_TTS, list) else [rc_TTS]):
+                        size += sys.getsizeof(text)
+        return size
+
+    ############################################################################
+    def data_timestamp(self):
+        """ return the time (as time.time()) of the newest measurement of pvm-out-meter-total.json,
+            the collector notes it in every record after the value, e.g. "2023-01-26 15:34:10.082062".
+            None if the json file was not loaded or has no timestamps.
+            the result is kept until the json file is reloaded
+        """
+        jfile_ctl = self.json_files["5"]
+        with self.lock:
+            if self.data_time is not None and self.data_time[0] == jfile_ctl[5]:
+                return self.data_time[1]
+            newest = None
+            if jfile_ctl[5] != 0:
+                for key, record in jfile_ctl[2].items():
+                    if len(record) < 5:
+                        continue
+                    try:
+                        t = datetime.datetime.fromisoformat(str(record[4])).timestamp()
+                    except ValueError:
+                        continue
+                    if newest is None or t > newest:
+                        newest = t
+            self.data_time = (jfile_ctl[5], newest)
+        return newest
+
+    ############################################################################
+    def close(self):
+        """ stop the watcher and the json workers and close the history store.
+            pi_energy can still be queried after close(), it polls the json files,
+            reads them one after the other and no longer answers history items.
+        """
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.json_workers = 1
+        if self.json_executor is not None:
+            if self.json_executor_owned:
+                self.json_executor.shutdown(wait=False)
+            self.json_executor = None
+        with self.lock:
+            history = self.history
+            self.history = None
+        if history is not None:
+            history.close()
+
+    ############################################################################
+    def refresh(self):
+        """ load all json files that changed and prerender the answers that depend on them,
+            and the answers that depend on the current date and have expired.
+            meant to be called by a background refresher, so that queries find
+            their answers in memory. Reading json files does not block queries.
+        """
+        fct = " pi_energy.refresh() "
+        jfiles, load_time = self.read_json_files()
+        with self.lock:
+            r, r_msg = self.install_json_files(jfiles, load_time)
+            if r != 0:
+                print(fct + " failed by " + r_msg)
+            now = time.time()
+            expired = []
+            for item in self.pi_query_clock:
+                if item in self.answer_cache:
+                    expires = self.answer_cache[item][1]
+                    if expires is not None and expires <= now:
+                        expired.append(item)
+            if expired:
+                opened = self.open_context()
+                try:
+                    for item in expired:
+                        self.answer(item)
+                finally:
+                    self.close_context(opened)
+
+    ############################################################################
+    def index_json_dict(self, jtype, jdict):
+        """ build the lookup index of a json dict that was just loaded.
+            PV, CH and V json files are lists of records [key1, key2, unit, value, ...],
+            they are indexed by (key1, key2). If a key occurs more than once, the last
+            record wins.
+            HP json files are already keyed by the item, so the json dict is the index.
+
+            return: lookup index as dict
+        """
+        if jtype == "HPH" or jtype == "HPS" or jtype == "HPP":
+            return jdict
+        j_index = {}
+        for index, j_ctl in jdict.items():
+            j_index[(j_ctl[0], j_ctl[1])] = j_ctl
+        return j_index
+
+    ############################################################################
+    def split_item_key(self, item_key, maxsplit):
+        """ split item_key into the (key1, key2) tuple used by the lookup index.
+            results are cached, item keys are a small and fixed set.
+        """
+        key = (item_key, maxsplit)
+        if key not in self.json_item_keys:
+            self.json_item_keys[key] = tuple(item_key.split(None if maxsplit == -1 else ' ', maxsplit))
+        return self.json_item_keys[key]
+
+    ############################################################################
+    def lookup_record_item(self, fct, item_key, jindex, maxsplit):
+        """ lookup item_key in the lookup index of a PV, CH or V json file
+            and return parameters unit, value, description
+        """
         rc = 1
         rc_m = fct + " item " + item_key + " not found!"
         unit = ""
         value = ""
         descr = ""
-        key1, key2 = item_key.split()
-        for index, pv_ctl in jdict.items():
-            if pv_ctl[0] == key1 and pv_ctl[1] == key2:
-                unit = pv_ctl[2]
-                value = pv_ctl[3]
-                desc = pv_ctl[0] + ' ' + pv_ctl[1]
-                rc = 0
-                rc_m = fct + " success!"
+        key = self.split_item_key(item_key, maxsplit)
+        if key in jindex:
+            j_ctl = jindex[key]
+            unit = j_ctl[2]
+            value = j_ctl[3]
+            descr = j_ctl[0] + ' ' + j_ctl[1]
+            rc = 0
+            rc_m = fct + " success!"
         return rc, rc_m, unit, value, descr
 
     ############################################################################
-    def lookup_HP_item(self, item_key, jdict):
+    def lookup_PV_item(self, item_key, jindex):
+        fct = " pi_energy.lookup_PV_item() "
+        return self.lookup_record_item(fct, item_key, jindex, -1)
+
+    ############################################################################
+    def lookup_HP_item(self, item_key, jindex):
         fct = " pi_energy.lookup_HP_item() "
         rc = 1
         rc_m = fct  +" item " + item_key + " not found!"
         unit = ""
         value = ""
         descr = ""
-        if item_key in jdict:
-            item = jdict[item_key]
+        if item_key in jindex:
+            item = jindex[item_key]
             unit = item[0]
             value = item[1]
             descr = item[2]
@@ -494,52 +1739,21 @@ class pi_energy:
         return rc, rc_m, unit, value, descr
 
     ############################################################################
-    def lookup_V_item(self, item_key, jdict):
+    def lookup_V_item(self, item_key, jindex):
         fct = " pi_energy.lookup_V_item() "
-        rc = 1
-        rc_m = fct + " item " + item_key + " not found!"
-        unit = ""
-        unit = ""
-        value = ""
-        descr = ""
-        key1, key2 = item_key.split(' ', 1)
-        for index, v_ctl in jdict.items():
-            if v_ctl[0] == key1 and v_ctl[1] == key2:
-                unit = v_ctl[2]
-                value = v_ctl[3]
-                desc = v_ctl[0] + ' ' + v_ctl[1]
-                rc = 0
-                rc_m = fct + " success!"
-        return rc, rc_m, unit, value, descr
+        return self.lookup_record_item(fct, item_key, jindex, 1)
 
     ############################################################################
-    def lookup_CH_item(self, item_key, jdict):
+    def lookup_CH_item(self, item_key, jindex):
         fct = " pi_energy.lookup_CH_item() "
-        rc = 1
-        rc_m = fct + " item " + item_key + " not found!"
-        unit = ""
-        unit = ""
-        unit = ""
-        value = ""
-        descr = ""
-        #print("lookup_CH_item " + item_key)
-        #pprint(jdict)
-        key1, key2 = item_key.split(' ', 1)
-        for index, ch_ctl in jdict.items():
-            if ch_ctl[0] == key1 and ch_ctl[1] == key2:
-                unit = ch_ctl[2]
-                value = ch_ctl[3]
-                desc = ch_ctl[0] + ' ' + ch_ctl[1]
-                rc = 0
-                rc_m = fct + " success!"
-        return rc, rc_m, unit, value, descr
+        return self.lookup_record_item(fct, item_key, jindex, 1)
 
     ############################################################################
-    def lookup_item(self, item_key, jtype, jdict):
-        """ lookup item_key in json dictionary jdict and return parameters
+    def lookup_item(self, item_key, jtype, jindex):
+        """ lookup item_key in the lookup index jindex of a json file and return parameters
                 unit, value, description
-            jtype specifies the type of the dict:  HPH, HPS, HPP, PVM, PVT, CH, V
-            searching item_key and retrieving parameters depends on the jtype
+            jtype specifies the type of the json file:  HPH, HPS, HPP, PVM, PVT, CH, V
+            the lookup method depends on the jtype, see self.json_lookup
 
             return: rc:      return code 0=ok else error
                     rc_m:    return message
@@ -548,24 +1762,11 @@ class pi_energy:
                     descr:   description of the searched item
         """
         fct = " pi_energy.lookup_item() "
-        rc = 0
-        rc_m = fct + " success!"
-        unit = ""
-        value = ""
-        descr = ""
-
-        if jtype == "PVT" or jtype == "PVM":
-            rc, rc_m, unit, value, descr = self.lookup_PV_item(item_key, jdict)
-        elif jtype == "CH":
-            rc, rc_m, unit, value, descr = self.lookup_CH_item(item_key, jdict)
-        elif jtype == "V":
-            rc, rc_m, unit, value, descr = self.lookup_V_item(item_key, jdict)
-        elif jtype == "HPH" or jtype == "HPS" or jtype == "HPP":
-            rc, rc_m, unit, value, descr = self.lookup_HP_item(item_key, jdict)
-        else:
-            rc = 99
-            rc_m = fct + " invalid jtype " + jtype + " !"
-        return rc, rc_m, unit, value, descr
+        if jtype in self.json_lookup:
+            return self.json_lookup[jtype](item_key, jindex)
+        rc = 99
+        rc_m = fct + " invalid jtype " + jtype + " !"
+        return rc, rc_m, "", "", ""
 
     ############################################################################
 
@@ -578,6 +1779,60 @@ class pi_energy:
         except:
             return False
 
+    ############################################################################
+    def split_template(self, parts, placeholder, token):
+        """ split the text parts of a template at placeholder and insert token instead """
+        split_parts = []
+        for part in parts:
+            if isinstance(part, str) and placeholder in part:
+                texts = part.split(placeholder)
+                for text in texts[:-1]:
+                    if text:
+                        split_parts.append(text)
+                    split_parts.append(token)
+                if texts[-1]:
+                    split_parts.append(texts[-1])
+            else:
+                split_parts.append(part)
+        return split_parts
+
+    ############################################################################
+    def compile_template(self, TTS_template):
+        """ compile a TTS_template into a sequence of text parts and placeholder tokens,
+            see markup_item() for the placeholders. Translations of %%S and %%B terms via
+            self.TTS_dict are resolved here, so markup_item() renders in a single pass.
+            compiled templates are kept in self.tts_templates.
+
+            return: compiled template (signed, tokens)
+                    signed: True if a signed value is marked up by %%S
+                    tokens: list of text parts (str) and placeholder tokens (tuple)
+        """
+        if TTS_template in self.tts_templates:
+            return self.tts_templates[TTS_template]
+        signed = False
+        tokens = [TTS_template]
+        if '$$V' in TTS_template:
+            index = TTS_template.find('%%S')
+            if index != -1:
+                # verb for a signed (positiv/negative) value, kept as is if the value is no float
+                term = TTS_template[index+3:].split(' ', 1)[0]
+                token = ("S", self.TTS_dict.get('%%P' + term, term), self.TTS_dict.get('%%N' + term, term), '%%S' + term)
+                tokens = self.split_template(tokens, '%%S' + term, token)
+                signed = True
+            tokens = self.split_template(tokens, '$$V', ("V",))
+        # translatable value, formatted like $$V if the template has a $$V
+        tokens = self.split_template(tokens, '$$T', ("T", '$$V' in TTS_template))
+        tokens = self.split_template(tokens, '%%U', ("U",))
+        index = TTS_template.find('%%B')
+        if index != -1:
+            # bool expression
+            term = TTS_template[index+3:].split(' ', 1)[0]
+            token = ("B", self.TTS_dict.get('%%T' + term, term), self.TTS_dict.get('%%F' + term, term))
+            tokens = self.split_template(tokens, '%%B' + term, token)
+        compiled = (signed, tokens)
+        self.tts_templates[TTS_template] = compiled
+        return compiled
+
     ############################################################################
     def markup_item(self, TTS_template, unit, value, description):
         """ markup a TTS_template for TTS speach output.
@@ -592,83 +1847,69 @@ class pi_energy:
                          look for %%Tactive resp. %%Factive in the self.TTS_dict and  for
                                   %%Tloaded resp. %%Floaded
                  NOTE: per TTS_template at most one $$V, one %%U and one %%Bxxx placeholder is supported
+            the TTS_template is compiled once by compile_template()
 
             return: r = 0 ok, else error,
                     rc_m return message,
                     rc_TTS = TTS-ready speach output
         """
         fct = " pi_energy.markup_item() "
+        t0 = time.perf_counter()
         r = 0
         rc_msg = fct + " success!"
-        rc_TTS = ""
-        rc_TTS = TTS_template
+        signed, tokens = self.compile_template(TTS_template)
 
-        if self.is_float(str(value)):
-            v = round(float(str(value)), 2)
+        value = str(value)
+        try:
+            v = round(float(value), 2)
             value = str(v)
-        index = rc_TTS.find('$$V')
-        if index != -1:
-            index2 = rc_TTS.find('%%S')
-            if index2 != -1:
-                # markup verb for a signed (positiv/negative) value rc_TTS string
-                terms = rc_TTS[index2+3:].split(' ', 1)
-                if self.is_float(str(value)):
-                    if float(str(value)) >= 0:
-                        tmp1 = '%%P' + terms[0]
-                    else:
-                        tmp1 = '%%N' + terms[0]
-                        # value is negativ, switch to positiv
-                        v = float(str(value))
-                        value = str(-v)
-                    if tmp1 in self.TTS_dict:
-                        term_translated = self.TTS_dict[tmp1]
-                        rc_TTS = rc_TTS.replace('%%S'+ terms[0], term_translated)
-                    else:
-                        rc_TTS = rc_TTS.replace('%%S'+ terms[0], terms[0])
-            # markup value in rc_TTS string
-            value = str(value).replace(',', '')
-            value = str(value).replace('.', ',')
-            rc_TTS = rc_TTS.replace('$$V', value)
-
-        index = rc_TTS.find('$$T')
-        if index != -1:
-            # markup translatable value in rc_TTS string
-            if value in self.TTS_dict:
-                value_translated = self.TTS_dict[value]
-                rc_TTS = rc_TTS.replace('$$T', value_translated)
-            else:
-                rc_TTS = rc_TTS.replace('$$T', value)
-
-        index = rc_TTS.find('%%U')
-        if index != -1:
-            # markup unit in rc_TTS string
-            if unit in self.TTS_dict:
-                unit_translated = self.TTS_dict[unit]
-                rc_TTS = rc_TTS.replace('%%U', unit_translated)
-            else:
-                rc_TTS = rc_TTS.replace('%%U', unit)
-
-        index = rc_TTS.find('%%B')
-        if index != -1:
-            # markup bool expression in rc_TTS string
-            terms = rc_TTS[index+3:].split(' ', 1)
-            if str(value) == 'true':
-                tmp1 = '%%T' + terms[0]
-            else:
-                tmp1 = '%%F' + terms[0]
-            if tmp1 in self.TTS_dict:
-                term_translated = self.TTS_dict[tmp1]
-                rc_TTS = rc_TTS.replace('%%B'+ terms[0], term_translated)
-            else:
-                rc_TTS = rc_TTS.replace('%%B'+ terms[0], terms[0])
-
-        return r, rc_msg, rc_TTS
+            if signed and v < 0:
+                # value is negativ, switch to positiv
+                value = str(-v)
+        except ValueError:
+            v = None
+        v_text = value.replace(',', '').replace('.', ',')
+
+        rc_TTS = []
+        for token in tokens:
+            if isinstance(token, str):
+                rc_TTS.append(token)
+            elif token[0] == "V":
+                rc_TTS.append(v_text)
+            elif token[0] == "T":
+                t_text = v_text if token[1] else value
+                rc_TTS.append(self.TTS_dict.get(t_text, t_text))
+            elif token[0] == "U":
+                rc_TTS.append(self.TTS_dict.get(unit, unit))
+            elif token[0] == "S":
+                if v is None:
+                    rc_TTS.append(token[3])
+                elif v >= 0:
+                    rc_TTS.append(token[1])
+                else:
+                    rc_TTS.append(token[2])
+            elif token[0] == "B":
+                rc_TTS.append(token[1] if value == 'true' else token[2])
+        self.stats["render"] += 1
+        self.stats["render_time"] += time.perf_counter() - t0
+        return r, rc_msg, "".join(rc_TTS)
 
     ############################################################################
     def query_report(self, report):
         """ report about several energy items.
             "report" points to a list of item to be reported.
+            items and functions shared by the report items are evaluated once, see open_context()
         """
+        opened = self.open_context()
+        try:
+            rc, rc_msg, rc_TTS_array = self.markup_report(report)
+        finally:
+            self.close_context(opened)
+        return rc, rc_msg, rc_TTS_array
+
+    ############################################################################
+    def markup_report(self, report):
+        """ markup the TTS of all items of report, see query_report() """
         fct = " pi_energy.query_report() "
         rc = 0
         rc_msg = fct + "success!"
@@ -676,20 +1917,8 @@ class pi_energy:
         if report in self.pi_query_items_reports:
             report_ctl = self.pi_query_items_reports[report]
             for item in report_ctl:
-                r_c = 0
-                if item in self.pi_query_items_functions:
-                    pi_query_fct_ctrl = self.pi_query_items_functions[item]
-                    r_tts_template = pi_query_fct_ctrl[1][1]
-                    r_unit = pi_query_fct_ctrl[1][0]
-                    r_descr = ""
-                    r_c, rc_m, r_value = pi_query_fct_ctrl[0]()
-                else:
-                    r_c, r_msg, r_unit, r_value, r_descr, r_tts_template = self.query_item(item)
-
+                r_c, r_msg, rc_TTS = self.answer(item)
                 if r_c == 0:
-                    # markup answer TTS
-                    #                                     TTS_template,     unit, value, description
-                    r_c, r_msg, rc_TTS = self.markup_item(r_tts_template, r_unit, r_value, r_descr)
                     rc_TTS_array.append(rc_TTS)
                 #else:
                 #    print(fct + " could not find item " + item + " for report " + report)
@@ -698,8 +1927,188 @@ class pi_energy:
             rc_msg = fct + " rc= " + str(rc) + " requested report is not available!"
         return rc, rc_msg, rc_TTS_array
 
+    ############################################################################
+    def expire_at(self, expires):
+        """ note that the results of the current evaluation context depend on the
+            current date and expire at expires (datetime)
+        """
+        ctx = self.eval_ctx
+        if ctx is not None:
+            expires = expires.timestamp()
+            if ctx.expires is None or expires < ctx.expires:
+                ctx.expires = expires
+
+    ############################################################################
+    def answer(self, item):
+        """ answer the query item or report from self.answer_cache.
+            a cached answer is valid as long as the json files it depends on were not
+            reloaded (same generation) and, if it depends on the current date, it did not expire.
+            Otherwise the answer is rendered by markup_query() and cached.
+            must be called within an evaluation context, see open_context()
+
+            return: rc, rc_msg, rc_TTS resp. rc_TTS_array, see query()
+        """
+        if item not in self.pi_query_files:
+            return self.markup_query(item)
+        gens = self.cache_gens(item)
+        if item in self.answer_cache:
+            cache_gens, expires, result = self.answer_cache[item]
+            if cache_gens == gens and (expires is None or time.time() < expires):
+                self.stats["cache_hits"] += 1
+                return result
+        self.stats["cache_misses"] += 1
+        result = self.markup_query(item)
+        expires = None
+        if item in self.pi_query_clock:
+            expires = self.eval_ctx.expires
+        self.answer_cache[item] = (gens, expires, result)
+        return result
+
+    ############################################################################
+    def prerender(self, indexes):
+        """ render the answers of all query items and reports that depend on
+            the json files indexes, so that the following queries are cache hits.
+            answers that depend on json files that were not loaded yet are left
+            to their first query.
+        """
+        opened = self.open_context()
+        try:
+            # the functions first, in topological order, the answers then find them in the context
+            for item in self.pi_query_functions_order:
+                item_indexes = self.pi_query_files[item]
+                if not item_indexes.isdisjoint(indexes):
+                    for index in item_indexes:
+                        if self.json_files[index][5] == 0:
+                            break
+                    else:
+                        self.query_function(item)
+            for item, item_indexes in self.pi_query_files.items():
+                if not item_indexes.isdisjoint(indexes):
+                    for index in item_indexes:
+                        if self.json_files[index][5] == 0:
+                            break
+                    else:
+                        self.answer(item)
+        finally:
+            self.close_context(opened)
+
+    ############################################################################
+    def open_context(self):
+        """ open a request scoped evaluation context unless one is open already.
+            return: True if the context was opened by this call and must be closed
+                    by close_context()
+        """
+        if self.eval_ctx is not None:
+            return False
+        self.eval_ctx = pi_energy_context()
+        return True
+
+    ############################################################################
+    def close_context(self, opened):
+        """ close the evaluation context if it was opened by the respective open_context() """
+        if opened:
+            self.eval_ctx = None
+
+    ############################################################################
+    def query_function(self, item):
+        """ calculate the function item of self.pi_query_items_functions.
+            within an evaluation context every function is calculated only once.
+            return: rc = 0 ok, else error
+                    rc_msg return message
+                    r_value calculated value as string
+        """
+        ctx = self.eval_ctx
+        if ctx is not None and item in ctx.functions:
+            self.stats["context_hits"] += 1
+            return ctx.functions[item]
+        # a result is valid until the json files the function depends on are reloaded
+        # or, if it depends on the current date, it expires
+        gens = self.cache_gens(item)
+        if ctx is not None and item in self.function_cache:
+            cache_gens, expires, result = self.function_cache[item]
+            if cache_gens == gens and (expires is None or time.time() < expires):
+                self.stats["function_hits"] += 1
+                if expires is not None and (ctx.expires is None or expires < ctx.expires):
+                    ctx.expires = expires
+                ctx.functions[item] = result
+                return result
+        t0 = time.perf_counter()
+        function, template, inputs = self.pi_query_items_functions[item]
+        # the expiry of this function and its inputs is collected apart from the context's
+        outer_expires = None
+        if ctx is not None:
+            outer_expires = ctx.expires
+            ctx.expires = None
+        try:
+            result = function(*[self.query_input(i) for i in inputs])
+        finally:
+            if ctx is not None:
+                expires = ctx.expires
+                if outer_expires is not None and (expires is None or outer_expires < expires):
+                    ctx.expires = outer_expires
+        self.stats["functions"] += 1
+        self.stats["function_time"] += time.perf_counter() - t0
+        if ctx is not None:
+            ctx.functions[item] = result
+            self.function_cache[item] = (gens, expires, result)
+        return result
+
+    ############################################################################
+    def query_input(self, item):
+        """ evaluate the input item of a function, see pi_query_items_functions
+            return: rc = 0 ok, else error
+                    rc_msg return message
+                    r_value value of the item as string, the current datetime for "now"
+        """
+        if item == "now":
+            return 0, "success", datetime.datetime.now()
+        if item in self.pi_query_items_functions:
+            return self.query_function(item)
+        r, r_msg, r_unit, r_value, r_descr, r_tts = self.query_item(item)
+        return r, r_msg, r_value
+
+    ############################################################################
+    def query_functions_order(self):
+        """ return the functions of pi_query_items_functions in topological order:
+            every function follows the functions it takes as inputs.
+            raise ValueError if the inputs of functions form a cycle
+        """
+        order = []
+        state = {}   # function -> 1 while its inputs are visited, 2 when done
+        def visit(item):
+            if state.get(item) == 2:
+                return
+            if state.get(item) == 1:
+                raise ValueError(" pi_energy.query_functions_order()  inputs of " + item + " form a cycle!")
+            state[item] = 1
+            for i in self.pi_query_items_functions[item][2]:
+                if i in self.pi_query_items_functions:
+                    visit(i)
+            state[item] = 2
+            order.append(item)
+        for item in self.pi_query_items_functions:
+            visit(item)
+        return order
+
     ############################################################################
     def query_item(self, item):
+        """ search item and return its value, unit and description, see retrieve_item().
+            within an evaluation context every item is retrieved only once.
+        """
+        ctx = self.eval_ctx
+        if ctx is not None and item in ctx.items:
+            self.stats["context_hits"] += 1
+            return ctx.items[item]
+        t0 = time.perf_counter()
+        result = self.retrieve_item(item)
+        self.stats["lookups"] += 1
+        self.stats["lookup_time"] += time.perf_counter() - t0
+        if ctx is not None:
+            ctx.items[item] = result
+        return result
+
+    ############################################################################
+    def retrieve_item(self, item):
         """ search item and return its value, unit and description
             searched item must be one of self.pi_query_items, pi_query_items_static or self.pi_query_items_patch
             in case of static, the item values are retrieved from a static (hard coded) hash
@@ -747,9 +2156,9 @@ class pi_energy:
                 jfile_ctl = self.json_files[pi_query_ctrl[0]]
                 if jfile_ctl[3] != 0:
                     # json file was loaded
-                    # lookup item in json dict (jfile_ctl[2]) and return parameters
-                    #                                              item,        jtype,        jdict
-                    r, rc_m, unit, value, descr = self.lookup_item(search_item, jfile_ctl[0], jfile_ctl[2])
+                    # lookup item in lookup index (jfile_ctl[4]) and return parameters
+                    #                                              item,        jtype,        jindex
+                    r, rc_m, unit, value, descr = self.lookup_item(search_item, jfile_ctl[0], jfile_ctl[4])
                     if r == 0:
                         r_unit = unit
                         r_value = value
@@ -771,20 +2180,380 @@ class pi_energy:
     ############################################################################
     def query(self, item):
         """ search item in json files and markup an according answer TTS (text-to-speach) for Picroft
+            the query is answered within one evaluation context, see open_context(),
+            answers are cached until the json files they depend on change, see answer()
             return: rc = 0, ok else error
                     rc_msg  return message
                     rc_TTS  single text-to-speech answer to the query or
                     rc_TTS_array an array of answers
         """
+        t0 = time.perf_counter()
+        indexes = self.pi_query_files.get(item, ())
+        if not self.load_on_query:
+            # json files are kept up to date by refresh(), load those only that were never loaded
+            indexes = [index for index in indexes
+                       if self.json_files[index][5] == 0 and index not in self.json_files_missing]
+        with self.lock:
+            # load json files the item depends on that have not been loaded yet or have been updated since last query
+            if indexes:
+                self.load_json_files(indexes)
+
+            opened = self.open_context()
+            try:
+                return self.answer(item)
+            finally:
+                self.close_context(opened)
+                self.stats["queries"] += 1
+                self.stats["query_time"] += time.perf_counter() - t0
+
+    ############################################################################
+    def query_stream(self, item):
+        """ answer the query item like query(), as a generator of (rc, rc_msg, rc_TTS)
+            a report yields each of its answers as soon as it is rendered, so the first
+            answer can be spoken while the following ones are still calculated.
+            the items of the report share one evaluation context, the lock is only held
+            while an answer is rendered. The complete report is cached like by query().
+            items that are not reports yield their single answer.
+        """
+        if item not in self.pi_query_items_reports:
+            yield self.query(item)
+            return
+        fct = " pi_energy.query_report() "
+        t0 = time.perf_counter()
+        indexes = self.pi_query_files[item]
+        if not self.load_on_query:
+            indexes = [index for index in indexes
+                       if self.json_files[index][5] == 0 and index not in self.json_files_missing]
+        with self.lock:
+            if indexes:
+                self.load_json_files(indexes)
+            gens = self.cache_gens(item)
+            result = None
+            if item in self.answer_cache:
+                cache_gens, expires, result = self.answer_cache[item]
+                if cache_gens != gens or (expires is not None and time.time() >= expires):
+                    result = None
+            if result is not None:
+                self.stats["cache_hits"] += 1
+                self.stats["queries"] += 1
+                self.stats["query_time"] += time.perf_counter() - t0
+        if result is not None:
+            for rc_TTS in result[2]:
+                yield result[0], result[1], rc_TTS
+            return
+        ctx = pi_energy_context()
+        rc_TTS_array = []
+        for report_item in self.pi_query_items_reports[item]:
+            with self.lock:
+                outer_ctx = self.eval_ctx
+                self.eval_ctx = ctx
+                try:
+                    r_c, r_msg, rc_TTS = self.answer(report_item)
+                finally:
+                    self.eval_ctx = outer_ctx
+            if r_c == 0:
+                rc_TTS_array.append(rc_TTS)
+                yield 0, fct + "success!", rc_TTS
+        with self.lock:
+            expires = ctx.expires if item in self.pi_query_clock else None
+            self.answer_cache[item] = (gens, expires, (0, fct + "success!", rc_TTS_array))
+            self.stats["cache_misses"] += 1
+            self.stats["queries"] += 1
+            self.stats["query_time"] += time.perf_counter() - t0
+
+    ############################################################################
+    def query_many(self, items):
+        """ answer the query items like query(), in one pass:
+            the json files all items depend on are checked and loaded once, and all
+            items are answered within one evaluation context, so shared inputs are
+            retrieved and calculated only once.
+            return: list of (rc, rc_msg, rc_TTS) in the order of items, see query()
+        """
+        t0 = time.perf_counter()
+        items = list(items)
+        indexes = set()
+        for item in items:
+            indexes.update(self.pi_query_files.get(item, ()))
+        if not self.load_on_query:
+            indexes = [index for index in indexes
+                       if self.json_files[index][5] == 0 and index not in self.json_files_missing]
+        with self.lock:
+            if indexes:
+                self.load_json_files(sorted(indexes))
+            answers = []
+            opened = self.open_context()
+            try:
+                for item in items:
+                    answers.append(self.answer(item))
+            finally:
+                self.close_context(opened)
+                self.stats["queries"] += len(items)
+                self.stats["query_time"] += time.perf_counter() - t0
+        return answers
+
+    ############################################################################
+    def index_watch_rules(self):
+        """ map the json_files indexes to the watch rules that check them, see self.pi_watch_files """
+        self.pi_watch_files = {}
+        for name, pi_watch_ctrl in self.pi_watch_rules.items():
+            for index in self.pi_query_files.get(pi_watch_ctrl[0], ()):
+                self.pi_watch_files.setdefault(index, []).append(name)
+
+    ############################################################################
+    def add_watch_rule(self, name, item, kind, condition, TTS_template):
+        """ add or replace the watch rule name, see self.pi_watch_rules
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy.add_watch_rule() "
+        if item not in self.pi_query_files or item in self.pi_query_items_reports:
+            return 1, fct + " item " + str(item) + " cannot be watched!"
+        if kind == "threshold":
+            if not isinstance(condition, (tuple, list)) or len(condition) != 2 or \
+               condition[0] not in ("<", "<=", ">", ">=") or not self.is_float(condition[1]):
+                return 2, fct + " threshold condition must be (operator, limit)!"
+        elif kind == "transition":
+            if not isinstance(condition, (tuple, list)) or len(condition) != 2:
+                return 2, fct + " transition condition must be (from, to)!"
+        elif kind == "flip":
+            if condition not in (True, False, None):
+                return 2, fct + " flip condition must be True, False or None!"
+        else:
+            return 3, fct + " unknown kind " + str(kind) + " of rule " + name + "!"
+        with self.lock:
+            self.compile_template(TTS_template)
+            self.pi_watch_rules[name] = (item, kind, tuple(condition) if kind != "flip" else condition,
+                                         TTS_template)
+            self.watch_state.pop(name, None)
+            self.index_watch_rules()
+            # the value seen now is the one the rule compares the next reload with
+            if all(self.json_files[index][5] != 0 for index in self.pi_query_files[item]):
+                opened = self.open_context()
+                try:
+                    r, r_msg, unit, value = self.watch_value(item)
+                finally:
+                    self.close_context(opened)
+                if r == 0:
+                    self.watch_state[name] = value
+        return 0, fct + " success!"
+
+    ############################################################################
+    def remove_watch_rule(self, name):
+        with self.lock:
+            self.pi_watch_rules.pop(name, None)
+            self.watch_state.pop(name, None)
+            self.index_watch_rules()
+
+    ############################################################################
+    def watch_value(self, item):
+        """ return rc, rc_msg, unit and value of the watched item, functions included """
+        if item in self.pi_query_items_functions:
+            r, r_msg, r_value = self.query_function(item)
+            return r, r_msg, self.pi_query_items_functions[item][1][0], r_value
+        r, r_msg, r_unit, r_value, r_descr, r_tts = self.query_item(item)
+        return r, r_msg, r_unit, r_value
+
+    ############################################################################
+    def watch_bool(self, value):
+        """ return the bool of a value as found in json files, None if it is no bool, e.g. "NA" """
+        value = str(value).lower()
+        if value in ("true", "1", "on"):
+            return True
+        if value in ("false", "0", "off"):
+            return False
+        return None
+
+    ############################################################################
+    def watch_fires(self, kind, condition, old, new):
+        """ return True if a rule of kind with condition fires as its value changed from old to new """
+        if kind == "threshold":
+            if not self.is_float(old) or not self.is_float(new):
+                return False
+            op, limit = condition
+            limit = float(limit)
+            check = {"<": lambda v: v < limit, "<=": lambda v: v <= limit,
+                     ">": lambda v: v > limit, ">=": lambda v: v >= limit}[op]
+            return check(float(new)) and not check(float(old))
+        if kind == "transition":
+            return old != new and new == condition[1] and (condition[0] is None or old == condition[0])
+        if kind == "flip":
+            old = self.watch_bool(old)
+            new = self.watch_bool(new)
+            return old is not None and new is not None and old != new and (condition is None or new == condition)
+        return False
+
+    ############################################################################
+    def check_watch_rules(self, indexes):
+        """ check the watch rules on items that depend on the json files indexes just reloaded
+            and queue the announcements of the rules that fire, see take_notifications().
+            rules on json files that were not reloaded are not checked at all.
+            the caller must hold self.lock
+        """
+        names = set()
+        for index in indexes:
+            names.update(self.pi_watch_files.get(index, ()))
+        if not names:
+            return
+        opened = self.open_context()
+        try:
+            for name in sorted(names):
+                item, kind, condition, TTS_template = self.pi_watch_rules[name]
+                if any(self.json_files[index][5] == 0 for index in self.pi_query_files[item]):
+                    continue
+                self.stats["rule_checks"] += 1
+                r, r_msg, unit, value = self.watch_value(item)
+                if r != 0:
+                    continue
+                old = self.watch_state.get(name)
+                self.watch_state[name] = value
+                if old is None or not self.watch_fires(kind, condition, old, value):
+                    continue
+                r, r_msg, rc_TTS = self.markup_item(TTS_template, unit, value, "")
+                self.stats["notifications"] += 1
+                self.notifications.append((name, rc_TTS))
+                del self.notifications[:-self.notifications_max]
+        finally:
+            self.close_context(opened)
+
+    ############################################################################
+    def take_notifications(self):
+        """ return and forget the announcements of the watch rules fired since the last call
+            return: list of (rule name, rc_TTS) in the order they fired
+        """
+        with self.lock:
+            notifications = self.notifications
+            self.notifications = []
+        return notifications
+
+    ############################################################################
+    def new_stats(self):
+        """ return new, zeroed timings and counters of the query stages
+                queries, query_time:       queries answered and their total time
+                load, load_time:           checks for json files to (re)load and their time,
+                                           including parsing
+                reloads:                   hash of json filename to number of loads
+                bytes_parsed:              bytes of all json files loaded
+                parse_time:                time spent decoding and indexing json files
+                lookups, lookup_time:      items retrieved from json files or static items
+                functions, function_time:  calc_*() functions calculated, including their lookups
+                function_hits:             function results reused as their inputs did not change
+                context_hits:              items and functions answered by the evaluation context
+                rule_checks, notifications: watch rules checked after reloads and rules fired
+                pushes:                    records pushed by collectors, see ingest()
+                cache_hits, cache_misses:  answers found resp. not found in the answer cache
+                render, render_time:       TTS templates marked up
+            times are in seconds
+        """
+        return {
+            "queries": 0, "query_time": 0.0,
+            "load": 0, "load_time": 0.0,
+            "reloads": {}, "bytes_parsed": 0, "parse_time": 0.0,
+            "lookups": 0, "lookup_time": 0.0,
+            "functions": 0, "function_time": 0.0, "function_hits": 0,
+            "context_hits": 0,
+            "rule_checks": 0, "notifications": 0, "pushes": 0,
+            "cache_hits": 0, "cache_misses": 0,
+            "render": 0, "render_time": 0.0,
+        }
+
+    ############################################################################
+    def get_stats(self):
+        """ return a copy of the timings and counters of the query stages, see new_stats() """
+        stats = dict(self.stats)
+        stats["reloads"] = dict(self.stats["reloads"])
+        return stats
+
+    ############################################################################
+    def reset_stats(self):
+        """ zero the timings and counters of the query stages """
+        self.stats = self.new_stats()
+
+    ############################################################################
+    def stats_summary(self, stats=None):
+        """ return the timings and counters of the query stages as a single log line """
+        if stats is None:
+            stats = self.stats
+        summary = []
+        for key in ("queries", "load", "lookups", "functions", "function_hits", "context_hits", "cache_hits", "cache_misses",
+                    "render", "rule_checks", "notifications", "pushes", "bytes_parsed"):
+            summary.append(key + "=" + str(stats[key]))
+        for key in ("query_time", "load_time", "parse_time", "lookup_time", "function_time", "render_time"):
+            summary.append(key + "=" + str(round(stats[key] * 1000, 3)) + "ms")
+        summary.append("reloads=" + ",".join([f + ":" + str(n) for f, n in sorted(stats["reloads"].items())]))
+        return " ".join(summary)
+
+    ############################################################################
+    def explain(self, item):
+        """ answer the query item like query() and explain how it was answered.
+            return: hash with
+                "item", "kind":   the query item and whether it is a report, function, static or json item
+                "inputs":         items the function or report is calculated from, resp. the search key
+                "files":          json files it depends on, their generation and whether they
+                                  are missing or need to be checked for a reload
+                "clock":          True if the answer depends on the current date
+                "cache":          "hit", "stale" or "miss" of the answer cache before the query
+                "rc", "rc_msg", "rc_TTS": the result of query()
+                "stats":          timings and counters of this query, see new_stats()
+        """
+        plan = {"item": item}
+        if item in self.pi_query_items_reports:
+            plan["kind"] = "report"
+            plan["inputs"] = list(self.pi_query_items_reports[item])
+        elif item in self.pi_query_items_functions:
+            plan["kind"] = "function"
+            plan["inputs"] = list(self.pi_query_items_functions[item][2])
+        elif item in self.pi_query_items_static:
+            plan["kind"] = "static"
+            plan["inputs"] = []
+        elif item in self.pi_query_items_patch:
+            plan["kind"] = "patch"
+            plan["inputs"] = [self.pi_query_items_patch[item][0]]
+        elif item in self.pi_query_items:
+            plan["kind"] = "item"
+            plan["inputs"] = [item]
+        else:
+            plan["kind"] = "unknown"
+            plan["inputs"] = []
+        files = []
+        for index in sorted(self.pi_query_files.get(item, ())):
+            jfile_ctl = self.json_files[index]
+            dirty = self.watcher is None or not self.watcher.active or index in self.watcher.dirty
+            files.append({"file": jfile_ctl[1], "generation": jfile_ctl[5],
+                          "missing": index in self.json_files_missing, "check": dirty})
+        plan["files"] = files
+        plan["clock"] = item in self.pi_query_clock
+        plan["cache"] = "miss"
+        if item in self.answer_cache:
+            plan["cache"] = "stale"
+            cache_gens, expires, result = self.answer_cache[item]
+            gens = self.cache_gens(item)
+            if cache_gens == gens and (expires is None or time.time() < expires):
+                plan["cache"] = "hit"
+        with self.lock:
+            stats = self.stats
+            self.stats = self.new_stats()
+            try:
+                plan["rc"], plan["rc_msg"], plan["rc_TTS"] = self.query(item)
+            finally:
+                plan["stats"] = self.stats
+                for key, value in self.stats.items():
+                    if key == "reloads":
+                        for f, n in value.items():
+                            stats["reloads"][f] = stats["reloads"].get(f, 0) + n
+                    else:
+                        stats[key] += value
+                self.stats = stats
+        return plan
+
+    ############################################################################
+    def markup_query(self, item):
+        """ markup the TTS answer to the query item, see query() """
         fct = " pi_energy.query() "
         rc = 1
         rc_msg = fct + " success!"
         rc_TTS = ""
         rc_TTS_array = []
 
-        # load json files that have not been loaded yet or have been updated since last query
-        self.load_json_files()
-
         # lookup requested item in "reports" hash pi_query_items_reports
         if item in self.pi_query_items_reports:
             rc, rc_msg, rc_TTS_array = self.query_report(item)
@@ -793,7 +2562,7 @@ class pi_energy:
         # lookup requested item in "functional" hash pi_query_items_functions
         if item in self.pi_query_items_functions:
             pi_query_fct_ctrl = self.pi_query_items_functions[item]
-            r, rc_m, r_value = pi_query_fct_ctrl[0]()
+            r, rc_m, r_value = self.query_function(item)
             if r != 0:
                 rc_msg = fct + " cannot calculate item: " + item + " function failed by rc=" + str(r) + " rc_msg= " + rc_m + "!"
             else:
@@ -841,6 +2610,20 @@ if __name__ == "__main__":
         h31 = "                         default: outdoor "
         h32 = "                         -q AUTOTEST runs all supported queries"
         h33 = "                         -q summary creates a summary report "
+        h34 = "                  -b | --batch   read queries from stdin, one per line, and print"
+        h35 = "                         the answers as soon as they are answered"
+        h4  = "                  -H | --history <file> sqlite file of the history store"
+        h5  = "                  -S | --snapshot <filename> snapshot in the energy files folder"
+        h6  = "                  --serve        run as query server on the unix socket, see wita_pi_server.py"
+        h61 = "                  -s | --socket <path> unix socket of the query server"
+        h62 = "                         default: " + pi_energy_socket
+        h63 = "                         queries are sent to the server if one is listening"
+        h64 = "                  -l | --local   answer queries in this process, not by the server"
+        h7  = "                  --bench <n>    ask each query of AUTOTEST (or -q <query>) n times"
+        h71 = "                         and print min/median/p95/p99 in ms per query"
+        h8  = "                  --profile      print the top functions (cProfile) and the top"
+        h81 = "                         allocations (tracemalloc) of the run"
+        h9  = "                  --json         print the results as json, e.g. to compare Pi models"
         h99 = "wita_pi_energy.py version is: " + pvm_version
         print(h1)
         print(h2)
@@ -849,6 +2632,20 @@ if __name__ == "__main__":
         print(h31)
         print(h32)
         print(h33)
+        print(h34)
+        print(h35)
+        print(h4)
+        print(h5)
+        print(h6)
+        print(h61)
+        print(h62)
+        print(h63)
+        print(h64)
+        print(h7)
+        print(h71)
+        print(h8)
+        print(h81)
+        print(h9)
         print(h99)
         print("\n")
 
@@ -883,6 +2680,8 @@ if __name__ == "__main__":
             "stromspeicher Soc",
             "energy_consumption_today",
             "energy_autonomy_today",
+            "self_consumption_today",
+            "hp_share_today",
             "summary", # summary report about energy items
             "vehicle", # vehicle report
             "lease", # lease report
@@ -890,6 +2689,20 @@ if __name__ == "__main__":
             "heatpump",# heatpump report
             "grid",    # grid report
             "photovoltaik", # photovoltaik report
+            "pv_production_yesterday",
+            "pv_production_week",
+            "pv_production_month",
+            "pv_production_year",
+            "grid_consumption_yesterday",
+            "grid_feedin_yesterday",
+            "energy_autonomy_yesterday",
+            "energy_autonomy_week",
+            "energy_autonomy_month",
+            "hp_power_consumption_yesterday",
+            "vehicle_km_week",
+            "vehicle_km_month",
+            "vehicle_km_lease_year",
+            "history", # history report
         ]
 
     import traceback
@@ -904,10 +2717,88 @@ if __name__ == "__main__":
         else:
             print(tts)
 
+    try:
+        from wita_pi_server import pi_energy_socket, pi_energy_server, pi_energy_client
+    except ImportError:
+        from .wita_pi_server import pi_energy_socket, pi_energy_server, pi_energy_client
+
+    def percentile(samples, p):
+        """ return the p-th percentile (nearest rank) of the sorted list samples """
+        return samples[max(0, -(-len(samples) * p // 100) - 1)]
+
+    def bench_query(ask, query, runs):
+        """ ask query once (cold) and then runs times (warm)
+            return: hash of rc, first and min/median/p95/p99 durations of the warm runs in ms
+        """
+        t0 = time.perf_counter()
+        rc, rc_msg, rc_TTS = ask(query)
+        first = (time.perf_counter() - t0) * 1000
+        samples = []
+        for n in range(runs):
+            t0 = time.perf_counter()
+            ask(query)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        return {"query": query, "rc": rc, "runs": runs, "first_ms": round(first, 4),
+                "min_ms": round(samples[0], 4), "median_ms": round(percentile(samples, 50), 4),
+                "p95_ms": round(percentile(samples, 95), 4), "p99_ms": round(percentile(samples, 99), 4)}
+
+    def machine():
+        """ return the model of the Raspberry Pi, else the machine type """
+        try:
+            with open("/proc/device-tree/model") as m_handle:
+                return m_handle.read().strip("\0\n ")
+        except OSError:
+            import platform
+            return platform.machine()
+
+    def profile_report(profiler, top=25):
+        """ return hash of the top functions by cumulative time and the top allocations
+            of the run profiled by profiler and tracemalloc
+        """
+        import pstats
+        import tracemalloc
+        stats = pstats.Stats(profiler)
+        functions = []
+        for (filename, line, name), (cc, nc, tt, ct, callers) in stats.stats.items():
+            functions.append({"function": os.path.basename(filename) + ":" + str(line) + "(" + name + ")",
+                              "calls": nc, "tottime_ms": round(tt * 1000, 3), "cumtime_ms": round(ct * 1000, 3)})
+        functions.sort(key=lambda f: f["cumtime_ms"], reverse=True)
+        current, peak = tracemalloc.get_traced_memory()
+        allocations = []
+        for stat in tracemalloc.take_snapshot().statistics("lineno")[:top]:
+            frame = stat.traceback[0]
+            allocations.append({"line": os.path.basename(frame.filename) + ":" + str(frame.lineno),
+                                "bytes": stat.size, "count": stat.count})
+        tracemalloc.stop()
+        return {"functions": functions[:top], "memory": {"current_bytes": current, "peak_bytes": peak},
+                "allocations": allocations}
+
+    def print_profile(report):
+        print("\nprofile: top functions by cumulative time")
+        print("%10s %12s %12s  %s" % ("calls", "tottime ms", "cumtime ms", "function"))
+        for f in report["functions"]:
+            print("%10d %12.3f %12.3f  %s" % (f["calls"], f["tottime_ms"], f["cumtime_ms"], f["function"]))
+        print("\nprofile: memory current " + str(report["memory"]["current_bytes"]) + " bytes, peak "
+              + str(report["memory"]["peak_bytes"]) + " bytes, top allocations")
+        print("%12s %8s  %s" % ("bytes", "count", "line"))
+        for a in report["allocations"]:
+            print("%12d %8d  %s" % (a["bytes"], a["count"], a["line"]))
+
     try:
         # default path
         path_to_energy_files = "/opt/mycroft/skills/talk-to-me-skill/energy-files"
         query = "outdoor"
+        query_given = False
+        history = None
+        snapshot = None
+        serve = False
+        local = False
+        batch = False
+        bench = 0
+        profile = False
+        as_json = False
+        path_to_socket = pi_energy_socket
         for i in range(len(sys.argv)):
             if sys.argv[i] == "-h" or sys.argv[i] == "--help" or sys.argv[i] == "-?":
                 print_help()
@@ -916,22 +2807,130 @@ if __name__ == "__main__":
                 path_to_energy_files = sys.argv[i+1]
             if sys.argv[i] == "-q" or sys.argv[i] == "--query":
                 query = sys.argv[i+1]
-
-        print("\nwita_pi_energy: launching query " + query + " \n     for path_to_energy_files " + path_to_energy_files + "\n")
-
-        pi_e = pi_energy(path_to_energy_files)
-
-        if query == "AUTOTEST":
-            for query in test_queries:
-                rc, rc_msg, rc_TTS = pi_e.query(query)
+                query_given = True
+            if sys.argv[i] == "-H" or sys.argv[i] == "--history":
+                history = sys.argv[i+1]
+            if sys.argv[i] == "-S" or sys.argv[i] == "--snapshot":
+                snapshot = sys.argv[i+1]
+            if sys.argv[i] == "--serve":
+                serve = True
+            if sys.argv[i] == "-s" or sys.argv[i] == "--socket":
+                path_to_socket = sys.argv[i+1]
+            if sys.argv[i] == "-l" or sys.argv[i] == "--local":
+                local = True
+            if sys.argv[i] == "-b" or sys.argv[i] == "--batch":
+                batch = True
+            if sys.argv[i] == "--bench":
+                bench = int(sys.argv[i+1])
+            if sys.argv[i] == "--profile":
+                profile = True
+            if sys.argv[i] == "--json":
+                as_json = True
+
+        if serve:
+            print("\nwita_pi_energy: serving " + path_to_energy_files + " on " + path_to_socket + "\n")
+            pi_e = pi_energy(path_to_energy_files, watch=True, load_on_query=False,
+                             history=history, snapshot=snapshot)
+            rc, rc_msg = pi_energy_server(pi_e, path_to_socket).serve()
+            print(rc_msg)
+            os._exit(rc)
+
+        if not batch and not as_json:
+            print("\nwita_pi_energy: launching query " + query + " \n     for path_to_energy_files " + path_to_energy_files + "\n")
+
+        if profile:
+            import cProfile
+            import tracemalloc
+            tracemalloc.start()
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        # results for --json
+        results = {"version": pvm_version, "machine": machine(), "python": sys.version.split()[0],
+                   "path": path_to_energy_files}
+
+        # answer by the query server if one is listening, else in this process
+        client = pi_energy_client(path_to_socket)
+        if not local and client.connect() and not client.answers_for(path_to_energy_files):
+            # the server answers for another folder
+            client.close()
+        if client.sock is not None:
+            ask = lambda q: client.query(q, path_to_energy_files)
+            ask_many = lambda qs: client.query_many(qs, path_to_energy_files)
+            results["mode"] = "server"
+        else:
+            t0 = time.perf_counter()
+            pi_e = pi_energy(path_to_energy_files, history=history, snapshot=snapshot)
+            results["mode"] = "local"
+            results["construct_ms"] = round((time.perf_counter() - t0) * 1000, 4)
+            ask = pi_e.query
+            ask_many = pi_e.query_many
+
+        def print_answers(queries, answers):
+            for query, (rc, rc_msg, rc_TTS) in zip(queries, answers):
                 print ("\n")
                 print (query + ": pi_e.query() " + "rc= " + str(rc) + " rc_msg= " + rc_msg + "\n ")
                 print_TTS(rc_TTS)
+
+        if batch:
+            # answer the queries available on stdin in one pass, then wait for more.
+            # stdin is read in raw chunks, lines buffered by sys.stdin would be invisible to select()
+            import select
+            fd = sys.stdin.fileno()
+            rest = b""
+            eof = False
+            while not eof:
+                chunk = os.read(fd, 65536)
+                eof = not chunk
+                rest += chunk
+                while not eof and select.select([fd], [], [], 0)[0]:
+                    chunk = os.read(fd, 65536)
+                    eof = not chunk
+                    rest += chunk
+                lines = rest.split(b"\n")
+                # the last line is incomplete until its newline or the end of stdin
+                rest = b"" if eof else lines.pop()
+                queries = [l.decode("utf-8", "replace").strip() for l in lines]
+                queries = [q for q in queries if q]
+                if queries:
+                    print_answers(queries, ask_many(queries))
+                    sys.stdout.flush()
+        elif bench > 0:
+            queries = [query] if query_given and query != "AUTOTEST" else test_queries
+            results["bench"] = [bench_query(ask, q, bench) for q in queries]
+            if results["mode"] == "local":
+                results["loaded_bytes"] = pi_e.loaded_bytes()
+            if not as_json:
+                print("%-40s %3s %10s %10s %10s %10s %10s" % ("query", "rc", "first ms", "min ms", "median ms", "p95 ms", "p99 ms"))
+                for b in results["bench"]:
+                    print("%-40s %3d %10.3f %10.3f %10.3f %10.3f %10.3f" % (b["query"], b["rc"], b["first_ms"],
+                          b["min_ms"], b["median_ms"], b["p95_ms"], b["p99_ms"]))
+                print("\n" + str(len(results["bench"])) + " queries x " + str(bench) + " runs, mode "
+                      + results["mode"] + ", machine " + results["machine"])
+        elif query == "AUTOTEST":
+            answers = ask_many(test_queries)
+            if as_json:
+                results["answers"] = [{"query": q, "rc": rc, "rc_msg": rc_msg, "rc_TTS": rc_TTS}
+                                      for q, (rc, rc_msg, rc_TTS) in zip(test_queries, answers)]
+            else:
+                print_answers(test_queries, answers)
         else:
-            rc, rc_msg, rc_TTS = pi_e.query(query)
-            print ("\n")
-            print (query + ": pi_e.query() " + "rc= " + str(rc) + " rc_msg= " + rc_msg + "\n")
-            print_TTS(rc_TTS)
+            rc, rc_msg, rc_TTS = ask(query)
+            if as_json:
+                results["answers"] = [{"query": query, "rc": rc, "rc_msg": rc_msg, "rc_TTS": rc_TTS}]
+            else:
+                print ("\n")
+                print (query + ": pi_e.query() " + "rc= " + str(rc) + " rc_msg= " + rc_msg + "\n")
+                print_TTS(rc_TTS)
+
+        if profile:
+            profiler.disable()
+            results["profile"] = profile_report(profiler)
+            if not as_json:
+                print_profile(results["profile"])
+        if as_json:
+            import json
+            print(json.dumps(results, indent=1))
 
     except:
         tb = traceback.format_exc()
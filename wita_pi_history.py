@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""history store of WITA Energy items for the Picroft talk-to-me skill
+   pi_energy records the numeric values of its json files on every reload,
+   the history answers range queries like "how much did the PV produce yesterday"
+   data is kept in a sqlite database, indexed by item and time
+"""
+
+import time
+import sqlite3
+import threading
+
+class pi_history:
+    """ time series of WITA Energy items in a sqlite database
+        a sample is (item, timestamp, value), item is "<JSON-File-Type> <search key>",
+        e.g. "PVM pv-total Energy" or "HPP power_input_total_today".
+        samples are only written when the value of an item changed, ranges
+        are answered by seeks on the (item, ts) primary key.
+        the last value of every item is kept in the small table last as well,
+        so startup does not scan the samples.
+    """
+    def __init__(self, path_to_history, retention_days=None):
+        """ retention_days: samples older than this are pruned once a day, see prune(),
+                            None keeps all samples
+        """
+        self.path_to_history = path_to_history
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path_to_history, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS samples ("
+                        " item TEXT NOT NULL, ts REAL NOT NULL, value REAL NOT NULL,"
+                        " PRIMARY KEY (item, ts)) WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS last ("
+                        " item TEXT NOT NULL PRIMARY KEY, value REAL NOT NULL) WITHOUT ROWID")
+        if self.db.execute("SELECT 1 FROM last LIMIT 1").fetchone() is None:
+            # history of a version without the table last, filled once
+            # with MAX() sqlite takes the bare column value from the row of the newest sample
+            self.db.execute("INSERT INTO last (item, value)"
+                            " SELECT item, value FROM (SELECT item, value, MAX(ts) FROM samples GROUP BY item)")
+        self.db.commit()
+        # last value recorded per item, not to write unchanged values
+        self.last_values = dict(self.db.execute("SELECT item, value FROM last"))
+        # time of the last prune(), it runs once a day
+        self.pruned_at = 0
+
+    ############################################################################
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    ############################################################################
+    def to_float(self, value):
+        """ return value as float, None if it is not numeric (bool values are not recorded) """
+        if value is None or isinstance(value, bool):
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    ############################################################################
+    def record(self, jtype, jdict, timestamp):
+        """ record the numeric values of json dict jdict of the JSON-File-Type jtype at timestamp
+            jtype HPH, HPS, HPP: jdict is item -> [unit, value, description]
+            jtype PVM, PVT, CH, V: jdict is index -> [key1, key2, unit, value, ...]
+            return: rc = 0 ok, else error
+                    rc_msg return message
+                    n number of samples written
+        """
+        fct = " pi_history.record() "
+        samples = []
+        for key, j_ctl in jdict.items():
+            if jtype == "HPH" or jtype == "HPS" or jtype == "HPP":
+                item = jtype + " " + key
+                value = self.to_float(j_ctl[1])
+            else:
+                item = jtype + " " + j_ctl[0] + " " + j_ctl[1]
+                value = self.to_float(j_ctl[3])
+            if value is None or self.last_values.get(item) == value:
+                continue
+            samples.append((item, timestamp, value))
+        if not samples:
+            return 0, fct + " success!", 0
+        try:
+            with self.lock:
+                self.db.executemany("INSERT OR REPLACE INTO samples (item, ts, value) VALUES (?, ?, ?)", samples)
+                self.db.executemany("INSERT OR REPLACE INTO last (item, value) VALUES (?, ?)",
+                                    [(item, value) for item, ts, value in samples])
+                self.db.commit()
+        except sqlite3.Error as e:
+            return 1, fct + " cannot write history " + self.path_to_history + ": " + str(e) + "!", 0
+        for item, ts, value in samples:
+            self.last_values[item] = value
+        if self.retention_days is not None and time.time() - self.pruned_at >= 86400:
+            r, r_msg, n = self.prune()
+            if r != 0:
+                return r, r_msg, len(samples)
+        return 0, fct + " success!", len(samples)
+
+    ############################################################################
+    def prune(self, now=None):
+        """ delete the samples older than self.retention_days.
+            the last sample of an item before the cutoff is kept, it is the value at the cutoff,
+            so deltas of periods since the cutoff are still right.
+            return: rc = 0 ok, else error
+                    rc_msg return message
+                    n number of samples deleted
+        """
+        fct = " pi_history.prune() "
+        if now is None:
+            now = time.time()
+        self.pruned_at = now
+        if self.retention_days is None:
+            return 0, fct + " success! history is kept", 0
+        cutoff = now - self.retention_days * 86400
+        try:
+            with self.lock:
+                cursor = self.db.execute(
+                    "DELETE FROM samples WHERE ts < ? AND ts < (SELECT MAX(ts) FROM samples AS s"
+                    " WHERE s.item = samples.item AND s.ts < ?)", (cutoff, cutoff))
+                self.db.commit()
+        except sqlite3.Error as e:
+            return 1, fct + " cannot prune history " + self.path_to_history + ": " + str(e) + "!", 0
+        return 0, fct + " success!", cursor.rowcount
+
+    ############################################################################
+    def value_before(self, item, ts):
+        """ return the last value of item recorded before ts, None if there is none """
+        row = self.db.execute("SELECT value FROM samples WHERE item = ? AND ts < ? ORDER BY ts DESC LIMIT 1",
+                              (item, ts)).fetchone()
+        return None if row is None else row[0]
+
+    ############################################################################
+    def delta(self, item, start, end):
+        """ difference of a counting item, e.g. "PVM pv-total Energy", between timestamps start and end
+            the value at a timestamp is the last value recorded before it. If nothing was recorded
+            before start, the first value recorded since start is used.
+            return: rc = 0 ok, else no values of item are recorded in the range
+                    rc_msg return message
+                    value: the difference
+        """
+        fct = " pi_history.delta() "
+        with self.lock:
+            value_end = self.value_before(item, end)
+            value_start = self.value_before(item, start)
+            if value_start is None:
+                row = self.db.execute("SELECT value FROM samples WHERE item = ? AND ts >= ? AND ts < ? ORDER BY ts LIMIT 1",
+                                      (item, start, end)).fetchone()
+                value_start = None if row is None else row[0]
+        if value_end is None or value_start is None:
+            return 1, fct + " no history of " + item + " in the requested period!", 0
+        return 0, fct + " success!", value_end - value_start
+
+    ############################################################################
+    def aggregate(self, item, start, end, function):
+        """ aggregate the values of item recorded between timestamps start and end
+            function: "min", "max" or "avg"
+            return: rc = 0 ok, else no values of item are recorded in the range
+                    rc_msg return message
+                    value: the aggregated value
+        """
+        fct = " pi_history.aggregate() "
+        if function not in ("min", "max", "avg"):
+            return 2, fct + " invalid function " + function + "!", 0
+        with self.lock:
+            row = self.db.execute("SELECT " + function + "(value) FROM samples WHERE item = ? AND ts >= ? AND ts < ?",
+                                  (item, start, end)).fetchone()
+        if row is None or row[0] is None:
+            return 1, fct + " no history of " + item + " in the requested period!", 0
+        return 0, fct + " success!", row[0]
+
+# class pi_history
+############################################################################
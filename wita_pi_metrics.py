@@ -0,0 +1,269 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""metrics of pi_energy and the talk-to-me skill in the Prometheus text format
+   pi_energy_metrics counts the queries of the skill per query_hash key with their
+   latency and failure rc, see observe(), and adds the counters of pi_energy
+   (see pi_energy.get_stats()), the age of the json files and the age of the data,
+   that is of the newest timestamp in pvm-out-meter-total.json.
+
+   the metrics are exported
+     - by a local HTTP endpoint http://<host>:<port>/metrics, see serve()
+     - or as textfile for the textfile collector of node_exporter, see write_textfile()
+
+   for testing, wita_pi_metrics.py serves the metrics of an energy-files folder,
+   test/piscrape-talk-to-me.py scrapes and checks them.
+"""
+
+import sys
+import os
+import time
+import threading
+
+# upper bounds in secs of the buckets of the query latency histograms
+query_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class pi_energy_metrics:
+    """ collect the metrics of the skill's queries and render them with the
+        metrics of pi_e, see the module description
+    """
+    def __init__(self, pi_e=None, prefix="talktome"):
+        """ pi_e: pi_energy whose counters, json files and data are exported, None for the queries only
+            prefix: prefix of the metric names
+        """
+        self.pi_e = pi_e
+        self.prefix = prefix
+        # hash of query key -> [count, sum of secs, bucket counts by query_buckets]
+        self.queries = {}
+        # hash of (query key, rc) -> number of failed queries
+        self.failures = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    ############################################################################
+    def observe(self, key, rc, secs):
+        """ count a query of the query_hash key that took secs and returned rc """
+        with self.lock:
+            if key not in self.queries:
+                self.queries[key] = [0, 0.0, [0] * len(query_buckets)]
+            query = self.queries[key]
+            query[0] += 1
+            query[1] += secs
+            for i, bound in enumerate(query_buckets):
+                if secs <= bound:
+                    query[2][i] += 1
+            if rc != 0:
+                self.failures[(key, rc)] = self.failures.get((key, rc), 0) + 1
+
+    ############################################################################
+    def escape(self, value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    ############################################################################
+    def family(self, lines, name, mtype, help_text, samples):
+        """ append the metric family name with its samples [(suffix, labels, value), ...] to lines
+            suffix: "" resp. "_bucket", "_sum", "_count" of histograms
+            labels: list of (label, value)
+        """
+        name = self.prefix + "_" + name
+        lines.append("# HELP " + name + " " + help_text)
+        lines.append("# TYPE " + name + " " + mtype)
+        for suffix, labels, value in samples:
+            label_text = ""
+            if labels:
+                label_text = "{" + ",".join([l + '="' + self.escape(v) + '"' for l, v in labels]) + "}"
+            lines.append(name + suffix + label_text + " " + repr(float(value)))
+
+    ############################################################################
+    def render(self):
+        """ return the metrics in the Prometheus text format """
+        lines = []
+        with self.lock:
+            queries = dict((k, [q[0], q[1], list(q[2])]) for k, q in self.queries.items())
+            failures = dict(self.failures)
+        keys = sorted(queries)
+        self.family(lines, "queries_total", "counter", "queries of the skill by query_hash key",
+                    [("", [("key", k)], queries[k][0]) for k in keys])
+        self.family(lines, "query_failures_total", "counter", "failed queries of the skill by query_hash key and rc",
+                    [("", [("key", k), ("rc", str(rc))], n) for (k, rc), n in sorted(failures.items())])
+        samples = []
+        for k in keys:
+            count, total, buckets = queries[k]
+            for bound, n in zip(query_buckets, buckets):
+                samples.append(("_bucket", [("key", k), ("le", repr(bound))], n))
+            samples.append(("_bucket", [("key", k), ("le", "+Inf")], count))
+            samples.append(("_sum", [("key", k)], total))
+            samples.append(("_count", [("key", k)], count))
+        self.family(lines, "query_duration_seconds", "histogram", "latency of the queries of the skill", samples)
+        if self.pi_e is not None:
+            self.render_pi_energy(lines)
+        return "\n".join(lines) + "\n"
+
+    ############################################################################
+    def render_pi_energy(self, lines):
+        """ append the metrics of self.pi_e to lines """
+        pi_e = self.pi_e
+        stats = pi_e.get_stats()
+        for key, help_text in (("queries", "queries answered by pi_energy"),
+                               ("load", "checks for json files to load"),
+                               ("lookups", "items retrieved from json files or static items"),
+                               ("functions", "functions calculated"),
+                               ("function_hits", "function results reused"),
+                               ("cache_hits", "answers found in the answer cache"),
+                               ("cache_misses", "answers rendered as not found in the answer cache"),
+                               ("render", "TTS templates marked up"),
+                               ("rule_checks", "watch rules checked after reloads"),
+                               ("notifications", "watch rules fired"),
+                               ("pushes", "records pushed by collectors"),
+                               ("bytes_parsed", "bytes of the json files loaded")):
+            self.family(lines, "energy_" + key + "_total", "counter", help_text, [("", [], stats[key])])
+        for key, help_text in (("query_time", "time spent answering queries"),
+                               ("load_time", "time spent loading json files, including parsing"),
+                               ("parse_time", "time spent decoding and indexing json files"),
+                               ("function_time", "time spent calculating functions"),
+                               ("render_time", "time spent marking up TTS templates")):
+            name = "energy_" + key.replace("_time", "") + "_seconds_total"
+            self.family(lines, name, "counter", help_text, [("", [], stats[key])])
+        self.family(lines, "energy_reloads_total", "counter", "loads of the json files",
+                    [("", [("file", f)], n) for f, n in sorted(stats["reloads"].items())])
+        now = time.time()
+        samples = []
+        for index, jfile_ctl in sorted(pi_e.json_files.items()):
+            if jfile_ctl[3] != 0:
+                samples.append(("", [("file", jfile_ctl[1])], now - jfile_ctl[3]))
+        self.family(lines, "energy_file_age_seconds", "gauge", "secs since the loaded json files were written", samples)
+        self.family(lines, "energy_loaded_bytes", "gauge", "bytes of the json files loaded", [("", [], pi_e.loaded_bytes())])
+        data_time = pi_e.data_timestamp()
+        if data_time is not None:
+            self.family(lines, "energy_data_timestamp_seconds", "gauge",
+                        "time of the newest measurement in pvm-out-meter-total.json", [("", [], data_time)])
+            self.family(lines, "energy_data_age_seconds", "gauge",
+                        "secs since the newest measurement in pvm-out-meter-total.json", [("", [], now - data_time)])
+
+    ############################################################################
+    def write_textfile(self, path_to_textfile):
+        """ write the metrics to path_to_textfile for the textfile collector of node_exporter,
+            the file is replaced atomically, so the collector never reads a partial file
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy_metrics.write_textfile() "
+        path_to_tmp = path_to_textfile + ".tmp"
+        try:
+            with open(path_to_tmp, "w") as t_handle:
+                t_handle.write(self.render())
+            os.replace(path_to_tmp, path_to_textfile)
+        except OSError as e:
+            return 1, fct + " metrics could not be written: " + str(e) + "!"
+        return 0, fct + " success!"
+
+    ############################################################################
+    def serve(self, port, host="127.0.0.1"):
+        """ serve the metrics on http://host:port/metrics by a background thread, see stop()
+            port 0 picks a free port, see self.server.server_address
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy_metrics.serve() "
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+
+        class metrics_handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((host, port), metrics_handler)
+        except OSError as e:
+            return 1, fct + " cannot listen on " + host + ":" + str(port) + ": " + str(e) + "!"
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pi_energy_metrics", daemon=True)
+        self.thread.start()
+        return 0, fct + " success! serving on http://" + host + ":" + str(self.server.server_address[1]) + "/metrics"
+
+    ############################################################################
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.thread = None
+
+# class pi_energy_metrics
+############################################################################
+# here starts main program (for testing)
+
+if __name__ == "__main__":
+
+    def print_help():
+        print("wita_pi_metrics.py -p <path to energy files> [-P <port>] [-t <textfile>] [-i <interval>]")
+        print("    serves the metrics of pi_energy on http://127.0.0.1:<port>/metrics (default 9798)")
+        print("    or writes them to <textfile> every <interval> secs (default 15)")
+
+    try:
+        from wita_pi_energy import pi_energy
+    except ImportError:
+        from .wita_pi_energy import pi_energy
+
+    path_to_energy_files = "/opt/mycroft/skills/talk-to-me-skill/energy-files"
+    port = 9798
+    textfile = None
+    interval = 15
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print_help()
+            sys.exit(1)
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_energy_files = sys.argv[i+1]
+        if sys.argv[i] == "-P" or sys.argv[i] == "--port":
+            port = int(sys.argv[i+1])
+        if sys.argv[i] == "-t" or sys.argv[i] == "--textfile":
+            textfile = sys.argv[i+1]
+        if sys.argv[i] == "-i" or sys.argv[i] == "--interval":
+            interval = float(sys.argv[i+1])
+
+    pi_e = pi_energy(path_to_energy_files, watch=True, load_on_query=False)
+    metrics = pi_energy_metrics(pi_e)
+    if textfile is None:
+        rc, rc_msg = metrics.serve(port)
+        print(rc_msg)
+        if rc != 0:
+            sys.exit(rc)
+    try:
+        while True:
+            pi_e.refresh()
+            if textfile is not None:
+                rc, rc_msg = metrics.write_textfile(textfile)
+                if rc != 0:
+                    print(rc_msg)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    metrics.stop()
+    pi_e.close()
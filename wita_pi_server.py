@@ -0,0 +1,476 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""query daemon of pi_energy on a unix domain socket and its client
+   wita_pi_energy.py --serve runs pi_energy_server, it keeps the json files loaded
+   and the answers cached. wita_pi_energy.py -q <item> sends its query to the
+   server by pi_energy_client if one is listening, else it answers it itself.
+
+   protocol: one json object per line in both directions
+     request   {"query": "<item>", "path": "<energy files folder>"}
+               {"queries": ["<item>", ...], "path": "<energy files folder>"}
+               {"stats": true}
+               {"push": "<JSON-File-Type>", "records": <records>, "replace": false, "path": "..."}
+               {"path": "<energy files folder>"}   to check the server answers for the folder
+     response  {"rc": 0, "rc_msg": "...", "rc_TTS": "<answer>" or ["<answer>", ...]}
+               {"rc": 0, "rc_msg": "...", "answers": [[rc, rc_msg, rc_TTS], ...]}, see pi_energy.query_many()
+               {"rc": 0, "rc_msg": "...", "stats": {...}}, see pi_energy.get_stats()
+   "path" is optional, a request for another energy files folder than the server's
+   is answered with rc 6. A request longer than pi_energy_server.request_limit bytes
+   is answered with rc 8, a request that failed with rc 9, the connection stays open.
+
+   push: a collector pushes changed records of a JSON-File-Type (HPH, HPS, HPP, PVM, PVT,
+   CH, V) straight into the loaded json files of the server, see pi_energy.ingest(),
+   rather than writing the json file for pi_energy to parse it again. pi_energy_push()
+   falls back to writing the json file if no server accepts the connection.
+
+   for scripts, wita_pi_server.py -q <item> is a thin client: it only imports what
+   the client needs and prints the answer.
+"""
+
+import sys
+import os
+import json
+import socket
+
+pi_energy_socket = "/tmp/talk-to-me_energy-files/wita-pi-energy.sock"
+
+class pi_energy_server:
+    """ answer queries of pi_energy_client on the unix domain socket path_to_socket
+        pi_e should watch its folder and not load on query, the json files are
+        loaded by refresh() every refresh_interval secs off the event loop,
+        so queries are answered from memory.
+        only the owner of the server may connect to the socket, with socket_mode 0o660
+        its group as well, e.g. collectors running as another user of that group.
+    """
+    # bytes of a request line, e.g. records pushed by a collector
+    request_limit = 16 * 1024 * 1024
+
+    def __init__(self, pi_e, path_to_socket=pi_energy_socket, refresh_interval=5, socket_mode=0o600):
+        """ refresh_interval: None if pi_e is refreshed by its owner, e.g. the skill
+            socket_mode: permissions of the socket, any local user who may connect can push
+                         records that the skill speaks
+        """
+        self.pi_e = pi_e
+        self.path_to_socket = path_to_socket
+        self.socket_mode = socket_mode
+        self.refresh_interval = refresh_interval
+        self.stopped = None
+        self.loop = None
+        self.thread = None
+        self.listening = None   # set when listening, see start()
+
+    ############################################################################
+    def answer(self, line):
+        """ return the response to the request line """
+        fct = " pi_energy_server.answer() "
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {"rc": 1, "rc_msg": fct + " invalid request!", "rc_TTS": ""}
+        if not isinstance(request, dict):
+            return {"rc": 1, "rc_msg": fct + " invalid request!", "rc_TTS": ""}
+        path = request.get("path")
+        if path is not None and os.path.abspath(path) != os.path.abspath(self.pi_e.path_to_energy_files):
+            return {"rc": 6, "rc_msg": fct + " server answers for " + self.pi_e.path_to_energy_files + "!",
+                    "rc_TTS": ""}
+        if "query" in request:
+            rc, rc_msg, rc_TTS = self.pi_e.query(str(request["query"]))
+            return {"rc": rc, "rc_msg": rc_msg, "rc_TTS": rc_TTS}
+        if "queries" in request:
+            answers = self.pi_e.query_many([str(item) for item in request["queries"]])
+            return {"rc": 0, "rc_msg": fct + " success!", "answers": answers}
+        if "stats" in request:
+            return {"rc": 0, "rc_msg": fct + " success!", "stats": self.pi_e.get_stats()}
+        if "push" in request:
+            rc, rc_msg = self.pi_e.ingest(str(request["push"]), request.get("records"),
+                                          bool(request.get("replace", False)), len(line))
+            return {"rc": rc, "rc_msg": rc_msg}
+        if path is not None:
+            return {"rc": 0, "rc_msg": fct + " success!", "rc_TTS": ""}
+        return {"rc": 1, "rc_msg": fct + " invalid request!", "rc_TTS": ""}
+
+    ############################################################################
+    async def read_request(self, reader):
+        """ return the next request line, b"" at the end of the connection,
+            None if the request is longer than self.request_limit, it is skipped then
+        """
+        import asyncio
+        too_long = False
+        while True:
+            try:
+                line = await reader.readuntil(b"\n")
+            except asyncio.IncompleteReadError as e:
+                line = e.partial
+            except asyncio.LimitOverrunError as e:
+                # the data is left in the buffer, skip it and look for the end of the request again
+                too_long = True
+                await reader.readexactly(max(e.consumed, 1))
+                continue
+            if too_long:
+                return None
+            return line
+
+    ############################################################################
+    async def handle_client(self, reader, writer):
+        fct = " pi_energy_server.handle_client() "
+        import asyncio
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await self.read_request(reader)
+                if line is None:
+                    response = {"rc": 8, "rc_msg": fct + " request longer than " + str(self.request_limit) +
+                                " bytes!", "rc_TTS": ""}
+                elif not line:
+                    break
+                else:
+                    # queries and pushes wait for pi_e.lock, e.g. while refresh() installs json files,
+                    # they must not block the event loop and the other clients
+                    try:
+                        response = await loop.run_in_executor(None, self.answer, line)
+                    except Exception as e:
+                        response = {"rc": 9, "rc_msg": fct + " request failed by " + repr(e) + "!", "rc_TTS": ""}
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the server is stopped while the client is still connected
+            pass
+        finally:
+            writer.close()
+
+    ############################################################################
+    async def refresher(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.pi_e.refresh)
+            except Exception as e:
+                print(" pi_energy_server.refresher()  refresh failed: " + str(e))
+            await asyncio.sleep(self.refresh_interval)
+
+    ############################################################################
+    async def run(self, signals=True):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        self.loop = loop
+        self.stopped = asyncio.Event()
+        if signals:
+            import signal
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.stopped.set)
+        # the permissions are set before the socket listens, so nobody else can connect meanwhile
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.path_to_socket)
+            os.chmod(self.path_to_socket, self.socket_mode)
+        except OSError:
+            sock.close()
+            raise
+        server = await asyncio.start_unix_server(self.handle_client, sock=sock, limit=self.request_limit)
+        if self.listening is not None:
+            self.listening.set()
+        refresher = None
+        if self.refresh_interval is not None:
+            refresher = asyncio.create_task(self.refresher())
+        try:
+            async with server:
+                await self.stopped.wait()
+        finally:
+            if refresher is not None:
+                refresher.cancel()
+
+    ############################################################################
+    def serve(self):
+        """ serve until SIGINT or SIGTERM
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy_server.serve() "
+        rc, rc_msg = self.prepare_socket()
+        if rc != 0:
+            return rc, fct + rc_msg
+        import asyncio
+        try:
+            asyncio.run(self.run())
+        finally:
+            if os.path.exists(self.path_to_socket):
+                os.unlink(self.path_to_socket)
+            self.pi_e.close()
+        return 0, fct + " success!"
+
+    ############################################################################
+    def prepare_socket(self):
+        """ remove the stale socket of a server that was killed
+            return: rc = 0 ok, 1 if a server is listening on self.path_to_socket
+                    rc_msg return message
+        """
+        if os.path.exists(self.path_to_socket):
+            client = pi_energy_client(self.path_to_socket)
+            if client.connect():
+                client.close()
+                return 1, " a server is already listening on " + self.path_to_socket + "!"
+            os.unlink(self.path_to_socket)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path_to_socket)), exist_ok=True)
+        return 0, " success!"
+
+    ############################################################################
+    def start(self):
+        """ serve by a background thread until stop(), e.g. in the skill, pi_e stays open
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy_server.start() "
+        rc, rc_msg = self.prepare_socket()
+        if rc != 0:
+            return rc, fct + rc_msg
+        import asyncio
+        import threading
+        self.listening = threading.Event()
+
+        def serve_thread():
+            try:
+                asyncio.run(self.run(signals=False))
+            finally:
+                self.listening.set()
+                if os.path.exists(self.path_to_socket):
+                    os.unlink(self.path_to_socket)
+
+        self.thread = threading.Thread(target=serve_thread, name="pi_energy_server", daemon=True)
+        self.thread.start()
+        self.listening.wait()
+        if not self.thread.is_alive():
+            self.thread = None
+            return 2, fct + " cannot listen on " + self.path_to_socket + "!"
+        return 0, fct + " success! serving on " + self.path_to_socket
+
+    ############################################################################
+    def stop(self):
+        """ stop the server started by start() """
+        if self.thread is not None:
+            if self.loop is not None and self.stopped is not None:
+                self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join()
+            self.thread = None
+
+# class pi_energy_server
+############################################################################
+
+class pi_energy_client:
+    """ send queries to pi_energy_server, see the module description """
+    def __init__(self, path_to_socket=pi_energy_socket, timeout=10):
+        self.path_to_socket = path_to_socket
+        self.timeout = timeout
+        self.sock = None
+        self.stream = None
+
+    ############################################################################
+    def connect(self):
+        """ return True if connected to the server """
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.path_to_socket)
+        except OSError:
+            self.close()
+            return False
+        self.stream = self.sock.makefile("rwb")
+        return True
+
+    ############################################################################
+    def close(self):
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except OSError:
+                # the request could not be flushed, the server is gone
+                pass
+            self.stream = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    ############################################################################
+    def request(self, request):
+        """ send request and return the response hash, None if the server is gone """
+        try:
+            self.stream.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.stream.flush()
+            line = self.stream.readline()
+        except OSError:
+            return None
+        if not line:
+            return None
+        return json.loads(line)
+
+    ############################################################################
+    def answers_for(self, path_to_energy_files):
+        """ return True if the server answers for the energy files folder path_to_energy_files """
+        response = self.request({"path": path_to_energy_files})
+        return response is not None and response["rc"] == 0
+
+    ############################################################################
+    def query(self, item, path_to_energy_files=None):
+        """ query item like pi_energy.query()
+            return: rc = 0 ok, else error, rc 7 if the server is gone
+                    rc_msg return message
+                    rc_TTS answer or array of answers
+        """
+        fct = " pi_energy_client.query() "
+        request = {"query": item}
+        if path_to_energy_files is not None:
+            request["path"] = path_to_energy_files
+        response = self.request(request)
+        if response is None:
+            return 7, fct + " no response from server " + self.path_to_socket + "!", ""
+        return response["rc"], response["rc_msg"], response["rc_TTS"]
+
+    ############################################################################
+    def query_many(self, items, path_to_energy_files=None):
+        """ query items like pi_energy.query_many()
+            return: list of (rc, rc_msg, rc_TTS) in the order of items
+        """
+        fct = " pi_energy_client.query_many() "
+        items = list(items)
+        request = {"queries": items}
+        if path_to_energy_files is not None:
+            request["path"] = path_to_energy_files
+        response = self.request(request)
+        if response is None:
+            return [(7, fct + " no response from server " + self.path_to_socket + "!", "")] * len(items)
+        if "answers" not in response:
+            return [(response["rc"], response["rc_msg"], "")] * len(items)
+        return [tuple(answer) for answer in response["answers"]]
+
+    ############################################################################
+    def push(self, jtype, records, replace=False, path_to_energy_files=None):
+        """ push records of the JSON-File-Type jtype to the server, see pi_energy.ingest()
+            return: rc = 0 ok, else error, rc 7 if the server is gone
+                    rc_msg return message
+        """
+        fct = " pi_energy_client.push() "
+        request = {"push": jtype, "records": records, "replace": replace}
+        if path_to_energy_files is not None:
+            request["path"] = path_to_energy_files
+        response = self.request(request)
+        if response is None:
+            return 7, fct + " no response from server " + self.path_to_socket + "!"
+        return response["rc"], response["rc_msg"]
+
+# class pi_energy_client
+############################################################################
+
+def pi_energy_push(jtype, records, path_to_energy_files, replace=False, path_to_socket=pi_energy_socket,
+                   client=None):
+    """ push records of the JSON-File-Type jtype to the server answering for path_to_energy_files,
+        if no server accepts the connection or it answers for another folder, fall back to
+        file mode: merge them into the json file, see wita_pi_energy.pi_write_records()
+        client: connected pi_energy_client to reuse, e.g. by a collector pushing every cycle.
+                if its server is gone, it is connected again.
+        return: rc = 0 ok, else error
+                rc_msg return message
+                mode "socket" or "file"
+    """
+    own_client = client is None
+    if own_client:
+        client = pi_energy_client(path_to_socket)
+        client.connect()
+    try:
+        if client.sock is not None:
+            rc, rc_msg = client.push(jtype, records, replace, path_to_energy_files)
+            if rc == 7:
+                # the server of a reused connection may have been restarted meanwhile
+                client.close()
+                if client.connect():
+                    rc, rc_msg = client.push(jtype, records, replace, path_to_energy_files)
+            # rc 6: the server answers for another folder
+            if client.sock is not None and rc != 6:
+                return rc, rc_msg, "socket"
+    finally:
+        if own_client:
+            client.close()
+    try:
+        from .wita_pi_energy import pi_write_records
+    except ImportError:
+        from wita_pi_energy import pi_write_records
+    rc, rc_msg = pi_write_records(path_to_energy_files, jtype, records, replace)
+    return rc, rc_msg, "file"
+
+# pi_energy_push
+############################################################################
+# here starts main program: thin client for scripts
+
+if __name__ == "__main__":
+
+    def print_help():
+        print("wita_pi_server.py -q <query> [-p <path to energy files>] [-s <socket>]")
+        print("    sends the query to the server started by wita_pi_energy.py --serve")
+        print("    and prints the answer, exit code is the rc of the query")
+        print("wita_pi_server.py -P <JSON-File-Type> -p <path to energy files> [-r] [-s <socket>] < records.json")
+        print("    pushes the records read from stdin to the server, or writes them to the")
+        print("    json file if no server is listening, -r replaces all records of the json file")
+        print("    default socket: " + pi_energy_socket)
+
+    query = None
+    push = None
+    replace = False
+    path_to_energy_files = None
+    path_to_socket = pi_energy_socket
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print_help()
+            sys.exit(1)
+        if sys.argv[i] == "-q" or sys.argv[i] == "--query":
+            query = sys.argv[i+1]
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_energy_files = sys.argv[i+1]
+        if sys.argv[i] == "-s" or sys.argv[i] == "--socket":
+            path_to_socket = sys.argv[i+1]
+        if sys.argv[i] == "-P" or sys.argv[i] == "--push":
+            push = sys.argv[i+1]
+        if sys.argv[i] == "-r" or sys.argv[i] == "--replace":
+            replace = True
+    if push is not None:
+        if path_to_energy_files is None:
+            print_help()
+            sys.exit(1)
+        try:
+            records = json.load(sys.stdin)
+        except ValueError as e:
+            print(" pi_energy_push()  records are no json: " + str(e), file=sys.stderr)
+            sys.exit(2)
+        rc, rc_msg, mode = pi_energy_push(push, records, os.path.abspath(path_to_energy_files), replace, path_to_socket)
+        print(mode + ": " + rc_msg, file=sys.stderr if rc != 0 else sys.stdout)
+        sys.exit(rc)
+    if query is None:
+        print_help()
+        sys.exit(1)
+
+    client = pi_energy_client(path_to_socket)
+    if not client.connect():
+        print(" pi_energy_client.connect()  no server listening on " + path_to_socket + "!", file=sys.stderr)
+        sys.exit(7)
+    rc, rc_msg, rc_TTS = client.query(query, path_to_energy_files)
+    client.close()
+    if rc != 0:
+        print(rc_msg, file=sys.stderr)
+    for t in (rc_TTS if isinstance(rc_TTS, list) else [rc_TTS]):
+        print(t)
+    sys.exit(rc)
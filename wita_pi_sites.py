@@ -0,0 +1,250 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""multi-site mode of pi_energy for a hub that answers for many households
+   every site (household) has its own energy-files folder. pi_energy_sites keeps a
+   registry of site id -> energy-files folder and a bounded LRU of pi_energy instances
+   with their json files loaded, the least recently queried sites are evicted.
+   compiled TTS templates and the query tables are shared by all pi_energy instances.
+"""
+
+import sys
+import os
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    from .wita_pi_energy import pi_energy
+except ImportError:
+    from wita_pi_energy import pi_energy
+
+class pi_energy_sites:
+    """ answer queries for many sites, see query()
+        sites are loaded on their first query and kept in an LRU, bounded by
+          max_sites:  number of sites loaded at the same time
+          max_bytes:  memory of all sites, every site counts site_bytes for its pi_energy instance
+                      and the estimate of its json files and caches, see pi_energy.memory_estimate()
+        an evicted site is loaded again on its next query.
+        the json files of all sites are read by one executor of json_workers threads.
+        a pi_energy is checked out by get_site() while it answers a query, an evicted one
+        is closed when the last query checked in, see release().
+    """
+    def __init__(self, max_sites=1000, max_bytes=256 * 1024 * 1024, snapshot=None, decoder=None,
+                 json_workers=4):
+        """ snapshot, decoder: passed to the pi_energy of every site, see pi_energy()
+            json_workers: threads reading the json files of all sites
+        """
+        self.max_sites = max_sites
+        self.max_bytes = max_bytes
+        # estimate of the memory of a pi_energy instance with its tables, without json files and caches
+        self.site_bytes = 64 * 1024
+        self.snapshot = snapshot
+        self.decoder = decoder
+        # hash of site id to energy-files folder
+        self.registry = {}
+        # LRU of site id -> [pi_energy, bytes], least recently queried first
+        self.sites = OrderedDict()
+        self.loaded_bytes = 0
+        self.evictions = 0
+        # hash of pi_energy -> number of queries it currently answers, see get_site()
+        self.checked_out = {}
+        # evicted pi_energy instances still checked out, closed by release()
+        self.retired = set()
+        self.json_workers = json_workers
+        self.json_executor = None
+        self.lock = threading.Lock()
+
+    ############################################################################
+    def add_site(self, site, path_to_energy_files):
+        """ register or move site to the energy-files folder path_to_energy_files """
+        with self.lock:
+            if self.registry.get(site) != path_to_energy_files:
+                self.registry[site] = path_to_energy_files
+                self.evict(site)
+
+    ############################################################################
+    def remove_site(self, site):
+        with self.lock:
+            self.registry.pop(site, None)
+            self.evict(site)
+
+    ############################################################################
+    def load_registry(self, path_to_registry):
+        """ register the sites of a json file {"<site id>": "<energy-files folder>", ...}
+            relative folders are relative to the folder of the json file
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_energy_sites.load_registry() "
+        try:
+            with open(path_to_registry) as r_handle:
+                registry = json.load(r_handle)
+        except (OSError, ValueError) as e:
+            return 1, fct + " registry could not be loaded: " + str(e) + "!"
+        base = os.path.dirname(os.path.abspath(path_to_registry))
+        for site, path_to_energy_files in registry.items():
+            self.add_site(site, os.path.join(base, path_to_energy_files))
+        return 0, fct + " success! " + str(len(registry)) + " sites"
+
+    ############################################################################
+    def evict(self, site):
+        """ drop the loaded pi_energy of site, the caller must hold self.lock
+            a pi_energy that still answers queries is closed by the last release()
+        """
+        if site in self.sites:
+            pi_e, size = self.sites.pop(site)
+            self.loaded_bytes -= size
+            self.evictions += 1
+            if pi_e in self.checked_out:
+                self.retired.add(pi_e)
+            else:
+                pi_e.close()
+
+    ############################################################################
+    def get_site(self, site):
+        """ check out the pi_energy of site, the caller must release() it after the query
+            return: pi_energy, None if site is not registered
+        """
+        with self.lock:
+            if site in self.sites:
+                self.sites.move_to_end(site)
+                pi_e = self.sites[site][0]
+            elif site not in self.registry:
+                return None
+            else:
+                if self.json_executor is None and self.json_workers > 1:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self.json_executor = ThreadPoolExecutor(max_workers=self.json_workers,
+                                                            thread_name_prefix="pi_energy_sites_json")
+                pi_e = pi_energy(self.registry[site], snapshot=self.snapshot, decoder=self.decoder,
+                                 executor=self.json_executor)
+                self.sites[site] = [pi_e, self.site_bytes]
+                self.loaded_bytes += self.site_bytes
+            self.checked_out[pi_e] = self.checked_out.get(pi_e, 0) + 1
+            return pi_e
+
+    ############################################################################
+    def release(self, pi_e):
+        """ check in the pi_energy checked out by get_site(), close it if it was evicted meanwhile """
+        with self.lock:
+            self.checked_out[pi_e] -= 1
+            if self.checked_out[pi_e] > 0:
+                return
+            del self.checked_out[pi_e]
+            if pi_e not in self.retired:
+                return
+            self.retired.discard(pi_e)
+        pi_e.close()
+
+    ############################################################################
+    def close(self):
+        """ close the pi_energy of all sites and stop the json workers """
+        with self.lock:
+            for site in list(self.sites):
+                self.evict(site)
+            executor = self.json_executor
+            self.json_executor = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    ############################################################################
+    def account(self, site, pi_e):
+        """ update the size of site after a query, its json files and caches may have grown,
+            and evict the least recently queried sites until the LRU is within its bounds again.
+            The site just queried is kept.
+        """
+        # estimated before self.lock is taken, it waits for the queries of pi_e
+        size = self.site_bytes + pi_e.memory_estimate()
+        with self.lock:
+            if site not in self.sites or self.sites[site][0] is not pi_e:
+                return
+            self.loaded_bytes += size - self.sites[site][1]
+            self.sites[site][1] = size
+            while len(self.sites) > 1 and (len(self.sites) > self.max_sites or self.loaded_bytes > self.max_bytes):
+                self.evict(next(iter(self.sites)))
+
+    ############################################################################
+    def query(self, site, item):
+        """ answer the query item for site, see pi_energy.query()
+            return: rc = 0 ok, else error
+                    rc_msg return message
+                    rc_TTS  text-to-speech answer or an array of answers
+        """
+        fct = " pi_energy_sites.query() "
+        pi_e = self.get_site(site)
+        if pi_e is None:
+            return 5, fct + " site " + str(site) + " is not registered!", ""
+        try:
+            result = pi_e.query(item)
+            self.account(site, pi_e)
+        finally:
+            self.release(pi_e)
+        return result
+
+    ############################################################################
+    def get_stats(self):
+        """ return hash of the LRU state: sites registered and loaded, bytes and evictions """
+        with self.lock:
+            return {
+                "registered": len(self.registry),
+                "loaded": len(self.sites),
+                "loaded_bytes": self.loaded_bytes,
+                "evictions": self.evictions,
+                "checked_out": sum(self.checked_out.values()),
+            }
+
+# class pi_energy_sites
+############################################################################
+# here starts main program (for testing)
+
+if __name__ == "__main__":
+
+    def print_help():
+        print("wita_pi_sites.py -r <registry.json> -s <site> [-q <query>]")
+        print("    registry.json: {\"<site id>\": \"<energy-files folder>\", ...}")
+
+    registry = None
+    site = None
+    query = "outdoor"
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print_help()
+            sys.exit(1)
+        if sys.argv[i] == "-r" or sys.argv[i] == "--registry":
+            registry = sys.argv[i+1]
+        if sys.argv[i] == "-s" or sys.argv[i] == "--site":
+            site = sys.argv[i+1]
+        if sys.argv[i] == "-q" or sys.argv[i] == "--query":
+            query = sys.argv[i+1]
+    if registry is None or site is None:
+        print_help()
+        sys.exit(1)
+
+    pi_sites = pi_energy_sites()
+    rc, rc_msg = pi_sites.load_registry(registry)
+    if rc != 0:
+        print(rc_msg)
+        sys.exit(rc)
+    rc, rc_msg, rc_TTS = pi_sites.query(site, query)
+    print(query + ": pi_sites.query() " + "rc= " + str(rc) + " rc_msg= " + rc_msg + "\n")
+    if isinstance(rc_TTS, list):
+        for t in rc_TTS:
+            print(t)
+    else:
+        print(rc_TTS)
+    pi_sites.close()
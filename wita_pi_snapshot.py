@@ -0,0 +1,366 @@
+#!/usr/bin/python
+
+# Copyright 2023 MMWolf-Photovoltaik GbR
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""binary snapshot of all WITA Energy json files for the Picroft talk-to-me skill
+   rather than seven json files, a collector may write one snapshot file that
+   pi_energy maps into memory and reads without parsing.
+
+   file layout, all numbers little endian:
+     header          magic "WITASNAP", version u16, number of sections u16,
+                     reserved u32, generation u64
+     section table   per section: JSON-File-Type 4s, entries u32, directory offset u32,
+                     hash table offset u32, hash table slots u32, crc32 of the section u32,
+                     generation of its last change u64
+     key directory   per section and entry: key1, key2, unit, description as
+                     (string pool offset u32, length u16), value type u8, 3 pad bytes,
+                     value slot 8 bytes
+     hash table      per section: a power of 2 slots u32 of entry number + 1 (0 is empty),
+                     open addressing with linear probing on crc32 of the key
+     string pool     utf-8 strings referenced by the directory
+   value types: 0 null, 1 float64, 2 int64, 3 bool, 4 string (offset u32, length u32),
+                5 json text (offset u32, length u32) for lists and other values
+   numeric strings as written by the collectors, e.g. "12356.4", are stored as float64.
+
+   entries of the HP types (HPH, HPS, HPP) are json items key -> [unit, value, description],
+   key2 is empty. Entries of the other types are json records [key1, key2, unit, value, ...],
+   further record fields are kept as json text in the description.
+   the key of an entry is key1 for the HP types, key1 + "\\0" + key2 for the others.
+   If a key occurs more than once, the last entry wins, like in pi_energy.index_json_dict().
+"""
+
+import sys
+import os
+import json
+import mmap
+import struct
+import zlib
+
+snapshot_magic = b"WITASNAP"
+snapshot_version = 1
+snapshot_header = struct.Struct("<8sHHIQ")
+snapshot_section = struct.Struct("<4sIIIIIQ")
+snapshot_entry = struct.Struct("<IHIHIHIHB3x8s")
+snapshot_slot = struct.Struct("<I")
+
+T_NULL, T_FLOAT, T_INT, T_BOOL, T_STR, T_JSON = 0, 1, 2, 3, 4, 5
+
+# JSON-File-Types whose json files are keyed by item rather than lists of records
+snapshot_item_types = ("HPH", "HPS", "HPP")
+
+############################################################################
+
+class pi_snapshot_section:
+    """ one JSON-File-Type of a snapshot, read from the mapped snapshot file
+        the section is the lookup index pi_energy expects: keyed by item for the HP
+        types, by (key1, key2) for the others, returning json shaped records.
+        items() iterates json shaped (key, record) pairs like the json dict.
+        keys are found by the hash table of the snapshot, nothing is decoded before
+        a record is accessed.
+    """
+    def __init__(self, snapshot, jtype, count, dir_offset, hash_offset, hash_slots, crc, generation):
+        self.snapshot = snapshot
+        self.jtype = jtype
+        self.count = count
+        self.dir_offset = dir_offset
+        self.hash_offset = hash_offset
+        self.hash_slots = hash_slots
+        self.crc = crc
+        self.generation = generation
+        self.item_type = jtype in snapshot_item_types
+
+    def entry(self, n):
+        return snapshot_entry.unpack_from(self.snapshot.map, self.dir_offset + n * snapshot_entry.size)
+
+    def find(self, key):
+        """ return the entry number of key, -1 if it is not in the section """
+        if self.item_type:
+            if not isinstance(key, str):
+                return -1
+            k1, k2 = key.encode("utf-8"), b""
+        else:
+            if not isinstance(key, tuple) or len(key) != 2:
+                return -1
+            k1, k2 = key[0].encode("utf-8"), key[1].encode("utf-8")
+        if self.hash_slots == 0:
+            return -1
+        s_map = self.snapshot.map
+        mask = self.hash_slots - 1
+        slot = zlib.crc32(k1 + b"\0" + k2) & mask
+        while True:
+            n = snapshot_slot.unpack_from(s_map, self.hash_offset + slot * snapshot_slot.size)[0]
+            if n == 0:
+                return -1
+            fields = self.entry(n - 1)
+            if s_map[fields[0]:fields[0] + fields[1]] == k1 and s_map[fields[2]:fields[2] + fields[3]] == k2:
+                return n - 1
+            slot = (slot + 1) & mask
+
+    def record(self, n):
+        """ return the json shaped record of entry n """
+        k1_off, k1_len, k2_off, k2_len, u_off, u_len, d_off, d_len, vtype, slot = self.entry(n)
+        string = self.snapshot.string
+        value = self.snapshot.value(vtype, slot)
+        if self.item_type:
+            return [string(u_off, u_len), value, string(d_off, d_len)]
+        record = [string(k1_off, k1_len), string(k2_off, k2_len), string(u_off, u_len), value]
+        if d_len:
+            record.extend(json.loads(string(d_off, d_len)))
+        return record
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        n = self.find(key)
+        if n < 0:
+            raise KeyError(key)
+        return self.record(n)
+
+    def __len__(self):
+        return self.count
+
+    def get(self, key, default=None):
+        n = self.find(key)
+        return default if n < 0 else self.record(n)
+
+    def items(self):
+        for n in range(self.count):
+            if self.item_type:
+                fields = self.entry(n)
+                yield self.snapshot.string(fields[0], fields[1]), self.record(n)
+            else:
+                yield str(n + 1), self.record(n)
+
+# class pi_snapshot_section
+############################################################################
+
+class pi_snapshot:
+    """ reader of a snapshot file, see the module description
+        the file is mapped read only; a collector replaces it atomically, so the
+        mapping of an older snapshot stays valid as long as it is referenced.
+    """
+    def __init__(self, path_to_snapshot):
+        self.path_to_snapshot = path_to_snapshot
+        with open(path_to_snapshot, "rb") as s_handle:
+            self.map = mmap.mmap(s_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_sections, reserved, self.generation = snapshot_header.unpack_from(self.map, 0)
+        if magic != snapshot_magic or version != snapshot_version:
+            raise ValueError("not a version " + str(snapshot_version) + " snapshot: " + path_to_snapshot)
+        self.sections = {}
+        for i in range(n_sections):
+            fields = snapshot_section.unpack_from(self.map, snapshot_header.size + i * snapshot_section.size)
+            jtype = fields[0].rstrip(b"\0").decode("ascii")
+            self.sections[jtype] = pi_snapshot_section(self, jtype, *fields[1:])
+
+    def string(self, offset, length):
+        return str(self.map[offset:offset + length], "utf-8")
+
+    def value(self, vtype, slot):
+        if vtype == T_FLOAT:
+            return struct.unpack("<d", slot)[0]
+        if vtype == T_INT:
+            return struct.unpack("<q", slot)[0]
+        if vtype == T_BOOL:
+            return slot[0] != 0
+        if vtype == T_STR or vtype == T_JSON:
+            offset, length = struct.unpack("<II", slot)
+            text = self.string(offset, length)
+            return text if vtype == T_STR else json.loads(text)
+        return None
+
+# class pi_snapshot
+############################################################################
+
+class pi_snapshot_writer:
+    """ writer of a snapshot file for the collector side
+        usage:  w = pi_snapshot_writer(path)
+                w.set_section("PVM", pv_meter_dict)   # the dict that would go to pv_meter.json
+                ...
+                w.write()
+        the generation of a section only changes if its content changed, so pi_energy
+        only reloads and re-renders what changed. Writing is atomic (write and rename).
+    """
+    def __init__(self, path_to_snapshot):
+        self.path_to_snapshot = path_to_snapshot
+        self.generation = 0
+        self.sections = {}      # jtype -> json dict
+        self.crcs = {}          # jtype -> crc32 of the section as last written
+        self.generations = {}   # jtype -> generation of the last change
+        if os.path.exists(path_to_snapshot):
+            try:
+                snapshot = pi_snapshot(path_to_snapshot)
+                self.generation = snapshot.generation
+                for jtype, section in snapshot.sections.items():
+                    self.crcs[jtype] = section.crc
+                    self.generations[jtype] = section.generation
+                    self.sections[jtype] = dict(section.items())
+            except (OSError, ValueError, struct.error):
+                pass
+
+    ############################################################################
+    def set_section(self, jtype, jdict):
+        """ set the content of the JSON-File-Type jtype, jdict as it is written to its json file """
+        self.sections[jtype] = jdict
+
+    ############################################################################
+    def typed_value(self, value):
+        """ return value type and content of value:
+            8 bytes for the numeric types, the text for strings and json
+        """
+        if value is None:
+            return T_NULL, bytes(8)
+        if isinstance(value, bool):
+            return T_BOOL, struct.pack("<B7x", 1 if value else 0)
+        if isinstance(value, int) and -2**63 <= value < 2**63:
+            return T_INT, struct.pack("<q", value)
+        if isinstance(value, float):
+            return T_FLOAT, struct.pack("<d", value)
+        if isinstance(value, str):
+            try:
+                return T_FLOAT, struct.pack("<d", float(value))
+            except ValueError:
+                return T_STR, value
+        return T_JSON, json.dumps(value)
+
+    ############################################################################
+    def write(self):
+        """ write all sections to the snapshot file
+            return: rc = 0 ok, else error
+                    rc_msg return message
+        """
+        fct = " pi_snapshot_writer.write() "
+        self.generation += 1
+        jtypes = sorted(self.sections)
+        # entries of all sections: jtype -> list of (key1, key2, unit, description, value type, content)
+        entries = {}
+        for jtype in jtypes:
+            entries[jtype] = []
+            for key, j_ctl in self.sections[jtype].items():
+                if jtype in snapshot_item_types:
+                    key1, key2, unit, value, descr = key, "", j_ctl[0], j_ctl[1], j_ctl[2]
+                else:
+                    key1, key2, unit, value = j_ctl[0], j_ctl[1], j_ctl[2], j_ctl[3]
+                    descr = json.dumps(j_ctl[4:]) if len(j_ctl) > 4 else ""
+                entries[jtype].append((str(key1), str(key2), str(unit), str(descr)) + self.typed_value(value))
+        offset = snapshot_header.size + len(jtypes) * snapshot_section.size
+        layout = {}     # jtype -> (directory offset, hash table offset, hash table slots)
+        for jtype in jtypes:
+            hash_slots = 0
+            if entries[jtype]:
+                hash_slots = 1 << (2 * len(entries[jtype]) - 1).bit_length()
+            layout[jtype] = (offset, offset + len(entries[jtype]) * snapshot_entry.size, hash_slots)
+            offset = layout[jtype][1] + hash_slots * snapshot_slot.size
+        pool = snapshot_pool(offset)
+        section_table = []
+        parts = []
+        for jtype in jtypes:
+            dir_offset, hash_offset, hash_slots = layout[jtype]
+            directory = []
+            table = [0] * hash_slots
+            crc = 0
+            for n, (key1, key2, unit, descr, vtype, content) in enumerate(entries[jtype]):
+                crc = zlib.crc32("\0".join((key1, key2, unit, descr, str(vtype), "")).encode("utf-8"), crc)
+                if isinstance(content, str):
+                    crc = zlib.crc32(content.encode("utf-8"), crc)
+                    content = struct.pack("<II", *pool.add(content))
+                else:
+                    crc = zlib.crc32(content, crc)
+                directory.append(snapshot_entry.pack(*(pool.add(key1) + pool.add(key2) + pool.add(unit) +
+                                                       pool.add(descr) + (vtype, content))))
+                # hash table, a later entry of the same key replaces the earlier one
+                slot = zlib.crc32((key1 + "\0" + key2).encode("utf-8")) & (hash_slots - 1)
+                while table[slot] != 0 and entries[jtype][table[slot] - 1][0:2] != (key1, key2):
+                    slot = (slot + 1) & (hash_slots - 1)
+                table[slot] = n + 1
+            if self.crcs.get(jtype) != crc:
+                self.crcs[jtype] = crc
+                self.generations[jtype] = self.generation
+            section_table.append(snapshot_section.pack(jtype.encode("ascii"), len(entries[jtype]), dir_offset,
+                                                       hash_offset, hash_slots, crc, self.generations[jtype]))
+            parts.append(b"".join(directory))
+            parts.append(struct.pack("<" + str(hash_slots) + "I", *table))
+        data = b"".join([snapshot_header.pack(snapshot_magic, snapshot_version, len(jtypes), 0, self.generation)] +
+                        section_table + parts + [pool.data()])
+        tmp_path = self.path_to_snapshot + ".tmp"
+        try:
+            with open(tmp_path, "wb") as s_handle:
+                s_handle.write(data)
+            os.replace(tmp_path, self.path_to_snapshot)
+        except OSError as e:
+            return 1, fct + " cannot write " + self.path_to_snapshot + ": " + str(e) + "!"
+        return 0, fct + " success!"
+
+# class pi_snapshot_writer
+############################################################################
+
+class snapshot_pool:
+    """ string pool of a snapshot being written, equal strings are stored once """
+    def __init__(self, offset):
+        self.offset = offset
+        self.size = 0
+        self.parts = []
+        self.strings = {}
+
+    def add(self, text):
+        """ add text, return (offset, length) in the snapshot file """
+        if text not in self.strings:
+            b = text.encode("utf-8")
+            self.strings[text] = (self.offset + self.size, len(b))
+            self.parts.append(b)
+            self.size += len(b)
+        return self.strings[text]
+
+    def data(self):
+        return b"".join(self.parts)
+
+############################################################################
+# here starts main program: convert the json files of an energy-files folder to a snapshot
+
+if __name__ == "__main__":
+
+    json_files = {
+        "HPH": "hpm-out-header.json",
+        "HPS": "hpm-out-shortterm.json",
+        "HPP": "hpm-out-longterm.json",
+        "PVM": "pv_meter.json",
+        "PVT": "pvm-out-meter-total.json",
+        "CH":  "charger.json",
+        "V":   "vehicle.json",
+    }
+    path_to_energy_files = "/opt/mycroft/skills/talk-to-me-skill/energy-files"
+    path_to_snapshot = None
+    for i in range(len(sys.argv)):
+        if sys.argv[i] == "-h" or sys.argv[i] == "--help":
+            print("wita_pi_snapshot.py -p <path to energy files> [-o <snapshot file>]")
+            print("    converts the json files to a snapshot, default: <path>/energy-snapshot.wsnap")
+            sys.exit(1)
+        if sys.argv[i] == "-p" or sys.argv[i] == "--path":
+            path_to_energy_files = sys.argv[i+1]
+        if sys.argv[i] == "-o" or sys.argv[i] == "--output":
+            path_to_snapshot = sys.argv[i+1]
+    if path_to_snapshot is None:
+        path_to_snapshot = os.path.join(path_to_energy_files, "energy-snapshot.wsnap")
+
+    writer = pi_snapshot_writer(path_to_snapshot)
+    for jtype, filename in json_files.items():
+        path_to_file = os.path.join(path_to_energy_files, filename)
+        if os.path.isfile(path_to_file):
+            with open(path_to_file) as j_handle:
+                writer.set_section(jtype, json.load(j_handle))
+    rc, rc_msg = writer.write()
+    print(rc_msg)
+    sys.exit(rc)